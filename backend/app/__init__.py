@@ -3,7 +3,10 @@ from flask_restful import Api
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
 from .routes import initialize_routes
-from .db import db, init_db
+from .request_sessions import request_sessions
+from .migrations import migrate
+from .services.openai_service import openai_service
+from .services.dm_outbox import dm_outbox
 import os
 from dotenv import load_dotenv
 
@@ -29,13 +32,6 @@ def create_app():
         response.headers.add('Access-Control-Allow-Credentials', 'true')
         return response
     
-    # Configure database
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///emerald_altar.db'
-    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    
-    # Initialize database
-    db.init_app(app)
-    
     # Configure JWT
     app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', 'super-secret-key')
     app.config['JWT_ACCESS_TOKEN_EXPIRES'] = 5200
@@ -60,12 +56,17 @@ def create_app():
         response.status_code = 404
         return response
     
+    # Close each request's Session when its app context ends, and report leaks
+    request_sessions.init_app(app)
+    
     # Initialize API routes
     api = Api(app)
     initialize_routes(api)
     
-    # Create database tables
-    with app.app_context():
-        init_db()
+    # Create missing tables and apply pending schema migrations (see app/migrations.py)
+    migrate()
+    
+    # Apply DM reply effects after the response (DM_EFFECTS_MODE=outbox)
+    dm_outbox.start(openai_service._apply_effects, openai_service._queue_item_images)
     
     return app
@@ -1,18 +1,257 @@
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker, Session as OrmSession
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 import os
+import time
+import threading
+from collections import deque
 from contextlib import contextmanager
+from dotenv import load_dotenv
 
-# Create SQLAlchemy instance
-db = SQLAlchemy()
+# DATABASE_URL may come from the .env file
+load_dotenv()
 
-# Create database engine with absolute path
+# Database file used when DATABASE_URL is not set, next to this module
 db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'emerald_altar.db')
-engine = create_engine(f'sqlite:///{db_path}', pool_size=10, max_overflow=20, pool_timeout=60)
+
+# SQLite connection settings (see create_db_engine)
+DEFAULT_BUSY_TIMEOUT_MS = 5000
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+DEFAULT_CACHE_SIZE_KB = 16000
+DEFAULT_POOL_SIZE = 5
+DEFAULT_READ_POOL_SIZE = 10
+
+# Connection pool of a server database (PostgreSQL), per process
+DEFAULT_DB_POOL_SIZE = 10
+DEFAULT_DB_MAX_OVERFLOW = 10
+DEFAULT_DB_POOL_TIMEOUT = 30
+DEFAULT_DB_POOL_RECYCLE = 1800
+
+# Checkouts kept per pool class for the wait percentiles
+POOL_WAIT_WINDOW = 1000
+
+# session.info key: READ sends the session's queries to read_engine (see RoutingSession)
+ROUTE_KEY = "db_route"
+READ = "read"
+WRITE = "write"
+
+def database_url(read_only=False):
+    """URL of the app's database: DATABASE_URL, or the SQLite file next to this module
+
+    Args:
+        read_only: URL for read-only connections: DATABASE_READ_URL (a
+            replica) if set, else the same database
+
+    Returns:
+        Database URL
+    """
+    url = (read_only and os.environ.get('DATABASE_READ_URL')) or os.environ.get('DATABASE_URL') or f'sqlite:///{db_path}'
+    # Hosting providers still hand out the scheme SQLAlchemy dropped
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def _sqlite_pragmas():
+    return [
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA busy_timeout={int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', DEFAULT_BUSY_TIMEOUT_MS))}",
+        f"PRAGMA mmap_size={int(os.environ.get('SQLITE_MMAP_SIZE', DEFAULT_MMAP_SIZE))}",
+        # Negative: size in KiB instead of pages
+        f"PRAGMA cache_size=-{int(os.environ.get('SQLITE_CACHE_SIZE_KB', DEFAULT_CACHE_SIZE_KB))}",
+    ]
+
+class PoolWaitStats:
+    """Time threads waited for a pool connection, for one class of pools (read or write)
+
+    The wait includes opening a new connection when none is idle, so a pool
+    that is too small shows up as a growing p95 and, once DB_POOL_TIMEOUT
+    is reached, as timeouts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=POOL_WAIT_WINDOW)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+
+    def record(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.total_wait += seconds
+            self._waits.append(seconds)
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            checkouts, timeouts, total_wait = self.checkouts, self.timeouts, self.total_wait
+        return {
+            "checkouts": checkouts,
+            "timeouts": timeouts,
+            "avg_wait_ms": round(total_wait / checkouts * 1000, 3) if checkouts else None,
+            # Over the last POOL_WAIT_WINDOW checkouts
+            "p95_wait_ms": round(waits[max(0, int(round(len(waits) * 0.95)) - 1)] * 1000, 3) if waits else None,
+            "max_wait_ms": round(waits[-1] * 1000, 3) if waits else None
+        }
+
+# Checkout waits of this process, per pool class
+pool_wait_stats = {WRITE: PoolWaitStats(), READ: PoolWaitStats()}
+
+def _timed_pool(role):
+    """QueuePool class recording its checkout waits in pool_wait_stats[role]"""
+    wait_stats = pool_wait_stats[role]
+
+    # A class rather than a pool event: there is no event before a checkout
+    # starts waiting, and pool.recreate() keeps the class
+    class TimedQueuePool(QueuePool):
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                connection = super().connect()
+            except PoolTimeoutError:
+                wait_stats.record(time.perf_counter() - start, timed_out=True)
+                raise
+            wait_stats.record(time.perf_counter() - start)
+            return connection
+
+    return TimedQueuePool
+
+def create_db_engine(url=None, read_only=False):
+    """Create an engine on the app's database with the settings every process uses
+
+    The routes, services, job workers, seed.py and the migrations all
+    go through this, so they share one database and one configuration.
+
+    SQLite (the default):
+    - WAL journal: readers no longer block the writer or each other, only
+      writers wait for one another
+    - synchronous=NORMAL: safe with WAL, commits skip one fsync
+    - busy_timeout: a writer waits for the lock instead of failing at once
+      with "database is locked"
+    - mmap_size and cache_size: reads are served from memory
+    The pool keeps a few connections open, so their page cache survives
+    between requests; since SQLite has a single writer, more connections
+    would only add waiters on the lock.
+
+    PostgreSQL (DATABASE_URL=postgresql+psycopg2://...): writers no longer
+    queue behind one lock, so the pool is sized for the threads of a worker
+    process (request threads, job workers, the DM outbox dispatcher).
+    Every process has its own pools, one to write and one to read: keep
+    processes x 2 x (DB_POOL_SIZE + DB_MAX_OVERFLOW) below the server's
+    max_connections (half of that with a DATABASE_READ_URL replica). Connections are
+    checked before use and recycled, so a restarted server or a proxy
+    closing idle connections does not fail requests.
+
+    Read-only engines (read_only=True) serve the queries of GET requests
+    from their own pool, so readers never wait for a connection behind the
+    chat turns writing:
+    - SQLite: connections with query_only set, each transaction started
+      with BEGIN so a request reads one WAL snapshot from start to end
+      while writers commit beside it
+    - PostgreSQL: DATABASE_READ_URL (a replica) if set, else the primary;
+      transactions are READ ONLY and REPEATABLE READ, one snapshot each
+    Every pool records how long checkouts waited, per class (read or
+    write), in pool_wait_stats.
+
+    Settings can be overridden with environment variables:
+        DATABASE_URL, DATABASE_READ_URL, SQLITE_BUSY_TIMEOUT_MS,
+        SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE_KB, SQLITE_POOL_SIZE,
+        SQLITE_READ_POOL_SIZE, DB_POOL_SIZE, DB_MAX_OVERFLOW,
+        DB_POOL_TIMEOUT, DB_POOL_RECYCLE
+
+    Args:
+        url: Database URL (default: see database_url)
+        read_only: Create an engine for read-only connections
+
+    Returns:
+        A SQLAlchemy Engine
+    """
+    url = url or database_url(read_only)
+    poolclass = _timed_pool(READ if read_only else WRITE)
+    if make_url(url).get_backend_name() != 'sqlite':
+        options = {}
+        if read_only:
+            options = {'isolation_level': 'REPEATABLE READ', 'execution_options': {'postgresql_readonly': True}}
+        return create_engine(
+            url,
+            poolclass=poolclass,
+            pool_size=int(os.environ.get('DB_POOL_SIZE', DEFAULT_DB_POOL_SIZE)),
+            max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', DEFAULT_DB_MAX_OVERFLOW)),
+            pool_timeout=float(os.environ.get('DB_POOL_TIMEOUT', DEFAULT_DB_POOL_TIMEOUT)),
+            pool_recycle=int(os.environ.get('DB_POOL_RECYCLE', DEFAULT_DB_POOL_RECYCLE)),
+            pool_pre_ping=True,
+            **options
+        )
+
+    if read_only:
+        # Readers do not take the write lock, so more of them do not add waiters
+        pool_size = int(os.environ.get('SQLITE_READ_POOL_SIZE', DEFAULT_READ_POOL_SIZE))
+    else:
+        pool_size = int(os.environ.get('SQLITE_POOL_SIZE', DEFAULT_POOL_SIZE))
+    new_engine = create_engine(
+        url,
+        # Connections are handed between the request, job and dispatcher threads
+        connect_args={'check_same_thread': False},
+        poolclass=poolclass,
+        pool_size=pool_size,
+        max_overflow=pool_size * 2,
+        pool_timeout=30
+    )
+    pragmas = _sqlite_pragmas()
+    if read_only:
+        pragmas.append("PRAGMA query_only=ON")
+
+    @event.listens_for(new_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+        if read_only:
+            # pysqlite only opens a transaction before a write; open it ourselves
+            # so every query of the transaction reads the same snapshot
+            dbapi_connection.isolation_level = None
+
+    if read_only:
+        @event.listens_for(new_engine, "begin")
+        def begin_snapshot(conn):
+            conn.exec_driver_sql("BEGIN")
+
+    return new_engine
+
+class RoutingSession(OrmSession):
+    """Session sending the queries of a read-only session to the read engine
+
+    A session is read-only when info[ROUTE_KEY] is READ: RequestSessions
+    marks the Session of GET requests. Only SELECT statements are sent to
+    the read engine: flushes and anything else (DML, text() statements,
+    a bare session.connection()) go to the writer, and from then on the
+    whole session stays there, so it reads what it wrote.
+    """
+
+    def __init__(self, read_bind=None, **kwargs):
+        super().__init__(**kwargs)
+        self.read_bind = read_bind
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.info.get(ROUTE_KEY) == READ and self.read_bind is not None:
+            if not self._flushing and clause is not None and clause.is_select:
+                return self.read_bind
+            self.info[ROUTE_KEY] = WRITE
+        return super().get_bind(mapper, clause=clause, **kwargs)
+
+# Create database engine
+engine = create_db_engine()
+
+# Create the engine of read-only requests
+read_engine = create_db_engine(read_only=True)
 
 # Create session factory
-session_factory = sessionmaker(bind=engine)
+session_factory = sessionmaker(class_=RoutingSession, bind=engine, read_bind=read_engine)
 
 # Create thread-safe scoped session
 Session = scoped_session(session_factory)
@@ -30,5 +269,33 @@ def session_scope():
     finally:
         session.close()
 
-def init_db():
-    db.create_all()
+@contextmanager
+def unit_of_work():
+    """Provide a private session that commits once at the end, or rolls everything back.
+
+    Unlike session_scope it does not use the thread's scoped Session, so it
+    never commits or closes a session the caller is still working with. It
+    always writes through engine, even during a GET request.
+    """
+    session = session_factory(info={ROUTE_KEY: WRITE})
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def pool_stats():
+    """Connections held by this process's pools, and how long checkouts waited, per class"""
+    result = {}
+    for role, bound in ((WRITE, engine), (READ, read_engine)):
+        pool = bound.pool
+        result[role] = dict(
+            pool_wait_stats[role].stats(),
+            checked_out=pool.checkedout() if hasattr(pool, "checkedout") else None,
+            idle=pool.checkedin() if hasattr(pool, "checkedin") else None,
+            status=pool.status()
+        )
+    return result
@@ -0,0 +1,495 @@
+import json
+import os
+import signal
+import socket
+import time
+import traceback
+import multiprocessing
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, and_
+from sqlalchemy.exc import IntegrityError
+from .db import engine
+from .migrations import ensure_migrated
+from .models import Job
+
+# Seconds a worker may hold a job before it is considered lost and handed out again
+DEFAULT_LEASE_SECONDS = 600
+
+# Seconds an idle worker sleeps between polls of the job table
+DEFAULT_POLL_INTERVAL = 0.5
+
+# Seconds to wait before retrying a failed job (doubled on every attempt)
+DEFAULT_RETRY_DELAY = 5
+
+# Number of finished jobs the latency statistics are computed over
+STATS_WINDOW = 200
+
+# Workers that lose the race for a job look for the next one this many times per poll
+CLAIM_ATTEMPTS = 3
+
+# Days finished (done or failed) jobs are kept before purge() deletes them
+DEFAULT_RETENTION_DAYS = 7
+
+# Seconds between two purges by the worker supervisor
+PURGE_INTERVAL = 3600
+
+# Rows deleted per transaction, so a purge never holds the write lock for long
+PURGE_BATCH_SIZE = 500
+
+jobs_table = Job.__table__
+
+
+def _seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return round((end - start).total_seconds(), 3)
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, int(round(len(values) * percent / 100.0)) - 1)
+    return round(values[index], 3)
+
+
+class JobQueue:
+    """Durable job queue stored in the application database
+
+    Routes enqueue slow generation work (DALL-E renders, quest generation, ...)
+    and answer right away with a job id; worker processes started with
+    `python worker.py` claim the jobs, run the registered task and store the
+    result. Because the queue is a table, queued jobs survive restarts, and a
+    job whose worker died is handed out again once its lease expires.
+
+    Finished jobs are deleted after retention_days by the worker supervisor
+    (see purge), so the table only grows with the jobs in flight.
+
+    Settings can be overridden with environment variables:
+        JOB_LEASE_SECONDS, JOB_POLL_INTERVAL, JOB_RETRY_DELAY,
+        JOB_RETENTION_DAYS
+    """
+
+    def __init__(self, lease_seconds=None, poll_interval=None, retry_delay=None, retention_days=None):
+        self.lease_seconds = lease_seconds or float(os.environ.get("JOB_LEASE_SECONDS", DEFAULT_LEASE_SECONDS))
+        self.poll_interval = poll_interval or float(os.environ.get("JOB_POLL_INTERVAL", DEFAULT_POLL_INTERVAL))
+        self.retry_delay = retry_delay or float(os.environ.get("JOB_RETRY_DELAY", DEFAULT_RETRY_DELAY))
+        self.retention_days = retention_days or float(os.environ.get("JOB_RETENTION_DAYS", DEFAULT_RETENTION_DAYS))
+        self.handlers = {}
+
+    def task(self, kind):
+        """Decorator registering the function that runs jobs of a given kind
+
+        The function receives the job payload as keyword arguments and returns
+        a JSON-serializable result. Raising marks the attempt as failed.
+        """
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def ensure_table(self):
+        """Migrate the database, jobs table included (see app/migrations.py)"""
+        ensure_migrated()
+
+    def enqueue(self, kind, payload=None, max_attempts=3, dedupe_key=None):
+        """Add a job to the queue
+
+        Args:
+            kind: Name of the registered task to run
+            payload: Dictionary of keyword arguments for the task
+            max_attempts: Number of times the job is tried before it fails
+            dedupe_key: Optional key; while a job of the same kind and key is
+                queued or running, that job is returned instead of a new one
+
+        Returns:
+            Id of the new (or already pending) job
+        """
+        self.ensure_table()
+        now = datetime.utcnow()
+
+        try:
+            with engine.begin() as conn:
+                result = conn.execute(
+                    jobs_table.insert().values(
+                        kind=kind,
+                        payload=json.dumps(payload or {}),
+                        status='queued',
+                        attempts=0,
+                        max_attempts=max_attempts,
+                        created_at=now,
+                        run_at=now,
+                        dedupe_key=dedupe_key
+                    )
+                )
+                job_id = result.inserted_primary_key[0]
+        except IntegrityError:
+            if dedupe_key is None:
+                raise
+            # The unique index on pending jobs caught a duplicate: join that job instead
+            existing = self._pending_job_id(kind, dedupe_key)
+            if existing is None:
+                # It finished between the insert and the lookup, queue a fresh one
+                return self.enqueue(kind, payload, max_attempts, dedupe_key)
+            print(f"Job {existing} ({kind}) is already pending for '{dedupe_key}'")
+            return existing
+
+        print(f"Enqueued job {job_id} ({kind})")
+        return job_id
+
+    def _pending_job_id(self, kind, dedupe_key):
+        with engine.connect() as conn:
+            return conn.execute(
+                select(jobs_table.c.id).where(and_(
+                    jobs_table.c.kind == kind,
+                    jobs_table.c.dedupe_key == dedupe_key,
+                    jobs_table.c.status.in_(['queued', 'running'])
+                ))
+            ).scalar()
+
+    def get(self, job_id):
+        """Return a job as a dictionary, or None if it does not exist"""
+        self.ensure_table()
+        with engine.connect() as conn:
+            row = conn.execute(select(jobs_table).where(jobs_table.c.id == job_id)).mappings().first()
+        return self.to_dict(row) if row else None
+
+    def to_dict(self, row):
+        """Public representation of a job row, including its latency"""
+        return {
+            'id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'max_attempts': row['max_attempts'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'created_at': row['created_at'].isoformat() if row['created_at'] else None,
+            'started_at': row['started_at'].isoformat() if row['started_at'] else None,
+            'finished_at': row['finished_at'].isoformat() if row['finished_at'] else None,
+            # Time spent waiting for a worker, and time spent running the last attempt
+            'wait_seconds': _seconds_between(row['created_at'], row['started_at']),
+            'run_seconds': _seconds_between(row['started_at'], row['finished_at'])
+        }
+
+    def claim(self, worker_name):
+        """Atomically take the next runnable job for a worker
+
+        The next queued job is looked up on ix_jobs_status_run_at_id outside
+        any write transaction, so the poll of an idle worker never takes the
+        write lock (on SQLite, the one chat turns need). A single UPDATE ...
+        RETURNING then takes that job only if it is still queued, so two
+        workers can never claim the same one; the worker that loses the race
+        looks again. Jobs still marked running whose lease has expired (their
+        worker crashed or was killed) are put back in the queue first.
+
+        Returns:
+            (id, kind, payload dict) of the claimed job, or None if there is none
+        """
+        self.ensure_table()
+        self._recover_lost()
+
+        for _ in range(CLAIM_ATTEMPTS):
+            now = datetime.utcnow()
+            runnable = and_(jobs_table.c.status == 'queued', jobs_table.c.run_at <= now)
+            with engine.connect() as conn:
+                job_id = conn.execute(
+                    select(jobs_table.c.id)
+                    .where(runnable)
+                    .order_by(jobs_table.c.run_at, jobs_table.c.id)
+                    .limit(1)
+                ).scalar()
+            if job_id is None:
+                return None
+
+            with engine.begin() as conn:
+                row = conn.execute(
+                    update(jobs_table)
+                    .where(and_(jobs_table.c.id == job_id, runnable))
+                    .values(
+                        status='running',
+                        worker=worker_name,
+                        attempts=jobs_table.c.attempts + 1,
+                        started_at=now,
+                        finished_at=None,
+                        lease_expires_at=now + timedelta(seconds=self.lease_seconds)
+                    )
+                    .returning(jobs_table.c.id, jobs_table.c.kind, jobs_table.c.payload)
+                ).first()
+            if row is not None:
+                return row.id, row.kind, json.loads(row.payload)
+        return None
+
+    def _recover_lost(self):
+        """Requeue running jobs whose lease expired, or fail them once out of attempts
+
+        An indexed read finds them first: the write transaction only happens
+        when a worker was actually lost.
+        """
+        now = datetime.utcnow()
+        lost = and_(jobs_table.c.status == 'running', jobs_table.c.lease_expires_at < now)
+        with engine.connect() as conn:
+            if conn.execute(select(jobs_table.c.id).where(lost).limit(1)).first() is None:
+                return
+
+        with engine.begin() as conn:
+            failed = conn.execute(
+                update(jobs_table)
+                .where(and_(lost, jobs_table.c.attempts >= jobs_table.c.max_attempts))
+                .values(status='failed', error='Worker lost the job too many times', finished_at=now,
+                        lease_expires_at=None)
+            ).rowcount
+            requeued = conn.execute(
+                update(jobs_table)
+                .where(lost)
+                .values(status='queued', run_at=now, lease_expires_at=None)
+            ).rowcount
+        print(f"Requeued {requeued} and failed {failed} job(s) whose worker lost its lease")
+
+    def purge(self, retention_days=None):
+        """Delete done and failed jobs finished more than retention_days ago
+
+        Returns:
+            Number of jobs deleted
+        """
+        self.ensure_table()
+        cutoff = datetime.utcnow() - timedelta(days=retention_days or self.retention_days)
+        expired = and_(jobs_table.c.status.in_(['done', 'failed']), jobs_table.c.finished_at < cutoff)
+        deleted = 0
+        while True:
+            with engine.begin() as conn:
+                ids = conn.execute(select(jobs_table.c.id).where(expired).limit(PURGE_BATCH_SIZE)).scalars().all()
+                if ids:
+                    conn.execute(jobs_table.delete().where(jobs_table.c.id.in_(ids)))
+            deleted += len(ids)
+            if len(ids) < PURGE_BATCH_SIZE:
+                break
+        if deleted:
+            print(f"Purged {deleted} finished job(s) older than {retention_days or self.retention_days:g} days")
+        return deleted
+
+    def complete(self, job_id, result):
+        """Store the result of a finished job"""
+        with engine.begin() as conn:
+            conn.execute(
+                update(jobs_table)
+                .where(jobs_table.c.id == job_id)
+                .values(
+                    status='done',
+                    result=json.dumps(result),
+                    error=None,
+                    finished_at=datetime.utcnow(),
+                    lease_expires_at=None
+                )
+            )
+
+    def fail(self, job_id, error):
+        """Record a failed attempt; the job is retried later until it runs out of attempts"""
+        now = datetime.utcnow()
+
+        with engine.begin() as conn:
+            row = conn.execute(
+                select(jobs_table.c.attempts, jobs_table.c.max_attempts).where(jobs_table.c.id == job_id)
+            ).first()
+            if row is None:
+                return
+
+            values = {'error': error, 'finished_at': now, 'lease_expires_at': None}
+            if row.attempts < row.max_attempts:
+                # Back off exponentially so a rate-limited upstream gets room to recover
+                delay = self.retry_delay * (2 ** (row.attempts - 1))
+                values.update(status='queued', run_at=now + timedelta(seconds=delay))
+            else:
+                values.update(status='failed')
+
+            conn.execute(update(jobs_table).where(jobs_table.c.id == job_id).values(**values))
+
+    def requeue_orphans(self):
+        """Put back jobs held by dead workers of this host without waiting for the lease
+
+        Returns:
+            Number of jobs put back in the queue
+        """
+        self.ensure_table()
+        hostname = socket.gethostname()
+        orphans = []
+
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select(jobs_table.c.id, jobs_table.c.worker)
+                .where(jobs_table.c.status == 'running')
+            ).all()
+
+        for row in rows:
+            host, _, pid = (row.worker or '').rpartition(':')
+            if host != hostname or not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                orphans.append(row.id)
+            except PermissionError:
+                pass  # The process exists but belongs to someone else
+
+        if orphans:
+            with engine.begin() as conn:
+                conn.execute(
+                    update(jobs_table)
+                    .where(and_(jobs_table.c.id.in_(orphans), jobs_table.c.status == 'running'))
+                    .values(status='queued', run_at=datetime.utcnow(), lease_expires_at=None)
+                )
+            print(f"Requeued {len(orphans)} job(s) left running by dead workers")
+
+        return len(orphans)
+
+    def run_next(self, worker_name):
+        """Claim and run one job
+
+        Returns:
+            True if a job was run, False if the queue was empty
+        """
+        claimed = self.claim(worker_name)
+        if claimed is None:
+            return False
+
+        job_id, kind, payload = claimed
+        handler = self.handlers.get(kind)
+        if handler is None:
+            self.fail(job_id, f"No task registered for job kind '{kind}'")
+            return True
+
+        print(f"[{worker_name}] Running job {job_id} ({kind})")
+        start = time.perf_counter()
+        try:
+            result = handler(**payload)
+        except Exception as e:
+            print(f"[{worker_name}] Job {job_id} failed: {str(e)}")
+            traceback.print_exc()
+            self.fail(job_id, str(e))
+        else:
+            self.complete(job_id, result)
+            print(f"[{worker_name}] Job {job_id} done in {time.perf_counter() - start:.2f}s")
+        return True
+
+    def stats(self):
+        """Queue depth per status and kind, plus latency of recently finished jobs"""
+        self.ensure_table()
+        now = datetime.utcnow()
+
+        with engine.connect() as conn:
+            pending = conn.execute(
+                select(jobs_table.c.kind, jobs_table.c.status, jobs_table.c.created_at)
+                .where(jobs_table.c.status.in_(['queued', 'running']))
+            ).all()
+            finished = conn.execute(
+                select(jobs_table.c.status, jobs_table.c.created_at, jobs_table.c.started_at, jobs_table.c.finished_at)
+                .where(jobs_table.c.status.in_(['done', 'failed']))
+                .order_by(jobs_table.c.finished_at.desc())
+                .limit(STATS_WINDOW)
+            ).all()
+
+        depth = {'queued': 0, 'running': 0}
+        by_kind = {}
+        oldest_queued = None
+        for row in pending:
+            depth[row.status] += 1
+            counts = by_kind.setdefault(row.kind, {'queued': 0, 'running': 0})
+            counts[row.status] += 1
+            if row.status == 'queued' and (oldest_queued is None or row.created_at < oldest_queued):
+                oldest_queued = row.created_at
+
+        wait_times = [_seconds_between(r.created_at, r.started_at) for r in finished if r.started_at]
+        run_times = [_seconds_between(r.started_at, r.finished_at) for r in finished if r.started_at and r.finished_at]
+
+        return {
+            'depth': depth,
+            'by_kind': by_kind,
+            'oldest_queued_seconds': _seconds_between(oldest_queued, now),
+            'recent': {
+                'jobs': len(finished),
+                'failed': sum(1 for r in finished if r.status == 'failed'),
+                'wait_seconds_avg': round(sum(wait_times) / len(wait_times), 3) if wait_times else None,
+                'wait_seconds_p95': _percentile(wait_times, 95),
+                'run_seconds_avg': round(sum(run_times) / len(run_times), 3) if run_times else None,
+                'run_seconds_p95': _percentile(run_times, 95)
+            }
+        }
+
+
+def run_worker(name=None):
+    """Worker process loop: run jobs until SIGTERM/SIGINT, finishing the current job first"""
+    # A forked worker must not reuse the database connections of its parent
+    engine.dispose(close=False)
+
+    name = name or f"{socket.gethostname()}:{os.getpid()}"
+    stopping = []
+
+    def request_stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    print(f"[{name}] Worker started with tasks: {', '.join(sorted(job_queue.handlers))}")
+    while not stopping:
+        try:
+            ran = job_queue.run_next(name)
+        except Exception as e:
+            # Database busy or unavailable: wait and poll again
+            print(f"[{name}] Error polling job queue: {str(e)}")
+            ran = False
+        if not ran:
+            time.sleep(job_queue.poll_interval)
+    print(f"[{name}] Worker stopped")
+
+
+def start_workers(count):
+    """Start a pool of worker processes and keep it running until interrupted
+
+    Workers that exit unexpectedly are replaced. On SIGTERM/SIGINT every
+    worker is asked to stop after its current job.
+    """
+    job_queue.ensure_table()
+    job_queue.requeue_orphans()
+
+    stopping = []
+
+    def request_stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    def spawn():
+        process = multiprocessing.Process(target=run_worker)
+        process.start()
+        return process
+
+    workers = [spawn() for _ in range(count)]
+    print(f"Started {count} job worker(s)")
+
+    next_purge = time.monotonic()
+    while not stopping:
+        time.sleep(1)
+        if time.monotonic() >= next_purge:
+            next_purge = time.monotonic() + PURGE_INTERVAL
+            try:
+                job_queue.purge()
+            except Exception as e:
+                print(f"Error purging finished jobs: {str(e)}")
+        for index, process in enumerate(workers):
+            if not process.is_alive() and not stopping:
+                print(f"Worker {process.pid} exited with code {process.exitcode}, restarting it")
+                job_queue.requeue_orphans()
+                workers[index] = spawn()
+
+    print("Stopping job workers...")
+    for process in workers:
+        if process.is_alive():
+            process.terminate()  # SIGTERM: the worker finishes its current job
+    for process in workers:
+        process.join()
+
+
+# Initialize queue
+job_queue = JobQueue()
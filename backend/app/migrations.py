@@ -0,0 +1,373 @@
+"""
+Versioned schema migrations.
+
+Each migration has a version, a name and an upgrade(conn) function run in
+one transaction together with the row recording it in schema_migrations,
+so a migration is either fully applied and recorded or not at all. The
+first one creates the tables that do not exist yet from the models, so a
+new database starts from the current schema and every later migration
+must be safe on a database that already has its change (check for a
+column before adding it, create indexes with checkfirst).
+
+Migrations only add (tables, columns, indexes); nothing here drops data.
+They run when the app and the job workers start, and on first use of a
+service that needs them (ensure_migrated). Several processes starting at
+once are fine: the first to record a version applies it, the others wait
+for it and skip it.
+
+Usage (from the backend directory):
+    python -m app.migrations            apply the pending migrations
+    python -m app.migrations --status   list the migrations and whether they are applied
+    python -m app.migrations --explain  check the query plans of the hot queries
+"""
+
+import argparse
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import select, insert, inspect, text, func, literal, or_
+from sqlalchemy.exc import IntegrityError, OperationalError, DBAPIError
+from .db import engine
+from .models import (Base, SchemaMigration, Item, Inventory, Enemy, Move, NPC, Quest, ChatMessage,
+                     DmOutboxEntry, Job, class_moves, enemy_moves)
+from .utils import name_key
+
+# Seconds a process waits for another one applying the same migration
+LOCK_TIMEOUT = 300
+
+# FTS5 side table over items.name_key; the trigram tokenizer (SQLite 3.34+)
+# answers substring queries from the index (see ItemIndex.find_similar)
+FTS_TABLE = "items_name_fts"
+
+FTS_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"name_key, content='items', content_rowid='id', tokenize='trigram')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON items BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, name_key) VALUES (new.id, new.name_key); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON items BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name_key) VALUES ('delete', old.id, old.name_key); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF name_key ON items BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name_key) VALUES ('delete', old.id, old.name_key); "
+    f"INSERT INTO {FTS_TABLE}(rowid, name_key) VALUES (new.id, new.name_key); END",
+]
+
+# PostgreSQL: a pg_trgm GIN index answers the LIKE '%name%' lookups without a scan
+TRIGRAM_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_items_name_key_trgm ON items USING gin (name_key gin_trgm_ops)",
+]
+
+Migration = namedtuple("Migration", "version name upgrade")
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    """Register an upgrade(conn) function as a migration; versions must only grow"""
+    def register(upgrade):
+        assert not MIGRATIONS or version > MIGRATIONS[-1].version, "migration versions must increase"
+        MIGRATIONS.append(Migration(version, name, upgrade))
+        return upgrade
+    return register
+
+
+def _columns(conn, table):
+    return [column["name"] for column in inspect(conn).get_columns(table.name)]
+
+
+def _create_indexes(conn, table):
+    for index in table.indexes:
+        index.create(conn, checkfirst=True)
+
+
+@migration(1, "create missing tables")
+def create_tables(conn):
+    # Tables added to the models after a database was created (npcs, jobs, dm_outbox...)
+    Base.metadata.create_all(conn)
+
+
+@migration(2, "jobs.dedupe_key")
+def add_job_dedupe_key(conn):
+    if "dedupe_key" not in _columns(conn, Job.__table__):
+        conn.execute(text("ALTER TABLE jobs ADD COLUMN dedupe_key VARCHAR(200)"))
+    _create_indexes(conn, Job.__table__)
+
+
+@migration(3, "name_key on items, enemies, moves and npcs")
+def add_name_keys(conn):
+    for model in (Item, Enemy, Move, NPC):
+        table = model.__table__
+        if "name_key" not in _columns(conn, table):
+            print(f"Adding {table.name}.name_key")
+            conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN name_key VARCHAR"))
+
+        # Rows written without the ORM, or before the column existed
+        rows = conn.execute(text(f"SELECT id, name FROM {table.name} WHERE name_key IS NULL")).all()
+        if rows:
+            conn.execute(
+                text(f"UPDATE {table.name} SET name_key = :key WHERE id = :id"),
+                [{"id": row.id, "key": name_key(row.name)} for row in rows]
+            )
+            print(f"Set name_key on {len(rows)} rows of {table.name}")
+        _create_indexes(conn, table)
+
+
+@migration(4, "item name search index")
+def add_item_name_search(conn):
+    # Optional: without it similar item lookups scan items, so a database
+    # that cannot build it (no FTS5 or pg_trgm) is still migrated
+    statements = {"sqlite": FTS_DDL, "postgresql": TRIGRAM_DDL}.get(conn.dialect.name, [])
+    try:
+        with conn.begin_nested():
+            for statement in statements:
+                conn.execute(text(statement))
+            if conn.dialect.name == "sqlite":
+                conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+                print(f"Built {FTS_TABLE}")
+    except DBAPIError as e:
+        print(f"Item name search index unavailable, similar item lookups will scan items: {str(e)}")
+
+
+@migration(5, "indexes for the hot query paths")
+def add_hot_query_indexes(conn):
+    for table in (ChatMessage.__table__, Inventory.__table__, Quest.__table__, class_moves, enemy_moves,
+                  DmOutboxEntry.__table__):
+        _create_indexes(conn, table)
+    # Covered by ix_inventories_character_id_item_id
+    conn.execute(text("DROP INDEX IF EXISTS ix_inventories_character_id"))
+
+
+@migration(6, "job queue and DM outbox indexes")
+def add_queue_indexes(conn):
+    # Idle job workers poll every JOB_POLL_INTERVAL; without these each poll scans jobs
+    for table in (Job.__table__, DmOutboxEntry.__table__):
+        _create_indexes(conn, table)
+
+
+class _AlreadyApplied(Exception):
+    pass
+
+
+def applied_versions(bind=None):
+    """Versions recorded in schema_migrations"""
+    bind = bind or engine
+    SchemaMigration.__table__.create(bind, checkfirst=True)
+    with bind.connect() as conn:
+        return set(conn.execute(select(SchemaMigration.version)).scalars())
+
+
+def migrate(bind=None):
+    """
+    Apply the pending migrations, oldest first
+
+    Args:
+        bind: Engine to migrate (default: the app's engine)
+
+    Returns:
+        Versions applied by this call
+    """
+    bind = bind or engine
+    applied = applied_versions(bind)
+    done = []
+    for pending in MIGRATIONS:
+        if pending.version in applied:
+            continue
+        if _apply(bind, pending):
+            done.append(pending.version)
+            print(f"Applied migration {pending.version} ({pending.name})")
+    return done
+
+
+def _apply(bind, pending):
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while True:
+        try:
+            with bind.begin() as conn:
+                # Recording the version first takes the write lock (SQLite) or the
+                # row lock (PostgreSQL): a process migrating at the same time waits
+                # here until this transaction ends, then finds the version taken
+                try:
+                    conn.execute(insert(SchemaMigration).values(
+                        version=pending.version, name=pending.name, applied_at=datetime.utcnow()
+                    ))
+                except IntegrityError:
+                    raise _AlreadyApplied()
+                pending.upgrade(conn)
+            return True
+        except _AlreadyApplied:
+            return False
+        except OperationalError as e:
+            # SQLite busy timeout: another process is still applying a migration
+            if "locked" not in str(e) or time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+_migrated = set()
+_lock = threading.Lock()
+
+
+def ensure_migrated(bind=None):
+    """Migrate an engine once per process, for services used before create_app runs"""
+    bind = bind or engine
+    if id(bind) in _migrated:
+        return
+    with _lock:
+        if id(bind) not in _migrated:
+            migrate(bind)
+            _migrated.add(id(bind))
+
+
+# Hot queries of routes.py and the services, with the index each should use
+HotQuery = namedtuple("HotQuery", "name statement index")
+
+
+def hot_queries():
+    character_id = 1
+    return [
+        HotQuery(
+            "chat window (ChatContextBuilder._split_history)",
+            select(ChatMessage.id).where(ChatMessage.character_id == character_id)
+            .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc()).limit(50),
+            "ix_chat_messages_character_id_timestamp"
+        ),
+        HotQuery(
+            "chat history (CharacterChatHistory)",
+            select(ChatMessage.id).where(ChatMessage.character_id == character_id).order_by(ChatMessage.timestamp),
+            "ix_chat_messages_character_id_timestamp"
+        ),
+        HotQuery(
+            "character inventory (CharacterInventory)",
+            select(Inventory.id).where(Inventory.character_id == character_id),
+            "ix_inventories_character_id_item_id"
+        ),
+        HotQuery(
+            "owned item (EquipItem, DropItem)",
+            select(Inventory.id).where(Inventory.character_id == character_id, Inventory.item_id == 1),
+            "ix_inventories_character_id_item_id"
+        ),
+        HotQuery(
+            "owned similar item (ItemIndex.find_owned)",
+            select(Item.id).join(Inventory, Inventory.item_id == Item.id)
+            .where(Inventory.character_id == character_id, or_(
+                Item.name_key.contains("rope", autoescape=True), literal("rope").contains(Item.name_key)
+            )).order_by(Inventory.id).limit(1),
+            "ix_inventories_character_id_item_id"
+        ),
+        HotQuery(
+            "item by name (ItemIndex.find_similar, render_item_image)",
+            select(Item.id).where(Item.name_key == "jade amulet").order_by(Item.id).limit(1),
+            "ix_items_name_key"
+        ),
+        HotQuery(
+            "character quests (CharacterQuests)",
+            select(Quest.id).where(Quest.character_id == character_id),
+            "ix_quests_character_id"
+        ),
+        HotQuery(
+            "class moves (ClassMoves)",
+            select(Move.id).join(class_moves, class_moves.c.move_id == Move.id)
+            .where(class_moves.c.class_id == 1),
+            "ix_class_moves_class_id_move_id"
+        ),
+        HotQuery(
+            "enemy moves (EnemyMoves, EntityRegistry._link_moves)",
+            select(Move.id).join(enemy_moves, enemy_moves.c.move_id == Move.id)
+            .where(enemy_moves.c.enemy_id == 1),
+            "ix_enemy_moves_enemy_id_move_id"
+        ),
+        HotQuery(
+            "entities by name (EntityRegistry._resolve)",
+            select(Enemy.name_key, func.min(Enemy.id)).where(Enemy.name_key.in_(["cultist", "nahual"]))
+            .group_by(Enemy.name_key),
+            "ix_enemies_name_key"
+        ),
+        HotQuery(
+            "next job (JobQueue.claim)",
+            select(Job.id).where(Job.status == "queued", Job.run_at <= datetime(2000, 1, 1))
+            .order_by(Job.run_at, Job.id).limit(1),
+            "ix_jobs_status_run_at_id"
+        ),
+        HotQuery(
+            "lost jobs (JobQueue._recover_lost)",
+            select(Job.id).where(Job.status == "running", Job.lease_expires_at < datetime(2000, 1, 1)).limit(1),
+            "ix_jobs_status_lease_expires_at"
+        ),
+        HotQuery(
+            "finished jobs to purge (JobQueue.purge)",
+            select(Job.id).where(Job.status.in_(["done", "failed"]), Job.finished_at < datetime(2000, 1, 1))
+            .limit(500),
+            "ix_jobs_status_finished_at"
+        ),
+        HotQuery(
+            "applied DM outbox entries to purge (DmOutbox.purge)",
+            select(DmOutboxEntry.id).where(DmOutboxEntry.status == "done", DmOutboxEntry.applied_at < datetime(2000, 1, 1))
+            .limit(500),
+            "ix_dm_outbox_done_applied_at"
+        ),
+        HotQuery(
+            "next DM outbox entry (DmOutbox.dispatch_next)",
+            select(func.min(DmOutboxEntry.id)).where(DmOutboxEntry.status == "pending")
+            .group_by(DmOutboxEntry.character_id),
+            "ix_dm_outbox_status_character"
+        ),
+    ]
+
+
+def explain(bind=None):
+    """
+    Check that each hot query uses its index
+
+    SQLite plans come from EXPLAIN QUERY PLAN. PostgreSQL prefers sequential
+    scans on small tables, so its plans are taken with sequential scans
+    disabled: the check is whether the index can be used, not whether the
+    planner picks it on this data.
+
+    Returns:
+        List of (HotQuery, plan lines, ok)
+    """
+    bind = bind or engine
+    results = []
+    with bind.connect() as conn:
+        for query in hot_queries():
+            sql = str(query.statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True}))
+            if conn.dialect.name == "sqlite":
+                plan = [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+            else:
+                with conn.begin():
+                    conn.execute(text("SET LOCAL enable_seqscan = off"))
+                    plan = [row[0] for row in conn.execute(text(f"EXPLAIN {sql}"))]
+            results.append((query, plan, any(query.index in line for line in plan)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--status", action="store_true", help="list the migrations and exit")
+    parser.add_argument("--explain", action="store_true", help="check the hot query plans and exit")
+    args = parser.parse_args()
+
+    if args.status:
+        applied = applied_versions()
+        for known in MIGRATIONS:
+            print(f"{known.version:>4} {'applied' if known.version in applied else 'pending':<8} {known.name}")
+        return 0
+
+    if args.explain:
+        failed = 0
+        for query, plan, ok in explain():
+            failed += not ok
+            print(f"{'ok  ' if ok else 'SCAN'} {query.name} (expects {query.index})")
+            for line in plan:
+                print(f"       {line}")
+        return 1 if failed else 0
+
+    done = migrate()
+    print(f"Applied {len(done)} migration(s), database is at version {max(applied_versions(), default=0)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
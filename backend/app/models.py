@@ -1,25 +1,41 @@
 from flask import Flask
 from sqlalchemy_serializer import SerializerMixin
-from sqlalchemy import Column, Integer, Float, String, Boolean, ForeignKey, Table, JSON, Text, DateTime
+from sqlalchemy import Column, Integer, Float, String, Boolean, ForeignKey, Table, JSON, Text, DateTime, Index, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, validates
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from .utils import name_key
 
 
 
 Base = declarative_base()
 
+
+class NameKeyMixin:
+    """Indexed normalized name, kept in sync with name, used to find entities by name"""
+
+    name_key = Column(String, index=True)
+
+    @validates('name')
+    def _set_name_key(self, key, name):
+        self.name_key = name_key(name)
+        return name
+
+
 class_moves = Table(
     'class_moves', Base.metadata,
     Column('class_id', Integer, ForeignKey('classes.id')),
-    Column('move_id', Integer, ForeignKey('moves.id'))
+    Column('move_id', Integer, ForeignKey('moves.id')),
+    Index('ix_class_moves_class_id_move_id', 'class_id', 'move_id')
 )
 
 enemy_moves = Table(
     'enemy_moves', Base.metadata,
     Column('enemy_id', Integer, ForeignKey('enemies.id')),
-    Column('move_id', Integer, ForeignKey('moves.id'))
+    Column('move_id', Integer, ForeignKey('moves.id')),
+    Index('ix_enemy_moves_enemy_id_move_id', 'enemy_id', 'move_id')
 )
 
 
@@ -93,7 +109,7 @@ class Class_(Base):
     moves = relationship("Move", secondary="class_moves", backref="classes")
 
 
-class Item(Base):
+class Item(NameKeyMixin, Base):
 
     __tablename__="items"
 
@@ -129,8 +145,12 @@ class Inventory(Base):
     character_id = Column(Integer, ForeignKey('characters.id'))
     character = relationship("Character", backref="inventories")
 
+    __table_args__ = (
+        Index('ix_inventories_character_id_item_id', 'character_id', 'item_id'),
+    )
 
-class Enemy(Base):
+
+class Enemy(NameKeyMixin, Base):
 
     __tablename__="enemies"
 
@@ -154,7 +174,7 @@ class Enemy(Base):
     moves = relationship("Move", secondary="enemy_moves", backref="enemies")
 
 
-class Move(Base):
+class Move(NameKeyMixin, Base):
     __tablename__ = "moves"
 
     id = Column(Integer, primary_key=True)
@@ -173,10 +193,10 @@ class Map(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     description = Column(String)
-    map_data = Column(JSON)  # Changed from JSONB to JSON
+    map_data = Column(JSON().with_variant(JSONB(), 'postgresql'))
     image_url = Column(String)
     ai_generated = Column(Boolean, default=True)
-    created_at = Column(String, default=datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
 
 class Quest(Base):
@@ -188,13 +208,28 @@ class Quest(Base):
     completed = Column(Boolean, default=False)
     reward_money = Column(Integer, default=0)
     reward_item_id = Column(Integer, ForeignKey('items.id'), nullable=True)
-    character_id = Column(Integer, ForeignKey('characters.id'), nullable=False)
+    character_id = Column(Integer, ForeignKey('characters.id'), nullable=False, index=True)
     
     # Relationships
     character = relationship("Character", back_populates="quests")
     reward_item = relationship("Item")
 
 
+class PooledQuest(Base):
+    __tablename__ = 'quest_pool'
+
+    id = Column(Integer, primary_key=True)
+    difficulty = Column(String(20), nullable=False)  # easy, medium, hard
+    quest_type = Column(String(20), nullable=False)  # combat, exploration, puzzle, random
+    level_band = Column(Integer, nullable=False)  # character levels grouped, see QuestPool.level_band
+    quest_data = Column(Text, nullable=False)  # generated quest JSON, bound to a character when taken
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_quest_pool_key', 'difficulty', 'quest_type', 'level_band'),
+    )
+
+
 class ChatMessage(Base):
     __tablename__ = 'chat_messages'
     
@@ -207,8 +242,25 @@ class ChatMessage(Base):
     # Relationships
     character = relationship("Character")
 
+    __table_args__ = (
+        Index('ix_chat_messages_character_id_timestamp', 'character_id', 'timestamp'),
+    )
+
+
+class ChatSummary(Base):
+    __tablename__ = 'chat_summaries'
+
+    id = Column(Integer, primary_key=True)
+    character_id = Column(Integer, ForeignKey('characters.id'), nullable=False, unique=True)
+    summary = Column(Text, nullable=False, default='')  # rolling summary of the older turns
+    last_message_id = Column(Integer, default=0)  # newest chat message folded into the summary
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-class NPC(Base):
+    # Relationships
+    character = relationship("Character")
+
+
+class NPC(NameKeyMixin, Base):
     __tablename__ = 'npcs'
     
     id = Column(Integer, primary_key=True)
@@ -219,3 +271,71 @@ class NPC(Base):
     affiliation = Column(String(100))  # e.g., 'Obsidian Circle', 'Resistance', 'Independent'
     created_at = Column(DateTime, default=datetime.utcnow)
 
+
+
+class DmOutboxEntry(Base):
+    __tablename__ = 'dm_outbox'
+
+    id = Column(Integer, primary_key=True)
+    character_id = Column(Integer, ForeignKey('characters.id'), nullable=False)
+    message_id = Column(Integer, ForeignKey('chat_messages.id'))  # AI message the effects came with
+    message = relationship("ChatMessage")
+    effects = Column(Text, nullable=False)  # JSON list of the reply's effects, in reply order
+    status = Column(String(20), nullable=False, default='pending')  # pending, done, failed
+    attempts = Column(Integer, default=0)
+    notes = Column(Text)  # JSON list of the notes added to the message once applied
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    applied_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_dm_outbox_status_character', 'status', 'character_id', 'id'),
+        # DmOutbox.purge
+        Index(
+            'ix_dm_outbox_done_applied_at', 'status', 'applied_at',
+            sqlite_where=text("status = 'done'"),
+            postgresql_where=text("status = 'done'")
+        ),
+    )
+
+
+class Job(Base):
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(50), nullable=False)  # e.g., 'generate_avatar', 'generate_quest'
+    payload = Column(Text, nullable=False)  # JSON arguments for the task
+    status = Column(String(20), nullable=False, default='queued')  # queued, running, done, failed
+    result = Column(Text)  # JSON result once done
+    error = Column(Text)
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=3)
+    worker = Column(String(100))  # worker that claimed the job last
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    lease_expires_at = Column(DateTime)  # running jobs past their lease are picked up again
+    run_at = Column(DateTime, default=datetime.utcnow)  # not picked up before this time (retry backoff)
+    dedupe_key = Column(String(200))  # at most one queued/running job per kind and key
+
+    __table_args__ = (
+        Index(
+            'ix_jobs_active_dedupe', 'kind', 'dedupe_key',
+            unique=True,
+            sqlite_where=text("status IN ('queued', 'running')"),
+            postgresql_where=text("status IN ('queued', 'running')")
+        ),
+        # JobQueue.claim: next queued job by run_at, and running jobs whose lease expired
+        Index('ix_jobs_status_run_at_id', 'status', 'run_at', 'id'),
+        Index('ix_jobs_status_lease_expires_at', 'status', 'lease_expires_at'),
+        # JobQueue.purge and the latency stats of finished jobs
+        Index('ix_jobs_status_finished_at', 'status', 'finished_at'),
+    )
+
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True, autoincrement=False)  # see MIGRATIONS in app/migrations.py
+    name = Column(String(100), nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow)
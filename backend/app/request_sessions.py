@@ -0,0 +1,150 @@
+import os
+import threading
+import weakref
+from flask import g, request, has_app_context, has_request_context
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+from . import db
+from .db import Session, session_factory, ROUTE_KEY, READ
+
+# Leaks kept for the stats endpoint
+MAX_RECENT_LEAKS = 20
+
+# g attribute holding what the current request opened
+TRACKING_KEY = "_db_tracking"
+
+# Requests whose Session reads from read_engine
+READ_METHODS = ("GET", "HEAD")
+
+
+class RequestSessions:
+    """Request-scoped Session lifecycle with read routing and a leak detector
+
+    Routes get their session from the thread-local Session registry. The
+    Session of a GET request is marked read-only, so its queries run on
+    read_engine (a WAL snapshot on SQLite, a replica on PostgreSQL) while
+    POST/PUT/DELETE requests, job workers and unit_of_work keep the write
+    pool to themselves (see RoutingSession). Once
+    the app context of a request is torn down, its Session is removed:
+    closed (its transaction rolled back if nothing committed it) and its
+    connection returned to the pool, so the next request on that thread
+    starts with an empty identity map instead of the previous request's
+    objects.
+
+    The detector then looks for what the request left behind: sessions
+    made by session_factory (or unit_of_work) that are still in a
+    transaction, and pool connections checked out during the request that
+    were never checked in. Each leak is printed with the request that
+    caused it and counted in stats(). Work done outside a request (job
+    workers, the DM outbox dispatcher) is not tracked.
+
+    Settings can be overridden with environment variables:
+        SESSION_LEAK_CHECK (on or off), DB_READ_ROUTING (on or off)
+    """
+
+    def __init__(self, enabled=None, route_reads=None):
+        if enabled is None:
+            enabled = os.environ.get("SESSION_LEAK_CHECK", "on").lower() != "off"
+        if route_reads is None:
+            route_reads = os.environ.get("DB_READ_ROUTING", "on").lower() != "off"
+        self.enabled = enabled
+        self.route_reads = route_reads
+        self._lock = threading.Lock()
+        self._listening = False
+        self.requests_checked = 0
+        self.leaked_sessions = 0
+        self.leaked_connections = 0
+        self.recent_leaks = []
+
+    def init_app(self, app):
+        """Route GET requests to the read engine, remove the request's Session at teardown
+        and, if enabled, start tracking leaks"""
+        if self.route_reads:
+            app.before_request(self.route)
+        app.teardown_appcontext(self.teardown)
+        if self.enabled and not self._listening:
+            event.listen(session_factory, "after_begin", self._session_began)
+            event.listen(Pool, "checkout", self._checked_out)
+            event.listen(Pool, "checkin", self._checked_in)
+            self._listening = True
+
+    def route(self):
+        if request.method in READ_METHODS:
+            session = Session()
+            # A session left open outside a request keeps the engine it started on
+            if not session.in_transaction():
+                session.info[ROUTE_KEY] = READ
+
+    def _tracking(self):
+        tracking = g.get(TRACKING_KEY)
+        if tracking is None:
+            tracking = {
+                "request": f"{request.method} {request.path}" if has_request_context() else "app context",
+                "sessions": weakref.WeakSet(),
+                "connections": set()
+            }
+            setattr(g, TRACKING_KEY, tracking)
+        return tracking
+
+    def _session_began(self, session, transaction, connection):
+        if has_app_context():
+            self._tracking()["sessions"].add(session)
+
+    def _checked_out(self, dbapi_connection, connection_record, connection_proxy):
+        if has_app_context():
+            connections = self._tracking()["connections"]
+            connections.add(connection_record)
+            # Checkin can happen outside the app context (another thread, garbage collection)
+            connection_record.info[TRACKING_KEY] = connections
+
+    def _checked_in(self, dbapi_connection, connection_record):
+        connections = connection_record.info.pop(TRACKING_KEY, None)
+        if connections is not None:
+            connections.discard(connection_record)
+
+    def teardown(self, exception=None):
+        Session.remove()
+        if not self.enabled:
+            return
+
+        tracking = g.pop(TRACKING_KEY, None)
+        with self._lock:
+            self.requests_checked += 1
+        if tracking is None:
+            return
+
+        sessions = [session for session in tracking["sessions"] if session.in_transaction()]
+        connections = len(tracking["connections"])
+        if not sessions and not connections:
+            return
+
+        print(f"{tracking['request']} left {len(sessions)} session(s) in a transaction and "
+              f"{connections} connection(s) checked out; close sessions from session_factory "
+              f"or use unit_of_work")
+        with self._lock:
+            self.leaked_sessions += len(sessions)
+            self.leaked_connections += connections
+            self.recent_leaks.append({
+                "request": tracking["request"],
+                "sessions": len(sessions),
+                "connections": connections
+            })
+            del self.recent_leaks[:-MAX_RECENT_LEAKS]
+
+    def stats(self):
+        """Leak counters of this worker, and its read and write pools with their checkout waits"""
+        with self._lock:
+            result = {
+                "enabled": self.enabled,
+                "read_routing": self.route_reads,
+                "requests_checked": self.requests_checked,
+                "leaked_sessions": self.leaked_sessions,
+                "leaked_connections": self.leaked_connections,
+                "recent_leaks": list(self.recent_leaks)
+            }
+        result["pools"] = db.pool_stats()
+        return result
+
+
+# Initialize request session lifecycle
+request_sessions = RequestSessions()
@@ -3,7 +3,9 @@ from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 from typing import Optional, List
 from datetime import datetime, timedelta
-from flask import request, abort
+import json
+import time
+from flask import request, abort, Response, stream_with_context
 from flask_restful import Resource, reqparse
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
 from .models import User, Character, Class_, Item, Inventory, Enemy, Move, Quest, ChatMessage
@@ -12,6 +14,19 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from marshmallow import Schema, fields
 from sqlalchemy.orm.exc import NoResultFound
 from .services.openai_service import openai_service
+from .services.async_openai_service import async_openai_service
+from .services.async_runner import async_runner
+from .services.chat_context import chat_context_builder
+from .services.prompt_builder import prompt_builder
+from .services.rate_governor import rate_governor, STANDARD
+from .services.model_router import model_router
+from .services.quest_pool import quest_pool
+from .services.character_stats import character_stats
+from .services.structured_output import reply_stats
+from .services.dm_outbox import dm_outbox
+from .services.bulk_writer import bulk_writer
+from .jobs import job_queue
+from .request_sessions import request_sessions
 
 router = APIRouter()
 
@@ -146,7 +161,7 @@ class QuestSchema(Schema):
     reward_money = fields.Int()
     reward_item_id = fields.Int()
     character_id = fields.Int(required=True)
-    reward_item = fields.Nested(lambda: ItemSchema(exclude=("reward_quests",)), dump_only=True)
+    reward_item = fields.Nested(ItemSchema, dump_only=True)
 
 class ChatMessageSchema(Schema):
     id = fields.Int(dump_only=True)
@@ -866,6 +881,85 @@ class CharacterQuests(Resource):
         quests = session.query(Quest).filter_by(character_id=character_id).all()
         return quests_schema.dump(quests), 200
 
+# Bulk Resources
+# Create (POST) and update (PUT) of content tables: a JSON array of rows,
+# written in one transaction with a result per row (see BulkWriter).
+# ?atomic=true writes nothing unless every row is valid.
+class BulkResource(Resource):
+    model = None
+    schema = None
+    # Values of the fields a new row leaves out, as in the single-row POST
+    defaults = {}
+
+    @jwt_required()
+    def post(self):
+        return self._write(
+            lambda session, rows, atomic: bulk_writer.create(session, self.model, self.schema, rows, self.defaults, atomic),
+            'created', 201
+        )
+
+    @jwt_required()
+    def put(self):
+        return self._write(
+            lambda session, rows, atomic: bulk_writer.update(session, self.model, self.schema, rows, atomic),
+            'updated', 200
+        )
+
+    def _write(self, write, done, success_code):
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list) or not rows:
+            return {'message': 'Expected a non-empty JSON array of rows'}, 400
+        if len(rows) > bulk_writer.max_rows:
+            return {'message': f'At most {bulk_writer.max_rows} rows per request'}, 413
+        atomic = request.args.get('atomic', '').lower() in ('1', 'true', 'yes')
+
+        session = Session()
+        try:
+            results = write(session, rows, atomic)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"Error in {type(self).__name__}: {str(e)}")
+            return {'message': f'Server error: {str(e)}'}, 500
+
+        written = sum(1 for result in results if result['status'] == done)
+        response = {done: written, 'failed': len(results) - written, 'results': results}
+        if written == len(results):
+            return response, success_code
+        # Multi-Status: some rows were written, the others have their errors
+        return response, 207 if written else 400
+
+class ItemBulk(BulkResource):
+    model = Item
+    schema = item_schema
+    defaults = {
+        'weight': 0, 'lore_description': '', 'image_url': '', 'armor_class': None, 'str': None,
+        'dex': None, 'speed': None, 'wisdom': None, 'intelligence': None, 'constitution': None,
+        'charisma': None, 'initiative': None, 'equippable': False, 'is_equipped': False
+    }
+
+class EnemyBulk(BulkResource):
+    model = Enemy
+    schema = enemy_schema
+    defaults = {
+        'hp': 0, 'mp': 0, 'armor_class': 0, 'str': 0, 'dex': 0, 'speed': 0, 'wisdom': 0,
+        'intelligence': 0, 'constitution': 0, 'charisma': 0, 'initiative': 0
+    }
+
+class MoveBulk(BulkResource):
+    model = Move
+    schema = move_schema
+    defaults = {'damage': 0, 'mana_cost': 0, 'status_effect': None, 'condition': None}
+
+class InventoryBulk(BulkResource):
+    model = Inventory
+    schema = inventory_schema
+
+class QuestBulk(BulkResource):
+    model = Quest
+    schema = quest_schema
+    defaults = {'completed': False, 'reward_money': 0, 'reward_item_id': None}
+
 # Chat Resources
 class ChatMessageResource(Resource):
     @jwt_required()
@@ -925,6 +1019,9 @@ class CharacterChatHistory(Resource):
 
 # Add OpenAI API endpoints
 class ChatCompletion(Resource):
+    def generate_response(self, messages, character, summary=None, session=None):
+        return openai_service.generate_response(messages, character, summary=summary, session=session)
+
     @jwt_required()
     def post(self):
         try:
@@ -939,14 +1036,16 @@ class ChatCompletion(Resource):
                     if not character:
                         return {'message': 'Character not found'}, 404
                 
-                # Get chat history
+                # Get the recent chat history that fits the context, plus the summary of older turns
                 messages = []
+                summary = None
                 if character:
-                    chat_messages = session.query(ChatMessage).filter_by(character_id=character_id).order_by(ChatMessage.timestamp).all()
-                    messages = chat_messages_schema.dump(chat_messages)
+                    context = chat_context_builder.build(session, character_id)
+                    messages = context['messages']
+                    summary = context['summary']
                 
-                # Generate AI response
-                ai_response = openai_service.generate_response(messages, character)
+                # Generate AI response (in outbox mode its effects are queued in this session)
+                ai_response = self.generate_response(messages, character, summary, session=session)
                 
                 # Save AI response to database
                 if character:
@@ -956,9 +1055,10 @@ class ChatCompletion(Resource):
                         character_id=character_id
                     )
                     session.add(new_message)
+                    session.flush()
                     
                     # Return the saved message
-                    return chat_message_schema.dump(new_message), 201
+                    return _with_effects(chat_message_schema.dump(new_message), session, new_message), 201
                 
                 # If no character, just return the response
                 return {'content': ai_response}, 200
@@ -967,7 +1067,167 @@ class ChatCompletion(Resource):
             print(f"Error generating AI response: {str(e)}")
             return {'message': f'Server error: {str(e)}'}, 500
 
+# Prompt assembly time, prefix stability, upstream prompt cache usage and dropped DM effects
+class PromptStats(Resource):
+    @jwt_required()
+    def get(self):
+        return dict(prompt_builder.stats(), dm_output=reply_stats.stats()), 200
+
+# Shared OpenAI rate budget: bucket levels, upstream pauses and calls in flight
+class RateStats(Resource):
+    @jwt_required()
+    def get(self):
+        if not rate_governor.enabled:
+            return {'enabled': False}, 200
+        return {'enabled': True, 'families': rate_governor.stats()}, 200
+
+# Ready quests per pool and how often requests were served from them
+class QuestPoolStats(Resource):
+    @jwt_required()
+    def get(self):
+        return quest_pool.stats(), 200
+
+# Sessions and connections requests left open, and the read and write pools with their checkout waits (this worker only)
+class SessionStats(Resource):
+    @jwt_required()
+    def get(self):
+        return request_sessions.stats(), 200
+
+# Model routes per call type with their rolling latency and error rate (this worker only)
+class ModelStats(Resource):
+    @jwt_required()
+    def get(self):
+        return model_router.stats(), 200
+
+def _with_effects(message_data, session, message):
+    """Add the outbox entry of a saved AI message (outbox mode) to its response"""
+    entry = dm_outbox.attach(session, message)
+    if entry is not None:
+        message_data.update(effects_id=entry.id, effects_status='pending', effects_url=f'/api/dm-effects/{entry.id}')
+    return message_data
+
+# Effects of a DM reply applied after the response (DM_EFFECTS_MODE=outbox)
+class DmEffectsStatus(Resource):
+    @jwt_required()
+    def get(self, effects_id):
+        entry = dm_outbox.get(effects_id)
+        if entry is None:
+            return {'message': 'Effects not found'}, 404
+        return entry, 200
+
+def _sse_event(event, data):
+    """Format a single Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Streaming variant of ChatCompletion using Server-Sent Events
+class ChatCompletionStream(Resource):
+    @jwt_required()
+    def post(self):
+        data = request.get_json() or {}
+        character_id = data.get('character_id')
+
+        # Fail fast before the stream starts so the client gets a normal status code
+        if character_id:
+            session = Session()
+            if not session.query(Character).filter_by(id=character_id).first():
+                return {'message': 'Character not found'}, 404
+
+        def generate():
+            try:
+                with session_scope() as session:
+                    character = None
+                    messages = []
+                    summary = None
+
+                    if character_id:
+                        character = session.query(Character).filter_by(id=character_id).first()
+                        context = chat_context_builder.build(session, character_id)
+                        messages = context['messages']
+                        summary = context['summary']
+
+                    for event in openai_service.stream_response(messages, character, summary=summary, session=session):
+                        if event['type'] == 'token':
+                            yield _sse_event('token', {'content': event['content']})
+                            continue
+
+                        if event['type'] == 'error':
+                            yield _sse_event('error', {'message': event['content']})
+                            return
+
+                        # Stream finished: tag effects are applied, save the final message
+                        if character:
+                            new_message = ChatMessage(
+                                content=event['content'],
+                                is_user=False,
+                                character_id=character_id
+                            )
+                            session.add(new_message)
+                            session.flush()
+                            yield _sse_event('done', _with_effects(chat_message_schema.dump(new_message), session, new_message))
+                        else:
+                            yield _sse_event('done', {'content': event['content']})
+
+            except Exception as e:
+                print(f"Error streaming AI response: {str(e)}")
+                yield _sse_event('error', {'message': f'Server error: {str(e)}'})
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'  # Stop proxies from buffering the stream
+            }
+        )
+
+def _job_accepted(job_id):
+    """Response for work handed to the job queue"""
+    return {'job_id': job_id, 'status': 'queued', 'status_url': f'/api/jobs/{job_id}'}, 202
+
+def save_generated_quest(session, quest_data, character_id):
+    """Store a generated quest (and its reward item) and return the quest response"""
+    # Create item if reward includes an item
+    reward_item_id = None
+    if 'reward_item' in quest_data and quest_data['reward_item']:
+        item_data = quest_data['reward_item']
+        
+        new_item = Item(
+            name=item_data['name'],
+            type=item_data['type'],
+            effect_description=item_data.get('description', ''),
+            weight=item_data.get('weight', 1)
+        )
+        
+        session.add(new_item)
+        session.flush()  # Get ID without committing
+        reward_item_id = new_item.id
+    
+    # Create quest in database
+    new_quest = Quest(
+        title=quest_data['title'],
+        description=quest_data['description'],
+        completed=False,
+        reward_money=quest_data.get('reward_money', 0),
+        reward_item_id=reward_item_id,
+        character_id=character_id
+    )
+    
+    session.add(new_quest)
+    session.commit()
+    
+    # Return the created quest
+    quest_response = quest_schema.dump(new_quest)
+    
+    # Add objectives to response (not stored in database)
+    if 'objectives' in quest_data:
+        quest_response['objectives'] = quest_data['objectives']
+    
+    return quest_response
+
 class GenerateQuest(Resource):
+    def generate_quest(self, character, difficulty, quest_type):
+        return openai_service.generate_quest(character, difficulty, quest_type)
+
     @jwt_required()
     def post(self):
         try:
@@ -985,49 +1245,34 @@ class GenerateQuest(Resource):
             difficulty = data.get('difficulty', 'medium')
             quest_type = data.get('quest_type', 'random')
             
-            # Generate quest
-            quest_data = openai_service.generate_quest(character, difficulty, quest_type)
+            # Hand the generation to a worker if the client asked for it
+            if data.get('background'):
+                job_id = job_queue.enqueue('generate_quest', {
+                    'character_id': character_id,
+                    'difficulty': difficulty,
+                    'quest_type': quest_type
+                })
+                return _job_accepted(job_id)
+            
+            # Take a ready quest from the pool; it leaves the pool in the same commit that binds it
+            pool_key = quest_pool.key(character, difficulty, quest_type)
+            if pool_key and character_id:
+                quest_data = quest_pool.take(session, pool_key)
+                if quest_data:
+                    quest_response = save_generated_quest(session, quest_data, character_id)
+                    quest_pool.schedule_refill(pool_key)
+                    return quest_response, 201
+            
+            # Pool empty (or not pooled): generate quest
+            quest_data = self.generate_quest(character, difficulty, quest_type)
             
             # Check for errors
             if 'error' in quest_data:
                 return {'message': quest_data['error']}, 500
             
-            # Create item if reward includes an item
-            reward_item_id = None
-            if 'reward_item' in quest_data and quest_data['reward_item']:
-                item_data = quest_data['reward_item']
-                
-                new_item = Item(
-                    name=item_data['name'],
-                    type=item_data['type'],
-                    effect_description=item_data.get('description', ''),
-                    weight=item_data.get('weight', 1)
-                )
-                
-                session.add(new_item)
-                session.flush()  # Get ID without committing
-                reward_item_id = new_item.id
-            
-            # Create quest in database
-            new_quest = Quest(
-                title=quest_data['title'],
-                description=quest_data['description'],
-                completed=False,
-                reward_money=quest_data.get('reward_money', 0),
-                reward_item_id=reward_item_id,
-                character_id=character_id
-            )
-            
-            session.add(new_quest)
-            session.commit()
-            
-            # Return the created quest
-            quest_response = quest_schema.dump(new_quest)
-            
-            # Add objectives to response (not stored in database)
-            if 'objectives' in quest_data:
-                quest_response['objectives'] = quest_data['objectives']
-            
+            quest_response = save_generated_quest(session, quest_data, character_id)
+            if pool_key:
+                quest_pool.schedule_refill(pool_key)
             return quest_response, 201
             
         except Exception as e:
@@ -1088,8 +1333,13 @@ class GiveItemToCharacter(Resource):
             print(f"Error giving item to character: {str(e)}")
             return {'message': f'Error: {str(e)}'}, 500
 
-# Generate a character avatar
+# Generate a character avatar. The request thread waits for the OpenAI slot, so it uses
+# the standard priority (see PRIORITY_MAX_WAIT) rather than the minutes the job queue's
+# background calls may wait; the bio and test item routes do the same
 class GenerateCharacterAvatar(Resource):
+    def generate_avatar(self, character_name, character_class, character_description):
+        return openai_service.generate_character_avatar(character_name, character_class, character_description, priority=STANDARD)
+
     @jwt_required()
     def post(self):
         try:
@@ -1103,8 +1353,16 @@ class GenerateCharacterAvatar(Resource):
             if not character_name or not character_class:
                 return {'message': 'Character name and class are required'}, 400
             
+            if data.get('background'):
+                job_id = job_queue.enqueue('generate_avatar', {
+                    'character_name': character_name,
+                    'character_class': character_class,
+                    'character_description': character_description
+                })
+                return _job_accepted(job_id)
+            
             # Generate avatar using OpenAI
-            image_path = openai_service.generate_character_avatar(
+            image_path = self.generate_avatar(
                 character_name, 
                 character_class, 
                 character_description
@@ -1122,6 +1380,9 @@ class GenerateCharacterAvatar(Resource):
 
 # Generate a character bio
 class GenerateCharacterBio(Resource):
+    def generate_bio(self, character_name, character_class):
+        return openai_service.generate_character_bio(character_name, character_class, priority=STANDARD)
+
     @jwt_required()
     def post(self):
         try:
@@ -1134,8 +1395,15 @@ class GenerateCharacterBio(Resource):
             if not character_name or not character_class:
                 return {'message': 'Character name and class are required'}, 400
             
+            if data.get('background'):
+                job_id = job_queue.enqueue('generate_bio', {
+                    'character_name': character_name,
+                    'character_class': character_class
+                })
+                return _job_accepted(job_id)
+            
             # Generate bio using OpenAI
-            bio = openai_service.generate_character_bio(character_name, character_class)
+            bio = self.generate_bio(character_name, character_class)
             
             if not bio:
                 return {'message': 'Failed to generate character bio'}, 500
@@ -1146,6 +1414,86 @@ class GenerateCharacterBio(Resource):
             print(f"Error generating character bio: {str(e)}")
             return {'message': f'Error: {str(e)}'}, 500
 
+# Async variants of the AI routes: the handlers are shared with the routes above,
+# only the OpenAI call is awaited on the process-wide event loop
+class AsyncChatCompletion(ChatCompletion):
+    def generate_response(self, messages, character, summary=None, session=None):
+        return async_runner.run(
+            async_openai_service.generate_response(messages, character, summary=summary, session=session),
+            timeout=async_openai_service.deadline("chat")
+        )
+
+class AsyncGenerateQuest(GenerateQuest):
+    def generate_quest(self, character, difficulty, quest_type):
+        return async_runner.run(
+            async_openai_service.generate_quest(character, difficulty, quest_type),
+            timeout=async_openai_service.deadline("quest")
+        )
+
+class AsyncGenerateCharacterAvatar(GenerateCharacterAvatar):
+    def generate_avatar(self, character_name, character_class, character_description):
+        return async_runner.run(
+            async_openai_service.generate_character_avatar(character_name, character_class, character_description, priority=STANDARD),
+            timeout=async_openai_service.deadline("image", STANDARD)
+        )
+
+class AsyncGenerateCharacterBio(GenerateCharacterBio):
+    def generate_bio(self, character_name, character_class):
+        return async_runner.run(
+            async_openai_service.generate_character_bio(character_name, character_class, priority=STANDARD),
+            timeout=async_openai_service.deadline("bio", STANDARD)
+        )
+
+def create_test_item(session, character_id, item_name, item_type, item_description):
+    """Create a test item with a generated image in a character's inventory"""
+    # Create the new item
+    new_item = Item(
+        name=item_name,
+        type=item_type,
+        weight=1,  # Default weight
+        effect_description=item_description,
+        lore_description="A sacred artifact from ancient times that connects the mortal world to Xibalba.",
+        armor_class=0,
+        str=0,
+        dex=0,
+        speed=0,
+        wisdom=2,
+        intelligence=1,
+        constitution=0,
+        charisma=0,
+        initiative=0,
+        equippable=True if item_type in ["weapon", "armor", "necklace", "trinket", "helm", "accessory"] else False,
+        is_equipped=False
+    )
+    
+    # Generate image for the item
+    try:
+        image_path = openai_service._generate_image(f"{item_name}: {item_description}", "item", priority=STANDARD)
+        if image_path:
+            new_item.image_url = image_path
+            print(f"Item image path set to: {image_path}")
+    except Exception as img_err:
+        print(f"Error generating image for item: {str(img_err)}")
+    
+    # Add item to database
+    session.add(new_item)
+    session.flush()  # Get the ID without committing
+    
+    # Add item to character's inventory
+    new_inventory = Inventory(
+        item_id=new_item.id,
+        character_id=character_id
+    )
+    
+    session.add(new_inventory)
+    session.commit()
+    
+    # Return the created item
+    item_data = item_schema.dump(new_item)
+    item_data['inventory_id'] = new_inventory.id
+    
+    return item_data
+
 # Test endpoint for generating an item with an image
 class TestGenerateItem(Resource):
     @jwt_required()
@@ -1167,58 +1515,73 @@ class TestGenerateItem(Resource):
             item_type = data.get('type', 'trinket')
             item_description = data.get('description', 'A polished obsidian mirror that shows glimpses of the spirit realm. Increases wisdom and intuition.')
             
-            # Create the new item
-            new_item = Item(
-                name=item_name,
-                type=item_type,
-                weight=1,  # Default weight
-                effect_description=item_description,
-                lore_description="A sacred artifact from ancient times that connects the mortal world to Xibalba.",
-                armor_class=0,
-                str=0,
-                dex=0,
-                speed=0,
-                wisdom=2,
-                intelligence=1,
-                constitution=0,
-                charisma=0,
-                initiative=0,
-                equippable=True if item_type in ["weapon", "armor", "necklace", "trinket", "helm", "accessory"] else False,
-                is_equipped=False
-            )
-            
-            # Generate image for the item
-            try:
-                image_path = openai_service.generate_item_image(item_name, item_type, item_description)
-                if image_path:
-                    new_item.image_url = image_path
-                    print(f"Item image path set to: {image_path}")
-            except Exception as img_err:
-                print(f"Error generating image for item: {str(img_err)}")
-            
-            # Add item to database
-            session.add(new_item)
-            session.flush()  # Get the ID without committing
-            
-            # Add item to character's inventory
-            new_inventory = Inventory(
-                item_id=new_item.id,
-                character_id=character_id
-            )
-            
-            session.add(new_inventory)
-            session.commit()
-            
-            # Return the created item
-            item_data = item_schema.dump(new_item)
-            item_data['inventory_id'] = new_inventory.id
+            if data.get('background'):
+                job_id = job_queue.enqueue('generate_test_item', {
+                    'character_id': character_id,
+                    'item_name': item_name,
+                    'item_type': item_type,
+                    'item_description': item_description
+                })
+                return _job_accepted(job_id)
             
-            return item_data, 201
+            return create_test_item(session, character_id, item_name, item_type, item_description), 201
             
         except Exception as e:
             print(f"Error in test item generation: {str(e)}")
             return {'message': f'Error: {str(e)}'}, 500
 
+# Status and result of a background job
+class JobResource(Resource):
+    @jwt_required()
+    def get(self, job_id):
+        job = job_queue.get(job_id)
+        if not job:
+            return {'message': 'Job not found'}, 404
+        return job, 200
+
+# Push job status changes to the client over Server-Sent Events
+class JobEvents(Resource):
+    @jwt_required()
+    def get(self, job_id):
+        job = job_queue.get(job_id)
+        if not job:
+            return {'message': 'Job not found'}, 404
+
+        def generate():
+            current = job
+            last_status = None
+            last_sent = time.monotonic()
+            while True:
+                if current['status'] != last_status:
+                    last_status = current['status']
+                    last_sent = time.monotonic()
+                    if last_status in ('done', 'failed'):
+                        yield _sse_event(last_status, current)
+                        return
+                    yield _sse_event('status', current)
+                elif time.monotonic() - last_sent > 15:
+                    # Comment line so proxies keep the idle connection open
+                    last_sent = time.monotonic()
+                    yield ": keep-alive\n\n"
+
+                time.sleep(job_queue.poll_interval)
+                current = job_queue.get(job_id)
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+# Queue depth and latency of the job queue
+class JobStats(Resource):
+    @jwt_required()
+    def get(self):
+        return job_queue.stats(), 200
+
 # Equip or unequip an item
 class EquipItem(Resource):
     @jwt_required()
@@ -1439,31 +1802,16 @@ class UpdateCharacterHP(Resource):
             source = data.get('source', 'unknown')
             target = data.get('target', 'unknown')
             
-            # Calculate new HP
-            if damage_amount > 0:
-                # Apply damage
-                character.hp_status = max(0, character.hp_status - damage_amount)
-                print(f"Character {character.name} took {damage_amount} damage from {source}. New HP: {character.hp_status}")
-                
-            elif healing_amount > 0:
-                # Apply healing
-                # Get max HP from character class
-                max_hp = character.class_.hp if character.class_ else 100
-                character.hp_status = min(max_hp, character.hp_status + healing_amount)
-                print(f"Character {character.name} healed for {healing_amount} from {source}. New HP: {character.hp_status}")
-            
-            # Calculate new MP if moves were used
-            if mp_used > 0:
-                # Apply MP consumption
-                # Get max MP from character class
-                max_mp = character.class_.mp if character.class_ else 100
-                character.mp_status = max(0, character.mp_status - mp_used)
-                print(f"Character {character.name} used {mp_used} MP. New MP: {character.mp_status}")
-            
-            # Track damage dealt by player    
-            if damage_dealt > 0:
-                print(f"Character {character.name} dealt {damage_dealt} damage to {target}")
-                # Note: We don't update character stats here, just logging the damage dealt
+            # Apply the HP/MP changes
+            damage_info = character_stats.apply(
+                session, character,
+                damage=damage_amount,
+                healing=healing_amount,
+                mp_used=mp_used,
+                damage_dealt=damage_dealt,
+                source=source,
+                target=target
+            )
                 
             # Save changes
             session.commit()
@@ -1486,20 +1834,7 @@ class UpdateCharacterHP(Resource):
                     character_data['class_'] = class_data
             
             # Add damage info to the response
-            character_data['damage_info'] = {
-                'message': f"Character stats updated: HP = {character.hp_status}, MP = {character.mp_status}",
-                'damage_amount': damage_amount if damage_amount > 0 else 0,
-                'healing_amount': healing_amount if healing_amount > 0 else 0,
-                'mp_used': mp_used if mp_used > 0 else 0,
-                'damage_dealt': damage_dealt if damage_dealt > 0 else 0,
-                'source': source,
-                'target': target,
-                'hp_status': character.hp_status,
-                'mp_status': character.mp_status,
-                'max_hp': character.class_.hp if character.class_ else 100,
-                'max_mp': character.class_.mp if character.class_ else 100,
-                'is_dead': character.hp_status <= 0
-            }
+            character_data['damage_info'] = damage_info
             
             return character_data, 200
             
@@ -1535,10 +1870,12 @@ def initialize_routes(api):
     # Item routes
     api.add_resource(ItemResource, '/api/items/<int:item_id>')
     api.add_resource(ItemList, '/api/items')
+    api.add_resource(ItemBulk, '/api/items/bulk')
     
     # Inventory routes
     api.add_resource(InventoryResource, '/api/inventories/<int:inventory_id>')
     api.add_resource(InventoryList, '/api/inventories')
+    api.add_resource(InventoryBulk, '/api/inventories/bulk')
     api.add_resource(CharacterInventory, '/api/characters/<int:character_id>/inventory')
     api.add_resource(EquipItem, '/api/items/<int:item_id>/equip')
     api.add_resource(DropItem, '/api/items/<int:item_id>/drop')
@@ -1547,15 +1884,18 @@ def initialize_routes(api):
     # Enemy routes
     api.add_resource(EnemyResource, '/api/enemies/<int:enemy_id>')
     api.add_resource(EnemyList, '/api/enemies')
+    api.add_resource(EnemyBulk, '/api/enemies/bulk')
     api.add_resource(EnemyMoves, '/api/enemies/<int:enemy_id>/moves')
     
     # Move routes
     api.add_resource(MoveResource, '/api/moves/<int:move_id>')
     api.add_resource(MoveList, '/api/moves')
+    api.add_resource(MoveBulk, '/api/moves/bulk')
     
     # Quest routes
     api.add_resource(QuestResource, '/api/quests/<int:quest_id>')
     api.add_resource(QuestList, '/api/quests')
+    api.add_resource(QuestBulk, '/api/quests/bulk')
     api.add_resource(CharacterQuests, '/api/characters/<int:character_id>/quests')
     
     # Chat routes
@@ -1563,11 +1903,29 @@ def initialize_routes(api):
     api.add_resource(ChatMessageList, '/api/chat/messages')
     api.add_resource(CharacterChatHistory, '/api/characters/<int:character_id>/chat')
     api.add_resource(ChatCompletion, '/api/ai/chat')
+    api.add_resource(ChatCompletionStream, '/api/ai/chat/stream')
+    api.add_resource(PromptStats, '/api/ai/prompt-stats')
+    api.add_resource(RateStats, '/api/ai/rate-stats')
+    api.add_resource(ModelStats, '/api/ai/model-stats')
+    api.add_resource(SessionStats, '/api/db/session-stats')
+    api.add_resource(DmEffectsStatus, '/api/dm-effects/<int:effects_id>')
     
     # OpenAI integration routes
     api.add_resource(GenerateQuest, '/api/generate-quest')
+    api.add_resource(QuestPoolStats, '/api/quest-pool/stats')
     api.add_resource(GiveItemToCharacter, '/api/give-item')
     api.add_resource(GenerateCharacterAvatar, '/api/generate-avatar')
     api.add_resource(GenerateCharacterBio, '/api/generate-bio')
     api.add_resource(TestGenerateItem, '/api/test-generate-item')
     api.add_resource(AcquireItem, '/api/items/<int:item_id>/acquire')
+    
+    # Async OpenAI integration routes (shared event loop per worker)
+    api.add_resource(AsyncChatCompletion, '/api/async/ai/chat')
+    api.add_resource(AsyncGenerateQuest, '/api/async/generate-quest')
+    api.add_resource(AsyncGenerateCharacterAvatar, '/api/async/generate-avatar')
+    api.add_resource(AsyncGenerateCharacterBio, '/api/async/generate-bio')
+
+    # Background job routes
+    api.add_resource(JobStats, '/api/jobs/stats')
+    api.add_resource(JobResource, '/api/jobs/<int:job_id>')
+    api.add_resource(JobEvents, '/api/jobs/<int:job_id>/events')
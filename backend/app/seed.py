@@ -1,11 +1,9 @@
-from sqlalchemy import create_engine
+# Run from the backend directory: python -m app.seed
 from sqlalchemy.orm import sessionmaker
-from models import Base, Class_, Enemy, Move, Item
-import os
+from .models import Base, Class_, Enemy, Move, Item
+from .db import engine
+from .migrations import migrate
 
-# Create engine with absolute path
-db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'emerald_altar.db')
-engine = create_engine(f'sqlite:///{db_path}')
 Session = sessionmaker(bind=engine)
 session = Session()
 
@@ -801,4 +799,7 @@ fourth_wave_items = [
 session.add_all(fourth_wave_items)
 session.commit()
 
-print("Fourth wave of enemies, moves, and items seeded.")
\ No newline at end of file
+print("Fourth wave of enemies, moves, and items seeded.")
+
+# drop_all also cleared schema_migrations: re-apply them to the fresh tables (item search index)
+migrate()
@@ -0,0 +1,416 @@
+import os
+import json
+import time
+import asyncio
+import httpx
+from .openai_service import openai_service
+from .prompt_builder import prompt_builder
+from .model_router import model_router
+from .async_runner import async_runner
+from .rate_governor import CALL_TYPES, STANDARD, PRIORITY_MAX_WAIT
+
+# Connection limits for the shared asyncio client (per worker process)
+DEFAULT_ASYNC_MAX_CONNECTIONS = 200
+DEFAULT_ASYNC_MAX_KEEPALIVE = 20
+
+# Seconds a caller allows on top of the request timeouts (tag processing, saving images)
+DEADLINE_MARGIN = 15
+
+
+class AsyncOpenAIService:
+    """asyncio implementation of the OpenAIService API
+
+    Network calls go through one httpx.AsyncClient per event loop and retries
+    back off with asyncio.sleep, so a waiting generation never holds a thread.
+    Prompt building, tag processing and image saving are shared with the
+    synchronous OpenAIService; the blocking parts (database writes, file I/O)
+    run in a worker thread via asyncio.to_thread, while the rate governor's
+    SQLite calls use the runner's separate governor executor.
+
+    Run these coroutines on the shared loop with
+    async_runner.run(..., timeout=async_openai_service.deadline(call_type)).
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.max_connections = int(os.environ.get("OPENAI_ASYNC_MAX_CONNECTIONS", DEFAULT_ASYNC_MAX_CONNECTIONS))
+        self.max_keepalive = int(os.environ.get("OPENAI_ASYNC_MAX_KEEPALIVE", DEFAULT_ASYNC_MAX_KEEPALIVE))
+        self._client = None
+        self._client_loop = None
+
+    @property
+    def api_key(self):
+        return self.service.api_key
+
+    def _get_client(self):
+        """Return the AsyncClient bound to the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive
+                )
+            )
+            self._client_loop = loop
+        return self._client
+
+    def _timeout(self, call_type):
+        """Use the same per-call-type timeouts as the synchronous transport"""
+        connect_timeout, read_timeout = self.service.transport.timeout_for(call_type)
+        return httpx.Timeout(read_timeout, connect=connect_timeout)
+
+    def deadline(self, call_type, priority=None):
+        """
+        Seconds to wait for the result of a call: the longest wait the rate
+        governor allows its priority class, plus the request timeouts
+
+        Args:
+            call_type: Call type of the request ('chat', 'quest', 'image', ...)
+            priority: Rate governor priority class (default: the class of call_type)
+
+        Returns:
+            Timeout for async_runner.run
+        """
+        if priority is None:
+            priority = CALL_TYPES.get(call_type, ("chat", STANDARD))[1]
+        connect_timeout, read_timeout = self.service.transport.timeout_for(call_type)
+        deadline = PRIORITY_MAX_WAIT[priority] + connect_timeout + read_timeout + DEADLINE_MARGIN
+        if call_type == "image":
+            # The generated image is downloaded before the call returns
+            deadline += sum(self.service.transport.timeout_for("download"))
+        return deadline
+
+    async def _post(self, url, call_type, data, priority=None):
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+
+        # Same cross-worker rate governor as the synchronous transport, waiting with asyncio.sleep
+        governor = self.service.transport.governor
+        if governor is None or not governor.enabled:
+            return await self._timed_post(url, call_type, headers, data)
+
+        loop = asyncio.get_running_loop()
+        executor = async_runner.governor_executor
+        lease_id = await governor.acquire_async(call_type, priority, executor)
+        try:
+            response = await self._timed_post(url, call_type, headers, data)
+        finally:
+            await loop.run_in_executor(executor, governor.release, lease_id)
+        await loop.run_in_executor(executor, governor.observe, call_type, response.status_code, response.headers)
+        return response
+
+    async def _timed_post(self, url, call_type, headers, data):
+        """POST and report latency and outcome to the model router, like the synchronous transport"""
+        router = self.service.transport.router
+        started = time.monotonic()
+        try:
+            response = await self._get_client().post(url, headers=headers, json=data, timeout=self._timeout(call_type))
+        except httpx.TransportError:
+            if router is not None:
+                router.record(call_type, data, time.monotonic() - started, False)
+            raise
+        if router is not None:
+            ok = response.status_code != 429 and response.status_code < 500
+            router.record(call_type, data, time.monotonic() - started, ok)
+        return response
+
+    async def _post_with_retries(self, url, call_type, data, label, max_retries=3, base_delay=1):
+        """POST with exponential backoff on rate limits and network errors
+
+        Returns:
+            The last response received (which may still be a 429)
+
+        Raises:
+            httpx.TransportError if the network kept failing
+        """
+        retry_count = 0
+
+        while True:
+            try:
+                print(f"Making async {label} request to OpenAI API (attempt {retry_count + 1}/{max_retries + 1})")
+                response = await self._post(url, call_type, data)
+            except httpx.TransportError as e:
+                # Only retry on network-related errors
+                if retry_count < max_retries:
+                    retry_count += 1
+                    delay = (2 ** retry_count) * base_delay
+                    print(f"Network error ({str(e)}). Retrying in {delay:.2f} seconds...")
+                    await asyncio.sleep(delay)
+                    continue
+                raise
+
+            if response.status_code == 429 and retry_count < max_retries:
+                # Rate limit hit, back off (honoring Retry-After) before retrying
+                retry_count += 1
+                delay = self.service.transport.retry_delay(response, retry_count, base_delay)
+                print(f"Rate limit hit. Retrying in {delay:.2f} seconds...")
+                await asyncio.sleep(delay)
+                continue
+
+            return response
+
+    async def generate_response(self, messages, character=None, system_prompt=None, summary=None, session=None):
+        """
+        Generate a response from OpenAI API based on chat history
+
+        Args:
+            messages: List of message dictionaries with 'content' and 'is_user' keys
+            character: Character object with information about the player character
+            system_prompt: Custom system prompt to override the default
+            summary: Optional summary of the turns older than messages
+            session: Session the caller saves the AI message in (outbox mode)
+
+        Returns:
+            Response text from AI or error message
+        """
+        if not self.api_key:
+            return "ERROR: OpenAI API key not configured. Please set the OPENAI_API_KEY environment variable in the .env file."
+
+        structured = self.service.structured_output and character is not None
+        formatted_messages = self.service._build_chat_messages(messages, character, system_prompt, summary, structured)
+        call_type, data = self.service._chat_payload(formatted_messages, structured)
+
+        try:
+            response = await self._post_with_retries(self.service.api_url, call_type, data, "chat")
+        except Exception as e:
+            print(f"Exception when calling OpenAI API: {str(e)}")
+            return f"Error: {str(e)}"
+
+        if response.status_code == 200:
+            response_data = response.json()
+            ai_response = response_data['choices'][0]['message']['content']
+            prompt_builder.record_usage(response_data.get('usage'))
+
+            # Tag effects hit the database, keep them off the event loop
+            if character:
+                ai_response = await asyncio.to_thread(
+                    self.service._process_tags, ai_response, character, structured, session
+                )
+
+            return ai_response
+
+        print(f"Error from OpenAI API: {response.status_code}")
+        print(response.text)
+        if response.status_code == 429:
+            return "I'm thinking too hard right now. Please try again in a moment."
+        return f"Error: Unable to generate response (HTTP {response.status_code})"
+
+    async def generate_quest(self, character=None, difficulty=None, quest_type=None):
+        """
+        Generate a quest based on character information
+
+        Args:
+            character: Character object with information about the player
+            difficulty: Optional difficulty level (easy, medium, hard)
+            quest_type: Optional quest type (combat, exploration, puzzle)
+
+        Returns:
+            Dictionary with quest data or error message
+        """
+        if not self.api_key:
+            return {"error": "OpenAI API key not configured. Please set the OPENAI_API_KEY environment variable in the .env file."}
+
+        data = {
+            **model_router.params("quest"),
+            "messages": self.service._build_quest_messages(character, difficulty, quest_type),
+            "temperature": 0.7,
+            "response_format": {"type": "json_object"}
+        }
+
+        try:
+            response = await self._post_with_retries(self.service.api_url, "quest", data, "quest generation")
+
+            if response.status_code == 200:
+                quest_json = response.json()['choices'][0]['message']['content']
+                return json.loads(quest_json)
+
+            print(f"Error from OpenAI API: {response.status_code}")
+            print(response.text)
+            if response.status_code == 429:
+                return {"error": "OpenAI rate limit reached. Please try again in a moment."}
+            return {"error": f"Unable to generate quest (HTTP {response.status_code})"}
+
+        except Exception as e:
+            print(f"Exception when calling OpenAI API: {str(e)}")
+            return {"error": str(e)}
+
+    async def _download_image(self, image_url, image_type, name=None):
+        """Download a generated image and save it for the frontend"""
+        image_response = await self._get_client().get(image_url, timeout=self._timeout("download"))
+        if image_response.status_code != 200:
+            print(f"Failed to download image from {image_url}")
+            return None
+
+        return await asyncio.to_thread(self.service._save_image, image_response.content, image_type, name)
+
+    async def _generate_image(self, prompt, image_type="other", priority=None):
+        """Internal method to generate an image using DALL-E
+
+        Args:
+            prompt: The text prompt to generate the image
+            image_type: Type of image ("avatar", "item", or "other")
+            priority: Rate governor priority class (default: background, as for
+                the job queue; request handlers pass STANDARD)
+
+        Returns:
+            Path to the saved image or None if generation failed
+        """
+        max_retries = 2
+        retry_count = 0
+        base_delay = 1
+
+        safety_prompt = self.service._build_image_prompt(prompt)
+
+        while retry_count <= max_retries:
+            try:
+                # Try the preferred image route first (DALL-E-3 HD unless it is slow or failing)
+                route = model_router.params("image")
+                data = {
+                    **route,
+                    "prompt": safety_prompt,
+                    "n": 1,
+                    "response_format": "url"
+                }
+
+                print(f"Requesting async image generation with {route['model']} (attempt {retry_count + 1}/{max_retries + 1})")
+                response = await self._post(self.service.image_api_url, "image", data, priority)
+
+                if response.status_code == 429 or "model is currently overloaded" in response.text:
+                    # Try the next image route as fallback on rate limits or overload
+                    route = model_router.fallback("image", route) or route
+                    data = {
+                        **route,
+                        "prompt": safety_prompt,
+                        "n": 1,
+                        "response_format": "url"
+                    }
+
+                    print(f"Requesting fallback image generation with {route['model']} (attempt {retry_count + 1}/{max_retries + 1})")
+                    response = await self._post(self.service.image_api_url, "image", data, priority)
+
+                    if response.status_code == 429:
+                        if retry_count < max_retries:
+                            retry_count += 1
+                            delay = self.service.transport.retry_delay(response, retry_count, base_delay)
+                            print(f"Rate limit hit. Retrying in {delay:.2f} seconds...")
+                            await asyncio.sleep(delay)
+                            continue
+
+                        print(f"Rate limit error, max retries exceeded: {response.status_code}")
+                        print(response.text)
+                        return None
+
+                if response.status_code != 200:
+                    print(f"Error from OpenAI image API: {response.status_code}")
+                    print(response.text)
+                    return None
+
+                image_url = response.json()['data'][0]['url']
+                return await self._download_image(image_url, image_type)
+
+            except httpx.TransportError as e:
+                print(f"Exception when calling OpenAI image API: {str(e)}")
+
+                # Only retry on network-related errors
+                if retry_count < max_retries:
+                    retry_count += 1
+                    delay = (2 ** retry_count) * base_delay
+                    print(f"Network error. Retrying in {delay:.2f} seconds...")
+                    await asyncio.sleep(delay)
+                    continue
+                return None
+
+            except Exception as e:
+                print(f"Exception when calling OpenAI image API: {str(e)}")
+                return None
+
+        return None
+
+    async def generate_character_avatar(self, character_name, character_class, character_description, priority=None):
+        """Generate a 16-bit style avatar image for a character using OpenAI's DALL-E model
+
+        Args:
+            character_name: Name of the character
+            character_class: Class of the character (warrior, mage, etc.)
+            character_description: Description of the character
+            priority: Rate governor priority class (default: background, as for
+                the job queue; request handlers pass STANDARD)
+
+        Returns:
+            Path to the saved avatar image or None if generation failed
+        """
+        if not self.api_key:
+            print("Cannot generate avatar: OpenAI API key not set")
+            return None
+
+        data = {
+            **model_router.params("image"),
+            "prompt": self.service._build_avatar_prompt(character_class),
+            "n": 1
+        }
+
+        try:
+            print("Requesting async character avatar generation...")
+            response = await self._post(self.service.image_api_url, "image", data, priority)
+
+            if response.status_code != 200:
+                print(f"Error from OpenAI image API: {response.status_code}")
+                print(response.text)
+                return None
+
+            image_url = response.json()['data'][0]['url']
+            return await self._download_image(image_url, "avatar", name=character_name)
+
+        except Exception as e:
+            print(f"Exception when calling OpenAI image API: {str(e)}")
+            return None
+
+    async def generate_character_bio(self, character_name, character_class, priority=None):
+        """Generate a character bio using OpenAI
+
+        Args:
+            character_name: Name of the character
+            character_class: Class of the character
+            priority: Rate governor priority class (default: background, as for
+                the job queue; request handlers pass STANDARD)
+
+        Returns:
+            Generated character biography or None if generation failed
+        """
+        if not self.api_key:
+            print("Cannot generate bio: OpenAI API key not set")
+            return None
+
+        data = {
+            **model_router.params("bio"),
+            "messages": self.service._build_bio_messages(character_name, character_class),
+            "temperature": 0.7
+        }
+
+        try:
+            response = await self._post(self.service.api_url, "bio", data, priority)
+
+            if response.status_code == 200:
+                return response.json()['choices'][0]['message']['content']
+
+            print(f"Error from OpenAI API: {response.status_code}")
+            print(response.text)
+            return None
+
+        except Exception as e:
+            print(f"Exception when calling OpenAI API: {str(e)}")
+            return None
+
+    async def aclose(self):
+        """Close the pooled connections of the client on the running loop"""
+        if self._client is not None and self._client_loop is asyncio.get_running_loop():
+            await self._client.aclose()
+        self._client = None
+        self._client_loop = None
+
+
+# Initialize service
+async_openai_service = AsyncOpenAIService(openai_service)
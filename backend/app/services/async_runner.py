@@ -0,0 +1,147 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+
+# Worker threads of the loop, for the blocking parts of a call (database
+# writes, file I/O) and, separately, for the rate governor's SQLite calls
+DEFAULT_ASYNC_THREADS = 32
+DEFAULT_GOVERNOR_THREADS = 8
+
+
+class AsyncRunner:
+    """A process-wide asyncio event loop running in a background thread
+
+    Flask request threads hand coroutines to this loop and wait for the result,
+    so every in-flight OpenAI call of a worker process shares one event loop
+    and one connection pool instead of a thread-bound socket each. Waiting on
+    the result is cheap, which lets a threaded worker (gunicorn -k gthread)
+    hold hundreds of generations in flight while still serving CRUD routes.
+
+    The loop gets its own thread pool as default executor (asyncio.to_thread)
+    instead of the min(32, cpus + 4) threads asyncio would pick, and the rate
+    governor gets a second one, so waiting for a slot never queues behind tag
+    processing holding database connections.
+
+    Settings can be overridden with environment variables:
+        OPENAI_ASYNC_THREADS, OPENAI_GOVERNOR_THREADS
+    """
+
+    def __init__(self, threads=None, governor_threads=None):
+        self.threads = threads or int(os.environ.get("OPENAI_ASYNC_THREADS", DEFAULT_ASYNC_THREADS))
+        self.governor_threads = governor_threads or int(
+            os.environ.get("OPENAI_GOVERNOR_THREADS", DEFAULT_GOVERNOR_THREADS)
+        )
+        self.governor_executor = None
+        self._executor = None
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """The running event loop for the current process, started on first use"""
+        # A forked worker inherits the parent's loop object but not its thread
+        if self._loop is None or self._pid != os.getpid():
+            with self._lock:
+                if self._loop is None or self._pid != os.getpid():
+                    self._start()
+        return self._loop
+
+    def _start(self):
+        loop = asyncio.new_event_loop()
+        executor = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix="openai-loop-worker")
+        loop.set_default_executor(executor)
+        ready = threading.Event()
+
+        def run_loop():
+            asyncio.set_event_loop(loop)
+            loop.call_soon(ready.set)
+            loop.run_forever()
+
+        thread = threading.Thread(target=run_loop, name="openai-event-loop", daemon=True)
+        thread.start()
+        ready.wait()
+
+        self._loop = loop
+        self._thread = thread
+        self._executor = executor
+        self.governor_executor = concurrent.futures.ThreadPoolExecutor(
+            self.governor_threads, thread_name_prefix="openai-governor"
+        )
+        self._pid = os.getpid()
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the shared loop and block until it finishes
+
+        The coroutine runs inside a copy of the caller's context, so the Flask
+        application context (current_app, JWT helpers, ...) stays available to
+        it and to anything it hands to asyncio.to_thread.
+
+        Args:
+            coro: Coroutine to run
+            timeout: Optional number of seconds to wait for the result; the
+                coroutine is cancelled when it runs longer
+
+        Returns:
+            Whatever the coroutine returns (its exceptions are re-raised)
+
+        Raises:
+            TimeoutError if the result took longer than timeout
+        """
+        loop = self.loop
+        context = contextvars.copy_context()
+        future = concurrent.futures.Future()
+        tasks = []
+
+        def start():
+            if not future.set_running_or_notify_cancel():
+                coro.close()
+                return
+
+            task = loop.create_task(coro)
+            tasks.append(task)
+
+            def done(finished):
+                if finished.cancelled():
+                    future.set_exception(concurrent.futures.CancelledError())
+                elif finished.exception() is not None:
+                    future.set_exception(finished.exception())
+                else:
+                    future.set_result(finished.result())
+
+            task.add_done_callback(done)
+
+        def cancel():
+            for task in tasks:
+                task.cancel()
+
+        # The task copies the context that is current when it is created
+        loop.call_soon_threadsafe(start, context=context)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            # Nobody waits for the result any more, stop the call
+            future.cancel()
+            loop.call_soon_threadsafe(cancel)
+            raise TimeoutError(f"No result after {timeout:g} seconds") from None
+
+    def stop(self):
+        """Stop the loop of the current process (used on shutdown)"""
+        with self._lock:
+            if self._loop is not None and self._pid == os.getpid():
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join(timeout=5)
+                self._executor.shutdown(wait=False)
+                self.governor_executor.shutdown(wait=False)
+            self.governor_executor = None
+            self._executor = None
+            self._loop = None
+            self._thread = None
+            self._pid = None
+
+
+# Initialize runner
+async_runner = AsyncRunner()
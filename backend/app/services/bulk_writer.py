@@ -0,0 +1,189 @@
+import os
+from marshmallow import ValidationError
+from sqlalchemy import select, insert, update
+from sqlalchemy.exc import DBAPIError
+from ..utils import name_key
+
+# Rows accepted by one bulk request
+DEFAULT_MAX_ROWS = 1000
+
+
+class BulkWriter:
+    """Create or update many rows of a content table in one transaction
+
+    Used by the /bulk routes (items, enemies, moves, inventories, quests) so
+    a content pack or the loot of a party is one request and one commit
+    instead of one of each per row. A batch is validated in one pass: every
+    row is loaded with the table's marshmallow schema, then each foreign key
+    is checked with one query for all the ids the batch references. The
+    valid rows are then written with a single executemany.
+
+    Every row gets a result, in request order, so a client can tell which
+    ones to fix and send again. Invalid rows are skipped and the rest is
+    written, unless the batch is atomic: then nothing is written if a single
+    row is invalid. If the database still rejects the batch (a constraint
+    the validation does not know about), the rows are retried one by one in
+    savepoints, so only the rows it rejects are reported as failed.
+
+    Nothing is committed here: the caller's session decides when.
+
+    Settings can be overridden with environment variables:
+        BULK_MAX_ROWS
+    """
+
+    def __init__(self, max_rows=None):
+        self.max_rows = max_rows or int(os.environ.get("BULK_MAX_ROWS", DEFAULT_MAX_ROWS))
+
+    def create(self, session, model, schema, rows, defaults=None, atomic=False):
+        """
+        Insert rows of a table
+
+        Args:
+            session: Session to write in (not committed)
+            model: Mapped class of the table
+            schema: marshmallow Schema of the table, used to validate the rows
+            rows: List of dictionaries, one per new row
+            defaults: Values of the columns a row leaves out
+            atomic: Write nothing unless every row is valid
+
+        Returns:
+            One result per row, in request order: {'index', 'status': 'created', 'id'}
+            or {'index', 'status': 'invalid' or 'failed', 'errors'}
+        """
+        results = [None] * len(rows)
+        pending = {}
+        for index, row in enumerate(rows):
+            try:
+                values = dict(defaults or {}, **schema.load(row))
+            except ValidationError as e:
+                results[index] = _error(index, 'invalid', e.messages)
+                continue
+            pending[index] = values
+
+        self._check_references(session, model, pending, results)
+        if not pending or (atomic and len(pending) < len(rows)):
+            return _abort(results, pending)
+
+        # executemany needs the same columns in every row
+        columns = set().union(*pending.values())
+        for values in pending.values():
+            for column in columns:
+                values.setdefault(column, None)
+            self._set_name_key(model, values)
+
+        statement = insert(model).returning(model.id, sort_by_parameter_order=True)
+        ids = self._write(session, statement, pending, results, atomic)
+        for index, row_id in ids.items():
+            results[index] = {'index': index, 'status': 'created', 'id': row_id}
+        return results
+
+    def update(self, session, model, schema, rows, atomic=False):
+        """
+        Update rows of a table by id; a row only changes the fields it contains
+
+        Args:
+            session: Session to write in (not committed)
+            model: Mapped class of the table
+            schema: marshmallow Schema of the table, used to validate the rows
+            rows: List of dictionaries with the id of the row and the fields to change
+            atomic: Write nothing unless every row is valid
+
+        Returns:
+            One result per row, in request order: {'index', 'status': 'updated', 'id'}
+            or {'index', 'status': 'invalid', 'not_found' or 'failed', 'errors'}
+        """
+        results = [None] * len(rows)
+        pending = {}
+        for index, row in enumerate(rows):
+            if not isinstance(row, dict) or not isinstance(row.get('id'), int):
+                results[index] = _error(index, 'invalid', {'id': ['Missing or not an integer.']})
+                continue
+            fields = {key: value for key, value in row.items() if key != 'id'}
+            try:
+                values = schema.load(fields, partial=True)
+            except ValidationError as e:
+                results[index] = _error(index, 'invalid', e.messages)
+                continue
+            pending[index] = dict(values, id=row['id'])
+
+        ids = {values['id'] for values in pending.values()}
+        found = set(session.execute(select(model.id).where(model.id.in_(ids))).scalars()) if ids else set()
+        for index, values in list(pending.items()):
+            if values['id'] not in found:
+                del pending[index]
+                results[index] = _error(index, 'not_found', {'id': [f"No {model.__tablename__} row with id {values['id']}."]})
+
+        self._check_references(session, model, pending, results)
+        if not pending or (atomic and len(pending) < len(rows)):
+            return _abort(results, pending)
+
+        for values in pending.values():
+            self._set_name_key(model, values)
+
+        updated = self._write(session, update(model), pending, results, atomic)
+        for index in updated:
+            results[index] = {'index': index, 'status': 'updated', 'id': pending[index]['id']}
+        return results
+
+    def _check_references(self, session, model, pending, results):
+        """Mark rows pointing at rows that do not exist, with one query per foreign key"""
+        for column in model.__table__.columns:
+            for foreign_key in column.foreign_keys:
+                wanted = {values[column.name] for values in pending.values() if values.get(column.name) is not None}
+                if not wanted:
+                    continue
+                target = foreign_key.column
+                found = set(session.execute(select(target).where(target.in_(wanted))).scalars())
+                for index, values in list(pending.items()):
+                    value = values.get(column.name)
+                    if value is not None and value not in found:
+                        del pending[index]
+                        results[index] = _error(index, 'invalid', {
+                            column.name: [f"No {target.table.name} row with id {value}."]
+                        })
+
+    def _set_name_key(self, model, values):
+        # executemany skips the model's validators, name_key included
+        if 'name' in values and hasattr(model, 'name_key'):
+            values['name_key'] = name_key(values['name'])
+
+    def _write(self, session, statement, pending, results, atomic):
+        """Run statement with every pending row; returns {index: id or None} of the rows written"""
+        indexes = list(pending)
+        params = [pending[index] for index in indexes]
+        try:
+            with session.begin_nested():
+                outcome = session.execute(statement, params)
+                ids = outcome.scalars().all() if statement.is_insert else [None] * len(indexes)
+            return dict(zip(indexes, ids))
+        except DBAPIError as e:
+            if atomic:
+                for index in indexes:
+                    results[index] = _error(index, 'failed', {'_database': [str(e.orig).strip()]})
+                return {}
+            print(f"Bulk write of {len(indexes)} {statement.table.name} rows rejected, retrying row by row: {str(e.orig).strip()}")
+
+        written = {}
+        for index in indexes:
+            try:
+                with session.begin_nested():
+                    outcome = session.execute(statement, [pending[index]])
+                    written[index] = outcome.scalars().first() if statement.is_insert else None
+            except DBAPIError as e:
+                results[index] = _error(index, 'failed', {'_database': [str(e.orig).strip()]})
+        return written
+
+
+def _error(index, status, errors):
+    return {'index': index, 'status': status, 'errors': errors}
+
+
+def _abort(results, pending):
+    """Results of a batch that writes nothing: the valid rows are reported as skipped"""
+    for index in pending:
+        results[index] = _error(index, 'skipped', {'_batch': ['Not written: other rows of the batch are invalid.']})
+    return results
+
+
+# Initialize service
+bulk_writer = BulkWriter()
@@ -0,0 +1,94 @@
+from sqlalchemy import update, case
+from ..models import Character
+
+# Used when a character has no class
+DEFAULT_MAX_HP = 100
+DEFAULT_MAX_MP = 100
+
+
+def _at_least(expression, floor):
+    return case((expression < floor, floor), else_=expression)
+
+
+def _at_most(expression, ceiling):
+    return case((expression > ceiling, ceiling), else_=expression)
+
+
+class CharacterStatService:
+    """In-process HP/MP changes for a character
+
+    Used by the update-hp route and by the DM tag processor. The changes are
+    made with a single UPDATE computed by the database, so two turns landing
+    at the same time cannot overwrite each other's damage. Nothing is
+    committed here: the caller's session (or unit of work) decides when.
+    """
+
+    def apply(self, session, character, damage=0, healing=0, mp_used=0, damage_dealt=0,
+              source='unknown', target='unknown'):
+        """
+        Apply damage or healing and MP usage to a character
+
+        Damage takes precedence over healing when both are given. Damage
+        dealt by the character is only reported.
+
+        Args:
+            session: Session the character is loaded in
+            character: Character to update
+            damage: HP lost (floored at 0)
+            healing: HP restored (capped at the class maximum)
+            mp_used: MP spent (floored at 0)
+            damage_dealt: Damage the character dealt to target
+            source: What caused the damage or healing
+            target: What the character damaged
+
+        Returns:
+            The damage_info dictionary returned by the update-hp route
+        """
+        max_hp = character.class_.hp if character.class_ else DEFAULT_MAX_HP
+        max_mp = character.class_.mp if character.class_ else DEFAULT_MAX_MP
+
+        values = {}
+        if damage > 0:
+            values['hp_status'] = _at_least(Character.hp_status - damage, 0)
+        elif healing > 0:
+            values['hp_status'] = _at_most(Character.hp_status + healing, max_hp)
+        if mp_used > 0:
+            values['mp_status'] = _at_least(Character.mp_status - mp_used, 0)
+
+        if values:
+            session.execute(
+                update(Character)
+                .where(Character.id == character.id)
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+            session.refresh(character, ['hp_status', 'mp_status'])
+
+        if damage > 0:
+            print(f"Character {character.name} took {damage} damage from {source}. New HP: {character.hp_status}")
+        elif healing > 0:
+            print(f"Character {character.name} healed for {healing} from {source}. New HP: {character.hp_status}")
+        if mp_used > 0:
+            print(f"Character {character.name} used {mp_used} MP. New MP: {character.mp_status}")
+        if damage_dealt > 0:
+            # We don't update character stats here, just logging the damage dealt
+            print(f"Character {character.name} dealt {damage_dealt} damage to {target}")
+
+        return {
+            'message': f"Character stats updated: HP = {character.hp_status}, MP = {character.mp_status}",
+            'damage_amount': damage if damage > 0 else 0,
+            'healing_amount': healing if healing > 0 else 0,
+            'mp_used': mp_used if mp_used > 0 else 0,
+            'damage_dealt': damage_dealt if damage_dealt > 0 else 0,
+            'source': source,
+            'target': target,
+            'hp_status': character.hp_status,
+            'mp_status': character.mp_status,
+            'max_hp': max_hp,
+            'max_mp': max_mp,
+            'is_dead': character.hp_status <= 0
+        }
+
+
+# Initialize service
+character_stats = CharacterStatService()
@@ -0,0 +1,195 @@
+import os
+from ..models import ChatMessage, ChatSummary
+from ..migrations import ensure_migrated
+from ..jobs import job_queue
+
+try:
+    import tiktoken
+except ImportError:  # optional, the heuristic below is close enough for budgeting
+    tiktoken = None
+
+# Tokens of chat history (not counting the system prompt) sent with every DM turn
+DEFAULT_CONTEXT_TOKENS = 3000
+
+# Tokens of turns that fell out of the window before they are folded into the summary;
+# batching them keeps summary calls rare
+DEFAULT_FOLD_TOKENS = 1000
+
+# Messages loaded per query while walking back through the history
+PAGE_SIZE = 50
+
+# Upper bound on the tokens of turns folded by one summary call
+MAX_FOLD_TOKENS = 3000
+
+# Fixed cost of one chat message in the OpenAI format (role and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class ChatContextBuilder:
+    """Selects the chat history sent to the model for a DM turn
+
+    Only the most recent turns that fit in a token budget are sent. Turns
+    that fall out of the window are folded into a per-character summary by
+    the fold_chat_summary background job, and the summary is sent instead of
+    them, so the prompt stays the same size however long someone plays.
+
+    Settings can be overridden with environment variables:
+        CHAT_CONTEXT_TOKENS, CHAT_SUMMARY_FOLD_TOKENS
+    """
+
+    def __init__(self, context_tokens=None, fold_tokens=None):
+        self.context_tokens = context_tokens or int(os.environ.get("CHAT_CONTEXT_TOKENS", DEFAULT_CONTEXT_TOKENS))
+        self.fold_tokens = fold_tokens or int(os.environ.get("CHAT_SUMMARY_FOLD_TOKENS", DEFAULT_FOLD_TOKENS))
+        self._encoding = None
+        if tiktoken is not None:
+            try:
+                self._encoding = tiktoken.encoding_for_model("gpt-4")
+            except Exception as e:
+                print(f"tiktoken unavailable, estimating token counts: {str(e)}")
+
+    def ensure_table(self):
+        """Migrate the database, chat_summaries table included (see app/migrations.py)"""
+        ensure_migrated()
+
+    def count_tokens(self, text):
+        """Number of tokens in a piece of text (estimated when tiktoken is not installed)"""
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        # English prose averages about four characters per token
+        return len(text) // 4 + 1
+
+    def message_tokens(self, content):
+        return self.count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+    def _recent_messages(self, session, character_id):
+        """Walk back through a character's history, newest first, one page at a time"""
+        offset = 0
+        while True:
+            page = (
+                session.query(ChatMessage)
+                .filter_by(character_id=character_id)
+                .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())
+                .offset(offset)
+                .limit(PAGE_SIZE)
+                .all()
+            )
+            yield from page
+            if len(page) < PAGE_SIZE:
+                return
+            offset += PAGE_SIZE
+
+    def _split_history(self, session, character_id, summary_row):
+        """Split the unsummarized history into the window and the older turns
+
+        Returns:
+            (window newest first, tokens in the window, tokens of older turns
+            counted up to the fold threshold)
+        """
+        folded_up_to = summary_row.last_message_id if summary_row else 0
+        summary = summary_row.summary if summary_row else None
+        budget = self.context_tokens - self.count_tokens(summary)
+
+        window = []
+        used = 0
+        older_tokens = 0
+        for message in self._recent_messages(session, character_id):
+            if message.id <= folded_up_to:
+                break
+            tokens = self.message_tokens(message.content)
+            # The newest message (the player's turn) is always sent
+            if older_tokens == 0 and (not window or used + tokens <= budget):
+                window.append(message)
+                used += tokens
+                continue
+            older_tokens += tokens
+            if older_tokens >= self.fold_tokens:
+                break
+
+        return window, used, older_tokens
+
+    def build(self, session, character_id):
+        """Select the history and summary to send for a character's next DM turn
+
+        Queues a fold of the older turns into the summary when enough of them
+        have fallen out of the window.
+
+        Args:
+            session: Database session
+            character_id: ID of the character whose chat this is
+
+        Returns:
+            Dictionary with 'messages' (oldest first, each with 'id', 'content'
+            and 'is_user'), 'summary' (text or None) and 'tokens' (history
+            tokens in the window)
+        """
+        self.ensure_table()
+        summary_row = session.query(ChatSummary).filter_by(character_id=character_id).first()
+        window, used, older_tokens = self._split_history(session, character_id, summary_row)
+
+        if older_tokens >= self.fold_tokens:
+            self.schedule_fold(character_id)
+
+        window.reverse()
+        return {
+            'messages': [
+                {'id': message.id, 'content': message.content, 'is_user': message.is_user}
+                for message in window
+            ],
+            'summary': summary_row.summary if summary_row and summary_row.summary else None,
+            'tokens': used
+        }
+
+    def schedule_fold(self, character_id):
+        """Queue a background fold of a character's older turns into the summary"""
+        try:
+            job_queue.enqueue('fold_chat_summary', {'character_id': character_id}, dedupe_key=str(character_id))
+        except Exception as e:
+            # The turns stay out of the prompt until the next fold succeeds
+            print(f"Error queueing chat summary for character {character_id}: {str(e)}")
+
+    def turns_to_fold(self, session, character_id, max_tokens=MAX_FOLD_TOKENS):
+        """Oldest turns outside the window that the summary does not cover yet
+
+        Args:
+            session: Database session
+            character_id: ID of the character
+            max_tokens: Upper bound on the tokens returned, so one summary
+                call never receives an unbounded backlog
+
+        Returns:
+            (summary row or None, list of ChatMessage oldest first)
+        """
+        self.ensure_table()
+        summary_row = session.query(ChatSummary).filter_by(character_id=character_id).first()
+        window, _, older_tokens = self._split_history(session, character_id, summary_row)
+        if not window or older_tokens == 0:
+            return summary_row, []
+
+        folded_up_to = summary_row.last_message_id if summary_row else 0
+        candidates = (
+            session.query(ChatMessage)
+            .filter(
+                ChatMessage.character_id == character_id,
+                ChatMessage.id > folded_up_to,
+                ChatMessage.id < window[-1].id  # oldest message in the window
+            )
+            .order_by(ChatMessage.id)
+            .limit(PAGE_SIZE * 4)
+            .all()
+        )
+
+        turns = []
+        used = 0
+        for message in candidates:
+            tokens = self.message_tokens(message.content)
+            if turns and used + tokens > max_tokens:
+                break
+            turns.append(message)
+            used += tokens
+        return summary_row, turns
+
+
+# Initialize builder
+chat_context_builder = ChatContextBuilder()
@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import threading
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, and_, func, event
+from ..models import DmOutboxEntry, ChatMessage
+from ..db import engine, unit_of_work
+from ..migrations import ensure_migrated
+from .tag_parser import TagEffect
+
+# Seconds the dispatcher sleeps when it was not woken up by a commit
+DEFAULT_POLL_INTERVAL = 1.0
+
+# Times an entry is tried before it is marked failed and the next one runs
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Days applied entries are kept before purge() deletes them
+DEFAULT_RETENTION_DAYS = 7
+
+# Seconds between two purges by the dispatcher
+PURGE_INTERVAL = 3600
+
+# Rows deleted per transaction, so a purge never holds the write lock for long
+PURGE_BATCH_SIZE = 500
+
+# session.info keys
+PENDING_KEY = "dm_outbox_pending"
+LISTENING_KEY = "dm_outbox_listening"
+
+outbox_table = DmOutboxEntry.__table__
+
+
+class DmOutbox:
+    """Transactional outbox for the effects of DM replies
+
+    With DM_EFFECTS_MODE=outbox, a chat route no longer waits for the effects
+    of a reply (items, money, HP/MP, enemies, NPCs) before answering: they
+    are written to the dm_outbox table in the same transaction as the AI
+    ChatMessage, so they exist exactly when the message does. A dispatcher
+    thread then applies them and appends the notes ("You took 5 damage...")
+    to the saved message; GET /api/dm-effects/<id> reports the result.
+
+    An entry is marked done in the transaction that applies its effects, so
+    each one is applied exactly once, even with several dispatchers (one per
+    web worker). Entries of a character are applied in order: only its
+    oldest pending entry can be picked. An entry that keeps failing is
+    marked failed after max_attempts so it does not block the ones after it.
+    The dispatcher deletes applied entries after retention_days (failed ones
+    are kept for inspection).
+
+    Settings can be overridden with environment variables:
+        DM_EFFECTS_MODE (inline or outbox), DM_OUTBOX_POLL_INTERVAL,
+        DM_OUTBOX_MAX_ATTEMPTS, DM_OUTBOX_RETENTION_DAYS
+    """
+
+    def __init__(self, enabled=None, poll_interval=None, max_attempts=None, retention_days=None):
+        if enabled is None:
+            enabled = os.environ.get("DM_EFFECTS_MODE", "inline").lower() == "outbox"
+        self.enabled = enabled
+        self.poll_interval = poll_interval or float(os.environ.get("DM_OUTBOX_POLL_INTERVAL", DEFAULT_POLL_INTERVAL))
+        self.max_attempts = max_attempts or int(os.environ.get("DM_OUTBOX_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS))
+        self.retention_days = retention_days or float(os.environ.get("DM_OUTBOX_RETENTION_DAYS", DEFAULT_RETENTION_DAYS))
+        self.apply = None
+        self.after_commit = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._dispatcher_pid = None
+
+    def ensure_table(self):
+        """Migrate the database, dm_outbox table included (see app/migrations.py)"""
+        ensure_migrated()
+
+    def add(self, session, character_id, effects):
+        """
+        Write the effects of a reply to the outbox in the caller's transaction
+
+        Args:
+            session: Session the AI message is saved and committed in
+            character_id: ID of the character the reply was for
+            effects: TagEffects of the reply, in reply order
+
+        Returns:
+            The new DmOutboxEntry
+        """
+        self.ensure_table()
+        entry = DmOutboxEntry(
+            character_id=character_id,
+            effects=json.dumps([{'kind': e.kind, 'data': e.data, 'tag': e.tag} for e in effects]),
+            status='pending',
+            attempts=0
+        )
+        session.add(entry)
+
+        # Wake the dispatcher as soon as the entry is committed
+        if not session.info.get(LISTENING_KEY):
+            event.listen(session, "after_commit", self._committed)
+            session.info[LISTENING_KEY] = True
+        session.info.setdefault(PENDING_KEY, []).append(entry)
+
+        # A server that forked after create_app has no dispatcher in this process yet
+        if self.apply is not None and self._dispatcher_pid != os.getpid():
+            self.start(self.apply, self.after_commit)
+        return entry
+
+    def attach(self, session, message):
+        """
+        Link the entries added in this session to the AI message they came with
+
+        Args:
+            session: Session passed to add
+            message: The saved AI ChatMessage
+
+        Returns:
+            The entry linked to the message (flushed, so it has an id), or None
+        """
+        entries = [entry for entry in session.info.get(PENDING_KEY, []) if entry.message is None]
+        for entry in entries:
+            entry.message = message
+        if entries:
+            session.flush()
+        return entries[-1] if entries else None
+
+    def _committed(self, session):
+        if session.info.pop(PENDING_KEY, None):
+            self._wake.set()
+
+    def start(self, apply, after_commit=None):
+        """
+        Start the dispatcher thread of this process (once per process)
+
+        Args:
+            apply: Function (session, character_id, effects) -> (notes, extra)
+                applying effects without committing
+            after_commit: Optional function called with extra once the
+                effects are committed
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.apply = apply
+            self.after_commit = after_commit
+            if self._dispatcher_pid == os.getpid():
+                return
+            self._dispatcher_pid = os.getpid()
+        self.ensure_table()
+        threading.Thread(target=self._run, name="dm-outbox-dispatcher", daemon=True).start()
+        print(f"DM outbox dispatcher started (pid {os.getpid()})")
+
+    def _run(self):
+        next_purge = time.monotonic()
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                while self.dispatch_next():
+                    pass
+                if time.monotonic() >= next_purge:
+                    next_purge = time.monotonic() + PURGE_INTERVAL
+                    self.purge()
+            except Exception as e:
+                # Database busy or unavailable: wait and poll again
+                print(f"Error dispatching DM effects: {str(e)}")
+
+    def purge(self, retention_days=None):
+        """Delete entries applied more than retention_days ago
+
+        Returns:
+            Number of entries deleted
+        """
+        self.ensure_table()
+        cutoff = datetime.utcnow() - timedelta(days=retention_days or self.retention_days)
+        expired = and_(outbox_table.c.status == 'done', outbox_table.c.applied_at < cutoff)
+        deleted = 0
+        while True:
+            with engine.begin() as conn:
+                ids = conn.execute(select(outbox_table.c.id).where(expired).limit(PURGE_BATCH_SIZE)).scalars().all()
+                if ids:
+                    conn.execute(delete(outbox_table).where(outbox_table.c.id.in_(ids)))
+            deleted += len(ids)
+            if len(ids) < PURGE_BATCH_SIZE:
+                break
+        if deleted:
+            print(f"Purged {deleted} applied DM outbox entries older than {retention_days or self.retention_days:g} days")
+        return deleted
+
+    def dispatch_next(self):
+        """
+        Apply the next entry that is allowed to run
+
+        Returns:
+            True if an entry was applied, False if none is pending or the one
+            picked failed (the dispatcher then waits before trying again)
+        """
+        self.ensure_table()
+        pending = outbox_table.c.status == 'pending'
+        heads = select(func.min(outbox_table.c.id)).where(pending).group_by(outbox_table.c.character_id)
+        next_entry = (
+            select(outbox_table.c.id)
+            .where(pending, outbox_table.c.id.in_(heads))
+            .order_by(outbox_table.c.id)
+            .limit(1)
+            .scalar_subquery()
+        )
+
+        row = None
+        try:
+            with unit_of_work() as session:
+                # Claiming marks the entry done; a rollback puts it back
+                row = session.execute(
+                    update(outbox_table)
+                    .where(outbox_table.c.id == next_entry, pending)
+                    .values(status='done', attempts=outbox_table.c.attempts + 1)
+                    .returning(outbox_table.c.id, outbox_table.c.character_id,
+                               outbox_table.c.message_id, outbox_table.c.effects)
+                ).first()
+                if row is None:
+                    return False
+
+                effects = [TagEffect(e['kind'], e['data'], e['tag']) for e in json.loads(row.effects)]
+                notes, extra = self.apply(session, row.character_id, effects)
+
+                if notes and row.message_id is not None:
+                    session.execute(
+                        update(ChatMessage)
+                        .where(ChatMessage.id == row.message_id)
+                        .values(content=ChatMessage.content + "\n\n" + "\n\n".join(notes))
+                    )
+                session.execute(
+                    update(outbox_table)
+                    .where(outbox_table.c.id == row.id)
+                    .values(notes=json.dumps(notes), error=None, applied_at=datetime.utcnow())
+                )
+        except Exception as e:
+            if row is None:
+                raise
+            print(f"Error applying DM effects {row.id}, none of them were saved: {str(e)}")
+            traceback.print_exc()
+            self._failed(row.id, str(e))
+            return False
+
+        if self.after_commit:
+            self.after_commit(extra)
+        print(f"Applied DM effects {row.id} for character {row.character_id}")
+        return True
+
+    def _failed(self, entry_id, error):
+        with engine.begin() as conn:
+            attempts = conn.execute(
+                select(outbox_table.c.attempts).where(outbox_table.c.id == entry_id)
+            ).scalar() + 1
+            conn.execute(
+                update(outbox_table)
+                .where(outbox_table.c.id == entry_id)
+                .values(
+                    attempts=attempts,
+                    error=error,
+                    status='failed' if attempts >= self.max_attempts else 'pending'
+                )
+            )
+
+    def get(self, entry_id):
+        """Return an entry as a dictionary, or None if it does not exist"""
+        self.ensure_table()
+        with engine.connect() as conn:
+            row = conn.execute(select(outbox_table).where(outbox_table.c.id == entry_id)).mappings().first()
+        if row is None:
+            return None
+        return {
+            'id': row['id'],
+            'character_id': row['character_id'],
+            'message_id': row['message_id'],
+            'status': row['status'],
+            'attempts': row['attempts'],
+            'notes': json.loads(row['notes']) if row['notes'] else [],
+            'error': row['error'],
+            'created_at': row['created_at'].isoformat() if row['created_at'] else None,
+            'applied_at': row['applied_at'].isoformat() if row['applied_at'] else None,
+            # Time between the reply being saved and its effects being applied
+            'lag_seconds': round((row['applied_at'] - row['created_at']).total_seconds(), 3)
+            if row['applied_at'] and row['created_at'] else None
+        }
+
+
+# Initialize outbox
+dm_outbox = DmOutbox()
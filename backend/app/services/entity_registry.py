@@ -0,0 +1,174 @@
+import threading
+from sqlalchemy import select, insert, func, exists, tuple_, event
+from ..models import Enemy, Move, NPC, enemy_moves
+from ..db import engine
+from ..migrations import ensure_migrated
+from ..utils import name_key
+
+# Tag effect kind -> model it creates (the tag fields are the model's columns)
+ENTITY_MODELS = {"enemy": Enemy, "enemy_move": Move, "npc": NPC}
+
+# Names remembered per model before the map starts over
+MAX_CACHED_NAMES = 10000
+
+# session.info keys
+PENDING_KEY = "entity_registry_pending"
+LISTENING_KEY = "entity_registry_listening"
+
+
+class EntityRegistry:
+    """Enemies, moves and NPCs from DM tags, resolved by normalized name
+
+    The DM keeps reintroducing known foes and allies. Each of their tags used
+    to insert a new row; now a tag only creates an entity whose name_key is
+    not known yet, and a known one keeps the values it was created with.
+    Names this process has already resolved come from an in-memory map, the
+    others from the name_key index, and all the new entities of a kind in a
+    reply are inserted with one statement. Moves are linked through
+    enemy_moves to their enemy in one more statement.
+
+    The map only learns ids when their transaction commits, and forgets
+    entities deleted through the ORM in this process. An entity deleted by
+    another process stays in the map: its name is not recreated (and moves
+    are not linked to it) until this process restarts.
+    """
+
+    def __init__(self, bind=None):
+        self.engine = bind or engine
+        self._ready = False
+        self._lock = threading.Lock()
+        self._ids = {model: {} for model in ENTITY_MODELS.values()}
+
+        for model in ENTITY_MODELS.values():
+            event.listen(model, "after_delete", self._forget)
+
+    def ensure_schema(self):
+        """Migrate the database (name_key columns and lookup indexes, see app/migrations.py)"""
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            ensure_migrated(self.engine)
+            self._ready = True
+
+    def apply(self, session, effects):
+        """
+        Create or reuse the entities of a reply's enemy, enemy_move and npc effects
+
+        Each move is linked to the closest enemy before it in the reply, or to
+        the reply's only enemy if none comes before it. Nothing is committed
+        here.
+
+        Args:
+            session: Session (unit of work) of the reply
+            effects: The reply's entity TagEffects, in reply order
+
+        Returns:
+            Dictionary with the created and reused counts per kind and the
+            number of moves linked
+        """
+        self.ensure_schema()
+        ids = {}
+        summary = {'created': {}, 'reused': {}, 'linked': 0}
+        for kind, model in ENTITY_MODELS.items():
+            rows = {}
+            for effect in effects:
+                key = name_key(effect.data['name'])
+                if effect.kind == kind and key and key not in rows:
+                    rows[key] = dict(effect.data, name_key=key)
+            ids[kind], created = self._resolve(session, model, rows)
+            summary['created'][kind] = created
+            summary['reused'][kind] = len(rows) - created
+
+        summary['linked'] = self._link_moves(session, effects, ids['enemy'], ids['enemy_move'])
+        return summary
+
+    def _resolve(self, session, model, rows):
+        """Ids by name_key of the entities in rows, inserting those that do not exist yet"""
+        if not rows:
+            return {}, 0
+
+        cache = self._ids[model]
+        with self._lock:
+            ids = {key: cache[key] for key in rows if key in cache}
+
+        missing = [key for key in rows if key not in ids]
+        if missing:
+            ids.update(session.execute(
+                select(model.name_key, func.min(model.id))
+                .where(model.name_key.in_(missing))
+                .group_by(model.name_key)
+            ).all())
+
+        new = [rows[key] for key in rows if key not in ids]
+        for key in rows:
+            if key in ids:
+                print(f"{model.__name__} {rows[key]['name']} already exists (id {ids[key]}), reusing it")
+        if new:
+            ids.update((row.name_key, row.id) for row in session.execute(
+                insert(model).returning(model.id, model.name_key), new
+            ))
+            print(f"AI created {model.__name__.lower()}(s): {', '.join(row['name'] for row in new)}")
+
+        self._remember(session, model, ids)
+        return ids, len(new)
+
+    def _link_moves(self, session, effects, enemy_ids, move_ids):
+        """Link moves to their enemy in enemy_moves, skipping links that already exist"""
+        only_enemy = next(iter(enemy_ids.values())) if len(enemy_ids) == 1 else None
+        pairs = set()
+        enemy_id = None
+        for effect in effects:
+            if effect.kind == 'enemy':
+                enemy_id = enemy_ids.get(name_key(effect.data['name']))
+            elif effect.kind == 'enemy_move':
+                owner = enemy_id if enemy_id is not None else only_enemy
+                move_id = move_ids.get(name_key(effect.data['name']))
+                if owner is not None and move_id is not None:
+                    pairs.add((owner, move_id))
+        if not pairs:
+            return 0
+
+        # Selecting the pairs from the tables also drops ids that no longer exist
+        result = session.execute(
+            insert(enemy_moves).from_select(
+                ["enemy_id", "move_id"],
+                select(Enemy.id, Move.id)
+                .join(Move, tuple_(Enemy.id, Move.id).in_(sorted(pairs)))
+                .where(
+                    Enemy.id.in_({enemy for enemy, _ in pairs}),
+                    Move.id.in_({move for _, move in pairs}),
+                    ~exists().where(enemy_moves.c.enemy_id == Enemy.id, enemy_moves.c.move_id == Move.id)
+                )
+            )
+        )
+        return result.rowcount
+
+    def _remember(self, session, model, ids):
+        """Add ids to the in-memory map once the session commits"""
+        if not session.info.get(LISTENING_KEY):
+            event.listen(session, "after_commit", self._commit_pending)
+            event.listen(session, "after_rollback", self._drop_pending)
+            session.info[LISTENING_KEY] = True
+        session.info.setdefault(PENDING_KEY, []).append((model, ids))
+
+    def _commit_pending(self, session):
+        pending = session.info.pop(PENDING_KEY, [])
+        with self._lock:
+            for model, ids in pending:
+                cache = self._ids[model]
+                if len(cache) + len(ids) > MAX_CACHED_NAMES:
+                    cache.clear()
+                cache.update(ids)
+
+    def _drop_pending(self, session):
+        session.info.pop(PENDING_KEY, None)
+
+    def _forget(self, mapper, connection, target):
+        with self._lock:
+            self._ids[mapper.class_].pop(target.name_key, None)
+
+
+# Initialize registry
+entity_registry = EntityRegistry()
@@ -0,0 +1,166 @@
+import os
+import random
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from .rate_governor import rate_governor
+from .model_router import model_router
+
+# Seconds to wait for the TCP/TLS connection to be established
+DEFAULT_CONNECT_TIMEOUT = 3.05
+
+# Seconds to wait between bytes from the server, per type of call.
+# Streaming chat only waits between chunks, so it can be much shorter than a
+# full gpt-4 completion; DALL-E 3 HD renders are the slowest calls we make.
+DEFAULT_READ_TIMEOUTS = {
+    "chat": 90,
+    "chat_stream": 30,
+    "chat_json": 90,
+    "quest": 90,
+    "bio": 45,
+    "summary": 60,
+    "image": 150,
+    "download": 30,
+}
+
+# Connection pool settings (per worker process)
+DEFAULT_POOL_CONNECTIONS = 4   # number of distinct hosts to keep pools for
+DEFAULT_POOL_MAXSIZE = 16      # keep-alive connections kept per host
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    try:
+        return float(value) if value else default
+    except ValueError:
+        print(f"WARNING: ignoring invalid value for {name}: {value}")
+        return default
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    try:
+        return int(value) if value else default
+    except ValueError:
+        print(f"WARNING: ignoring invalid value for {name}: {value}")
+        return default
+
+
+class HTTPTransport:
+    """Shared keep-alive HTTP transport for calls to the OpenAI API
+
+    Every worker process gets its own requests.Session backed by a connection
+    pool, so repeated calls reuse TCP+TLS connections instead of paying a fresh
+    handshake each time. Every call gets a (connect, read) timeout based on its
+    call type, so a hung upstream can no longer pin a worker forever.
+
+    POSTs (the OpenAI API calls) go through the cross-worker rate governor and
+    report their latency and outcome to the model router; GETs (image
+    downloads from the CDN) do neither.
+
+    Settings can be overridden with environment variables:
+        OPENAI_POOL_CONNECTIONS, OPENAI_POOL_MAXSIZE, OPENAI_CONNECT_TIMEOUT,
+        OPENAI_READ_TIMEOUT_<CALL_TYPE> (e.g. OPENAI_READ_TIMEOUT_IMAGE=200)
+    """
+
+    def __init__(self, pool_connections=None, pool_maxsize=None, connect_timeout=None, read_timeouts=None,
+                 governor=rate_governor, router=model_router):
+        self.pool_connections = pool_connections or _env_int("OPENAI_POOL_CONNECTIONS", DEFAULT_POOL_CONNECTIONS)
+        self.pool_maxsize = pool_maxsize or _env_int("OPENAI_POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE)
+        self.connect_timeout = connect_timeout or _env_float("OPENAI_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT)
+
+        self.read_timeouts = {}
+        for call_type, default in DEFAULT_READ_TIMEOUTS.items():
+            self.read_timeouts[call_type] = _env_float(f"OPENAI_READ_TIMEOUT_{call_type.upper()}", default)
+        if read_timeouts:
+            self.read_timeouts.update(read_timeouts)
+
+        self.governor = governor
+        self.router = router
+
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The pooled session for the current process
+
+        Sockets must never be shared across a fork, so a worker that inherited
+        a session from its parent builds a fresh one.
+        """
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._create_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _create_session(self):
+        session = requests.Session()
+        # Retries are handled by the callers (rate limits need backoff), so the
+        # adapter itself never retries
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=0,
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def timeout_for(self, call_type):
+        """Return the (connect, read) timeout tuple for a call type"""
+        read_timeout = self.read_timeouts.get(call_type, self.read_timeouts["chat"])
+        return (self.connect_timeout, read_timeout)
+
+    def post(self, url, call_type="chat", priority=None, **kwargs):
+        """POST through the pooled session using the timeouts for call_type
+
+        Waits for the rate governor first (priority defaults to the class of
+        call_type) and reports the response's rate limit headers back to it.
+        For streamed responses the concurrency slot is held until the headers
+        arrive.
+        """
+        kwargs.setdefault("timeout", self.timeout_for(call_type))
+        if self.governor is None:
+            return self._timed_post(url, call_type, **kwargs)
+
+        with self.governor.slot(call_type, priority):
+            response = self._timed_post(url, call_type, **kwargs)
+        self.governor.observe(call_type, response.status_code, response.headers)
+        return response
+
+    def _timed_post(self, url, call_type, **kwargs):
+        """POST and record latency and outcome for the model in the payload"""
+        started = time.monotonic()
+        try:
+            response = self.session.post(url, **kwargs)
+        except requests.exceptions.RequestException:
+            if self.router is not None:
+                self.router.record(call_type, kwargs.get("json"), time.monotonic() - started, False)
+            raise
+        if self.router is not None:
+            ok = response.status_code != 429 and response.status_code < 500
+            self.router.record(call_type, kwargs.get("json"), time.monotonic() - started, ok)
+        return response
+
+    def get(self, url, call_type="download", **kwargs):
+        """GET through the pooled session using the timeouts for call_type"""
+        kwargs.setdefault("timeout", self.timeout_for(call_type))
+        return self.session.get(url, **kwargs)
+
+    def retry_delay(self, response, retry_count, base_delay=1):
+        """Seconds to wait before retrying a rate-limited call (honors Retry-After)"""
+        if self.governor is None:
+            return (2 ** retry_count) * base_delay + random.uniform(0.1, 0.5)
+        return self.governor.retry_delay(response, retry_count, base_delay)
+
+    def close(self):
+        """Close every pooled connection held by this process"""
+        with self._lock:
+            if self._session is not None and self._pid == os.getpid():
+                self._session.close()
+            self._session = None
+            self._pid = None
@@ -0,0 +1,128 @@
+import threading
+from sqlalchemy import text, select, literal, or_, func, inspect
+from ..models import Item, Inventory
+from ..db import engine
+from ..migrations import ensure_migrated, FTS_TABLE
+from ..utils import name_key
+
+# Trigrams need at least three characters to match
+MIN_FTS_QUERY_LENGTH = 3
+
+
+def _like_escaped(column):
+    """Column expression with its LIKE wildcards escaped (with backslash), to use it as a pattern"""
+    for character in ("\\", "%", "_"):
+        column = func.replace(column, character, "\\" + character)
+    return column
+
+
+class ItemIndex:
+    """Name lookups used to deduplicate items created from DM replies and quest rewards
+
+    An item is "already known" if an existing item has the same normalized
+    name, or a name containing it ("Amulet" finds "Jade Amulet"). The exact
+    check uses the indexed items.name_key column; the containment check uses
+    an FTS5 trigram table kept in sync by triggers (see app/migrations.py),
+    so neither scans the items table. Without FTS5 (older SQLite builds, other databases) the
+    containment check falls back to a LIKE on name_key, which PostgreSQL
+    answers from a pg_trgm index and other databases by scanning.
+    """
+
+    def __init__(self, bind=None):
+        self.engine = bind or engine
+        self._ready = False
+        self._lock = threading.Lock()
+        self.fts = False
+
+    def ensure_schema(self):
+        """Migrate the database (name_key, lookup indexes, FTS table) and check whether FTS is available"""
+        if self._ready:
+            return
+        with self._lock:
+            if self._ready:
+                return
+            ensure_migrated(self.engine)
+            # Migration 4 skips the FTS table when SQLite lacks FTS5
+            self.fts = self.engine.dialect.name == "sqlite" and inspect(self.engine).has_table(FTS_TABLE)
+            self._ready = True
+
+    def find_exact(self, session, name):
+        """All items whose normalized name equals that of name"""
+        self.ensure_schema()
+        return session.query(Item).filter(Item.name_key == name_key(name)).order_by(Item.id).all()
+
+    def find_similar(self, session, name):
+        """
+        Find an existing item matching a new item's name
+
+        Args:
+            session: Session to query (pending items in it are flushed and found)
+            name: Name of the new item
+
+        Returns:
+            The item with the same normalized name if there is one, otherwise
+            the oldest item whose name contains it, or None
+        """
+        self.ensure_schema()
+        key = name_key(name)
+        if not key:
+            return None
+
+        # Ids first, so at most one Item is loaded
+        item_id = session.execute(
+            select(Item.id).where(Item.name_key == key).order_by(Item.id).limit(1)
+        ).scalar()
+
+        if item_id is None and self.fts and len(key) >= MIN_FTS_QUERY_LENGTH:
+            # A quoted string is matched as a substring by the trigram tokenizer
+            item_id = session.execute(
+                text(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :query LIMIT 1"),
+                {"query": '"' + key.replace('"', '""') + '"'}
+            ).scalar()
+        elif item_id is None:
+            pattern = "%" + key.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            item_id = session.execute(
+                select(Item.id).where(Item.name_key.like(pattern, escape="\\")).order_by(Item.id).limit(1)
+            ).scalar()
+
+        return session.get(Item, item_id) if item_id is not None else None
+
+    def find_owned(self, session, character_id, name):
+        """
+        Find an item in a character's inventory similar to name, in one query
+
+        Similar means either normalized name contains the other, so buying
+        "Rope" matches an owned "Coil of Rope" and buying "Jade Amulet of
+        Tlaloc" matches an owned "Jade Amulet".
+
+        Args:
+            session: Session to query
+            character_id: ID of the character whose inventory is searched
+            name: Name of the item
+
+        Returns:
+            The first owned item that matches, or None
+        """
+        self.ensure_schema()
+        key = name_key(name)
+        if not key:
+            return None
+
+        return session.execute(
+            select(Item)
+            .join(Inventory, Inventory.item_id == Item.id)
+            .where(
+                Inventory.character_id == character_id,
+                Item.name_key != "",
+                or_(
+                    Item.name_key.contains(key, autoescape=True),
+                    literal(key).contains(_like_escaped(Item.name_key), escape="\\")
+                )
+            )
+            .order_by(Inventory.id)
+            .limit(1)
+        ).scalar()
+
+
+# Initialize service
+item_index = ItemIndex()
@@ -0,0 +1,217 @@
+import os
+import time
+import threading
+from collections import deque
+
+# Model choices per call type, in order of preference. Each entry holds the
+# request parameters that depend on the model. Bios, quest JSON and summaries
+# are short, structured outputs that a small model writes well and fast.
+DEFAULT_ROUTES = {
+    "chat": [
+        {"model": "gpt-4", "max_tokens": 500},
+        {"model": "gpt-4o-mini", "max_tokens": 500},
+    ],
+    # Structured DM replies: strict JSON schemas need gpt-4o or newer
+    "chat_json": [
+        {"model": "gpt-4o", "max_tokens": 700},
+        {"model": "gpt-4o-mini", "max_tokens": 700},
+    ],
+    "quest": [
+        {"model": "gpt-4o-mini", "max_tokens": 800},
+        {"model": "gpt-4", "max_tokens": 800},
+    ],
+    "bio": [
+        {"model": "gpt-4o-mini", "max_tokens": 200},
+        {"model": "gpt-4", "max_tokens": 200},
+    ],
+    "summary": [
+        {"model": "gpt-4o-mini", "max_tokens": 400},
+        {"model": "gpt-4", "max_tokens": 400},
+    ],
+    "image": [
+        {"model": "dall-e-3", "size": "1024x1024", "quality": "hd"},
+        {"model": "dall-e-3", "size": "1024x1024", "quality": "standard"},
+        {"model": "dall-e-2", "size": "1024x1024"},
+    ],
+}
+
+# Streaming chat shares the chat routes (and their health)
+ROUTE_ALIASES = {"chat_stream": "chat"}
+
+# A route is unhealthy when its p95 latency (seconds) or error rate crosses these
+DEFAULT_P95_THRESHOLDS = {
+    "chat": 20,
+    "chat_json": 20,
+    "quest": 30,
+    "bio": 10,
+    "summary": 30,
+    "image": 90,
+}
+DEFAULT_ERROR_RATE_THRESHOLD = 0.25
+
+# Outcomes kept per route, and how old they may be (seconds)
+WINDOW_SIZE = 50
+WINDOW_SECONDS = 300
+
+# Outcomes needed before a route can be judged unhealthy
+MIN_SAMPLES = 5
+
+# Seconds between trial requests sent to an unhealthy preferred route
+PROBE_INTERVAL = 30
+
+
+def _route_key(route):
+    return (route["model"], route.get("quality"))
+
+
+def _route_name(route):
+    return route["model"] + (f"/{route['quality']}" if route.get("quality") else "")
+
+
+class ModelRouter:
+    """Picks the model and its parameters for each type of OpenAI call
+
+    Every call type has an ordered list of routes. Latency and success of
+    each route are tracked over a rolling window (per worker process); when
+    the p95 latency or the error rate of a route crosses the threshold of its
+    call type, calls fail over to the next healthy route. An unhealthy
+    preferred route gets a trial request every PROBE_INTERVAL seconds; a fast,
+    successful trial clears its window so it takes traffic again.
+
+    Settings can be overridden with environment variables:
+        OPENAI_MODEL_<CALL_TYPE>=model[,fallback,...] (e.g. OPENAI_MODEL_BIO=gpt-4o-mini,gpt-4),
+        OPENAI_P95_<CALL_TYPE> in seconds, OPENAI_MAX_ERROR_RATE
+    """
+
+    def __init__(self, routes=None):
+        self.routes = {}
+        for call_type, default_routes in (routes or DEFAULT_ROUTES).items():
+            self.routes[call_type] = self._routes_from_env(call_type, default_routes)
+
+        self.p95_thresholds = {
+            call_type: float(os.environ.get(f"OPENAI_P95_{call_type.upper()}", default))
+            for call_type, default in DEFAULT_P95_THRESHOLDS.items()
+        }
+        self.error_rate_threshold = float(os.environ.get("OPENAI_MAX_ERROR_RATE", DEFAULT_ERROR_RATE_THRESHOLD))
+
+        self._samples = {}
+        self._last_probe = {}
+        self._probing = set()
+        self._lock = threading.Lock()
+
+    def _routes_from_env(self, call_type, default_routes):
+        value = os.environ.get(f"OPENAI_MODEL_{call_type.upper()}")
+        if not value:
+            return [dict(route) for route in default_routes]
+
+        # Keep the default parameters of known models, copy the first route's otherwise
+        routes = []
+        for model in [name.strip() for name in value.split(",") if name.strip()]:
+            known = next((route for route in default_routes if route["model"] == model), None)
+            routes.append(dict(known) if known else dict(default_routes[0], model=model))
+        return routes
+
+    def _table(self, call_type):
+        return ROUTE_ALIASES.get(call_type, call_type)
+
+    def _health(self, table, route, now):
+        """(healthy, p95 seconds, error rate, samples) of a route"""
+        samples = self._samples.get((table, _route_key(route)))
+        if not samples:
+            return True, None, None, 0
+
+        while samples and now - samples[0][0] > WINDOW_SECONDS:
+            samples.popleft()
+        if len(samples) < MIN_SAMPLES:
+            return True, None, None, len(samples)
+
+        latencies = sorted(latency for _, latency, ok in samples if ok)
+        errors = sum(1 for _, _, ok in samples if not ok)
+        error_rate = errors / len(samples)
+        p95 = latencies[max(0, int(round(len(latencies) * 0.95)) - 1)] if latencies else None
+
+        healthy = error_rate <= self.error_rate_threshold and (
+            p95 is None or p95 <= self.p95_thresholds.get(table, float("inf"))
+        )
+        return healthy, p95, error_rate, len(samples)
+
+    def candidates(self, call_type):
+        """Routes for a call type, best first"""
+        table = self._table(call_type)
+        routes = self.routes.get(table)
+        if not routes:
+            raise KeyError(f"No model route for call type '{call_type}'")
+
+        now = time.monotonic()
+        with self._lock:
+            healthy = []
+            unhealthy = []
+            for route in routes:
+                (healthy if self._health(table, route, now)[0] else unhealthy).append(route)
+
+            # Let a preferred route that went bad take one trial request now and then
+            if unhealthy and unhealthy[0] is routes[0]:
+                key = (table, _route_key(routes[0]))
+                if now - self._last_probe.get(key, 0) >= PROBE_INTERVAL:
+                    self._last_probe[key] = now
+                    self._probing.add(key)
+                    return [dict(route) for route in [routes[0]] + healthy + unhealthy[1:]]
+
+        return [dict(route) for route in healthy + unhealthy]
+
+    def params(self, call_type):
+        """Model parameters (model, max_tokens / size and quality) for the next call"""
+        return self.candidates(call_type)[0]
+
+    def fallback(self, call_type, current):
+        """The next route after `current` (e.g. after a 429 or an overloaded model), or None"""
+        routes = self.candidates(call_type)
+        keys = [_route_key(route) for route in routes]
+        key = _route_key(current)
+        if key not in keys:
+            return routes[0]
+        index = keys.index(key)
+        return routes[index + 1] if index + 1 < len(routes) else None
+
+    def record(self, call_type, params, latency, ok):
+        """Record the outcome of a call made with the parameters of a route
+
+        Args:
+            call_type: Type of call
+            params: Request payload (only the model and quality are used)
+            latency: Seconds until the response (headers) arrived
+            ok: False for network errors, 429s and 5xx responses
+        """
+        table = self._table(call_type)
+        if table not in self.routes or not params or "model" not in params:
+            return
+        key = (table, _route_key(params))
+        with self._lock:
+            samples = self._samples.setdefault(key, deque(maxlen=WINDOW_SIZE))
+            if key in self._probing:
+                self._probing.discard(key)
+                if ok and latency <= self.p95_thresholds.get(table, float("inf")):
+                    samples.clear()
+            samples.append((time.monotonic(), latency, ok))
+
+    def stats(self):
+        """Health of every route, in order of preference"""
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for table, routes in self.routes.items():
+                result[table] = []
+                for route in routes:
+                    healthy, p95, error_rate, samples = self._health(table, route, now)
+                    result[table].append({
+                        "route": _route_name(route),
+                        "healthy": healthy,
+                        "p95_seconds": round(p95, 3) if p95 is not None else None,
+                        "error_rate": round(error_rate, 3) if error_rate is not None else None,
+                        "samples": samples,
+                    })
+        return result
+
+
+# Initialize router
+model_router = ModelRouter()
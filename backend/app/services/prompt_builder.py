@@ -0,0 +1,294 @@
+import hashlib
+import threading
+import time
+from .tag_parser import TAG_SPECS
+
+# Static Dungeon Master rules. They never depend on the character, so they are
+# compiled once and always sent as the first system message: OpenAI caches long
+# prompt prefixes that repeat exactly, which makes every later turn cheaper.
+DM_RULES = """You are the Dungeon Master (DM) of *Emerald Altar*, a fantasy RPG set in 1920s Mexico City, blending Mesoamerican mythology, political unrest, and supernatural horror.
+
+WORLD SETTING:
+Your first message should always set the scene with a vivid description of where the character finds themselves in Mexico City. The city is vast and true to its actual size, with distinct neighborhoods, landmarks, and supernatural hotspots. The metropolitan landscape is experiencing supernatural phenomena due to the cursed emerald being removed from its altar.
+
+PRIMARY ANTAGONISTS:
+The "Obsidian Circle" is a dark occult faction actively working to prevent the emerald from being returned to its altar. They believe the chaos and death unleashed by the curses will "purify" the world and usher in a new era of power. They are organized, dangerous, and have infiltrated various levels of society. Their agents include both humans and supernatural entities.
+
+You are responsible for managing:
+1. Combat encounters using D&D-style rules: Use d20 rolls for attacks and checks, and d4-d12 rolls for damage or effects.
+2. Armor class checks: Determine whether attacks hit or miss based on the player's AC.
+3. Status effects: Apply conditions like poisoned, cursed, or bleeding as needed.
+4. Map generation: You can create new areas, dungeons, or landmarks and post them to the database for later reference.
+5. Quest generation: Create multi-step quests with objectives, rewards, and narrative arcs, optionally posting them to the database.
+6. NPC creation: Design characters with goals, backgrounds, and stats. They can assist or oppose the player and persist across sessions.
+7. Item generation: Create usable, equipable, or lore-relevant items with names, descriptions, rarity, and stats. Each item will be visualized in high-quality 16-bit pixel art style with fine details, not simple 8-bit graphics.
+8. Database awareness: You can refer back to any characters, quests, items, or maps previously generated or stored.
+9. Story progression: You understand the overall plot of *Emerald Altar*, including the cursed emerald, spreading miasma, and citywide transformation.
+
+COMBAT AND DAMAGE SYSTEM:
+When in combat, calculate damage using these guidelines:
+- Weak enemies: 1-4 damage per hit
+- Standard enemies: 3-8 damage per hit
+- Strong enemies: 6-12 damage per hit
+- Boss enemies: 10-20 damage per hit
+
+Always track all damage in the battle with these tag patterns:
+- When a player takes damage: [DAMAGE:Amount|Source] (e.g., [DAMAGE:7|Cultist's dagger])
+- When a player deals damage: [DAMAGE_DEALT:Amount|Target] (e.g., [DAMAGE_DEALT:12|Zombie cultist])
+- When a player heals: [HEALING:Amount|Source] (e.g., [HEALING:10|Healing potion])
+
+EXPLICITLY note all damage dealt to and by the player in your narration, then include the appropriate tag to update the character stats. 
+Always report combat actions in detail, describing how much damage was dealt, by whom, and to whom.
+
+MANA AND MP SYSTEM:
+For spell casting and special abilities, track the MP cost:
+- When a player uses MP: [MP_USED:Amount|Source] (e.g., [MP_USED:15|Fireball spell])
+- Each class has different MP costs for their abilities
+- Basic abilities cost 5-10 MP
+- Intermediate abilities cost 15-25 MP
+- Advanced abilities cost 30-50 MP
+
+Always consider:
+- Character's armor class for hit probability
+- Character's attributes for damage modifiers
+- Environmental factors that might increase or decrease damage
+- Character's remaining MP for spell casting
+
+If the player's HP reaches 0, they become unconscious but not dead. Make this clear in your narration.
+If the player tries to use an ability with insufficient MP, inform them they cannot perform the action without enough magical energy.
+
+ITEMS AND EQUIPMENT:
+When creating items, be aware of these categories:
+- Weapons: Swords, daggers, axes, bows, pistols, etc. for combat
+- Armor: Protective gear that increases armor class
+- Trinkets: Small magic items that provide minor bonuses
+- Necklaces: Worn items that often provide magical benefits
+- Helms: Headgear that can boost intelligence or wisdom
+- Accessories: Rings, gloves, and other worn items
+- Consumables: Potions, scrolls, or food items that are used once
+- Key items: Items that pertain to quests, story line, reveal clues or are necessary for a later issue - for instance a puzzle that needs to be solved.
+
+Items in the first six categories (weapons, armor, trinkets, necklaces, helms, accessories) are equippable. Players can equip them to gain their benefits. Equippable items should provide stat bonuses or special abilities.
+
+SKILL CHECKS & ENCOUNTERS:
+Frequently challenge the player with:
+- Perception checks to notice hidden details, traps, or supernatural phenomena
+- Wisdom checks to sense motives, resist manipulation, or commune with spirits
+- Intelligence checks to decipher glyphs, understand occult rituals, or recall lore
+- Surprise combat encounters that test the player's adaptability
+- Moral dilemmas related to the Obsidian Circle's activities and victims
+
+CREATING ENEMIES AND NPCS:
+When you create a new enemy or NPC during the game, you should add them to the database by using special tags:
+
+For enemies:
+[ENEMY:Name|Description|Lore Description|HP|MP|AC|STR|DEX|SPD|WIS|INT|CON|CHA|INIT]
+
+For enemy moves:
+[ENEMY_MOVE:Name|Description|Lore Description|Damage|Mana Cost|Status Effect|Condition]
+
+For NPCs:
+[NPC:Name|Description|Lore Description|Role|Affiliation]
+
+Place these tags at the end of your message, after describing the entity to the player in narrative form. Put the [ENEMY_MOVE] tags of an enemy right after its [ENEMY] tag. Reuse the exact name when an enemy or NPC the player has met appears again.
+
+THEMES & STYLE:
+- Evoke the atmosphere of post-revolutionary Mexico with mythic and supernatural elements.
+- Avoid modern language or technology.
+- Use rich, immersive language rooted in Mesoamerican imagery and folklore.
+- You can describe the outcome of dice rolls and prompt the player to roll or continue.
+
+FORMAT:
+- Speak in-character as the DM.
+- Offer player choices and actions when appropriate.
+- Respond with clarity and tone that sustains immersion.
+
+Your purpose is to facilitate an unforgettable RPG experience through dynamic, engaging narration and systems mastery."""
+
+# Used when there is no character to play with
+GENERIC_DM_RULES = "You are the dungeon master of a fantasy RPG game. Guide the player with immersive responses and creative prompts."
+
+# How the DM reports game effects; parsed by OpenAIService._process_tags
+TAG_INSTRUCTIONS = (
+    "ITEM GIVING: When you want to give an item to the player, describe it in the narrative, then add a special tag at the end of your message with the format: [ITEM:Name|Type|Effect Description]. The effect description should be a functional description of what the item does. When creating items, always make them interesting and thematic to Mesoamerican mythology and the game world. The item will be visualized as detailed 16-bit pixel art.",
+    "TRANSACTIONS: When the player purchases something, make sure to deduct the money from their wealth. Add a special tag with this format: [TRANSACTION:Amount|Description]. For example: [TRANSACTION:10|Purchase of leather boots]. Consider character's wealth before allowing expensive purchases.",
+    "DAMAGE: When the character takes damage in combat or from environmental hazards, add a damage tag at the end of your message: [DAMAGE:Amount|Source]. For example: [DAMAGE:5|Goblin attack]. Similarly, for healing: [HEALING:Amount|Source].",
+    "DAMAGE DEALT: When the character deals damage to enemies, ALWAYS add a damage dealt tag: [DAMAGE_DEALT:Amount|Target]. For example: [DAMAGE_DEALT:8|Goblin warrior]. Make sure to explicitly state all damage numbers in your narration.",
+    "MANA USAGE: Whenever the character uses a spell, ability, or any action that consumes mana or magical energy, add a mana usage tag: [MP_USED:Amount|Source]. For example: [MP_USED:15|Fireball spell]. Make sure to track the character's MP and don't allow them to cast spells if they have insufficient MP.",
+)
+
+# Appended in structured output mode, where effects come back as JSON (see structured_output.py)
+STRUCTURED_OUTPUT_INSTRUCTION = (
+    "OUTPUT FORMAT: Reply with a JSON object with two fields. \"narrative\" is the text the player reads and must "
+    "never contain bracket tags. \"effects\" lists the game effects of this turn in the order they happen, and is "
+    "empty when nothing happens. Every tag described above becomes one effect instead, with its fields as named "
+    "properties: " + "; ".join(
+        f"[{name}] -> {{\"effect\": \"{spec.kind}\", " + ", ".join(f"\"{field}\"" for field in spec.fields) + "}"
+        for name, spec in TAG_SPECS.items()
+    ) + "."
+)
+
+FIRST_MESSAGE_INSTRUCTION = "This is the first message in the conversation. Begin by describing the current setting in Mexico City where the character finds themselves. Create a vivid, detailed scene that establishes the mood, nearby landmarks, time of day, weather, and any supernatural phenomena that might be occurring. Then prompt the character to decide what they want to do next."
+
+FIRST_MESSAGE_PROMPT = "I'm ready to begin my adventure. Where do I find myself?"
+
+
+def compile_prefix(rules, structured=False):
+    """Join the rules and the tag instructions (plus the JSON output format) into the static system message"""
+    return "\n\n".join((rules,) + TAG_INSTRUCTIONS + ((STRUCTURED_OUTPUT_INSTRUCTION,) if structured else ()))
+
+
+def prefix_hash(prefix):
+    """Short fingerprint of a prompt prefix, to check that it stays the same"""
+    return hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:16]
+
+
+class PromptBuilder:
+    """Assembles the message list sent to the model for a DM turn
+
+    Message layout, most stable first:
+        1. system: DM rules and tag instructions (compiled once, cacheable upstream)
+        2. system: compact stat block of the character (plus the opening-scene
+           instruction on the first turn)
+        3. system: summary of older turns, when there is one
+        4. the recent chat history
+
+    The builder keeps counters on assembly time, on the prefixes it sent and
+    on the cached prompt tokens OpenAI reports, see stats().
+    """
+
+    def __init__(self):
+        self.dm_prefix = compile_prefix(DM_RULES)
+        self.generic_prefix = compile_prefix(GENERIC_DM_RULES)
+        self.dm_structured_prefix = compile_prefix(DM_RULES, structured=True)
+        self._known_hashes = {
+            prefix: prefix_hash(prefix)
+            for prefix in (self.dm_prefix, self.generic_prefix, self.dm_structured_prefix)
+        }
+
+        self._lock = threading.Lock()
+        self._builds = 0
+        self._build_seconds = 0.0
+        self._max_build_seconds = 0.0
+        self._prefix_counts = {}
+        self._usage_requests = 0
+        self._prompt_tokens = 0
+        self._cached_tokens = 0
+
+    def character_block(self, character):
+        """Compact per-character stat block"""
+        class_ = character.class_ if getattr(character, 'class_', None) else None
+        class_name = class_.name if class_ else 'Unknown'
+        max_hp = class_.hp if class_ else 100
+        max_mp = class_.mp if class_ else 100
+
+        return (
+            f"CURRENT PLAYER: {character.name}, a {character.race} {class_name if class_ else ''}".rstrip() + "\n"
+            f"Level {int(character.exp / 100) + 1} | HP {character.hp_status}/{max_hp} | "
+            f"MP {character.mp_status}/{max_mp} | Money {character.money} pesos\n"
+            f"Background: {character.description if character.description else 'Unknown'}"
+        )
+
+    def build(self, messages, character=None, system_prompt=None, summary=None, structured=False):
+        """Build the OpenAI message list for a DM turn
+
+        Args:
+            messages: List of message dictionaries with 'content' and 'is_user' keys
+            character: Character object with information about the player character
+            system_prompt: Custom rules replacing the DM rules (tag instructions are kept)
+            summary: Optional summary of the turns older than messages
+            structured: Ask for the JSON output format instead of tags
+
+        Returns:
+            List of OpenAI chat messages
+        """
+        start = time.perf_counter()
+
+        if system_prompt:
+            prefix = compile_prefix(system_prompt, structured)
+        elif character:
+            prefix = self.dm_structured_prefix if structured else self.dm_prefix
+        else:
+            prefix = self.generic_prefix
+
+        formatted_messages = [{"role": "system", "content": prefix}]
+
+        # Check if this is the first message (no chat history)
+        is_first_message = not summary and (len(messages) == 0 or (len(messages) == 1 and messages[0].get('is_user', True)))
+
+        # Everything that changes from turn to turn comes after the static prefix
+        turn_context = []
+        if character:
+            turn_context.append(self.character_block(character))
+        if is_first_message:
+            turn_context.append(FIRST_MESSAGE_INSTRUCTION)
+        if turn_context:
+            formatted_messages.append({"role": "system", "content": "\n\n".join(turn_context)})
+
+        # Older turns that no longer fit in the context are replaced by their summary
+        if summary:
+            formatted_messages.append({
+                "role": "system",
+                "content": f"STORY SO FAR (summary of the earlier conversation with this player):\n{summary}"
+            })
+
+        # Add chat history
+        for msg in messages:
+            role = "user" if msg.get('is_user', True) else "assistant"
+            formatted_messages.append({
+                "role": role,
+                "content": msg.get('content', '')
+            })
+
+        # If there's no user message yet, add a default one
+        if is_first_message and not messages:
+            formatted_messages.append({
+                "role": "user",
+                "content": FIRST_MESSAGE_PROMPT
+            })
+
+        elapsed = time.perf_counter() - start
+        fingerprint = self._known_hashes.get(prefix) or prefix_hash(prefix)
+        with self._lock:
+            self._builds += 1
+            self._build_seconds += elapsed
+            self._max_build_seconds = max(self._max_build_seconds, elapsed)
+            self._prefix_counts[fingerprint] = self._prefix_counts.get(fingerprint, 0) + 1
+
+        return formatted_messages
+
+    def record_usage(self, usage):
+        """Record the token usage of a chat completion, including cached prompt tokens"""
+        if not usage:
+            return
+        details = usage.get('prompt_tokens_details') or {}
+        with self._lock:
+            self._usage_requests += 1
+            self._prompt_tokens += usage.get('prompt_tokens', 0)
+            self._cached_tokens += details.get('cached_tokens', 0)
+
+    def stats(self):
+        """Assembly time, prefix stability and upstream cache usage since start"""
+        with self._lock:
+            builds = self._builds
+            dm_hash = self._known_hashes[self.dm_prefix]
+            return {
+                'builds': builds,
+                'avg_assembly_ms': round(self._build_seconds / builds * 1000, 4) if builds else None,
+                'max_assembly_ms': round(self._max_build_seconds * 1000, 4) if builds else None,
+                'dm_prefix_hash': dm_hash,
+                'dm_prefix_chars': len(self.dm_prefix),
+                # Share of DM turns that started with the compiled DM prefix
+                'dm_prefix_share': round(self._prefix_counts.get(dm_hash, 0) / builds, 4) if builds else None,
+                'prefixes': dict(self._prefix_counts),
+                'upstream': {
+                    'requests': self._usage_requests,
+                    'prompt_tokens': self._prompt_tokens,
+                    'cached_tokens': self._cached_tokens,
+                    'cached_ratio': round(self._cached_tokens / self._prompt_tokens, 4) if self._prompt_tokens else None
+                }
+            }
+
+
+# Initialize builder
+prompt_builder = PromptBuilder()
@@ -0,0 +1,177 @@
+import os
+import json
+import threading
+from datetime import datetime
+from sqlalchemy import select, delete, func, and_
+from ..models import PooledQuest
+from ..db import engine
+from ..migrations import ensure_migrated
+from ..jobs import job_queue
+
+# Quests kept ready per (difficulty, quest type, level band): a refill is queued
+# when a pool drops below the low watermark and fills it up to the high one
+DEFAULT_LOW_WATERMARK = 2
+DEFAULT_HIGH_WATERMARK = 5
+
+# Character levels per band; quests are generated for the middle level of a band
+DEFAULT_LEVEL_BAND_SIZE = 5
+
+# Only these values are pooled, anything else is generated live so arbitrary
+# request parameters cannot create pools that never get used
+POOLED_DIFFICULTIES = ("easy", "medium", "hard")
+POOLED_QUEST_TYPES = ("random", "combat", "exploration", "puzzle")
+
+# Pools filled when the workers start: every difficulty for low level characters
+WARM_KEYS = [(difficulty, "random", 0) for difficulty in POOLED_DIFFICULTIES]
+
+pool_table = PooledQuest.__table__
+
+
+class QuestPool:
+    """Pre-generated quests, so asking for a quest does not wait for OpenAI
+
+    Quests only depend on the difficulty, the quest type and the character's
+    level, so they are generated ahead of time by the refill_quest_pool
+    background job, keyed by (difficulty, quest_type, level band). Taking a
+    quest removes it from the pool in the same transaction that binds it to
+    the character; routes fall back to live generation when the pool is empty.
+
+    Settings can be overridden with environment variables:
+        QUEST_POOL_LOW, QUEST_POOL_HIGH, QUEST_POOL_LEVEL_BAND
+    """
+
+    def __init__(self, low_watermark=None, high_watermark=None, level_band_size=None):
+        self.low_watermark = low_watermark or int(os.environ.get("QUEST_POOL_LOW", DEFAULT_LOW_WATERMARK))
+        self.high_watermark = high_watermark or int(os.environ.get("QUEST_POOL_HIGH", DEFAULT_HIGH_WATERMARK))
+        self.level_band_size = level_band_size or int(os.environ.get("QUEST_POOL_LEVEL_BAND", DEFAULT_LEVEL_BAND_SIZE))
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def ensure_table(self):
+        """Migrate the database, quest_pool table included (see app/migrations.py)"""
+        ensure_migrated()
+
+    def level_band(self, character):
+        """Level band of a character (0 for levels 1-5 with the default band size)"""
+        level = int(character.exp / 100) + 1 if character else 1
+        return (level - 1) // self.level_band_size
+
+    def band_level(self, level_band):
+        """Character level quests of a band are generated for"""
+        return level_band * self.level_band_size + (self.level_band_size + 1) // 2
+
+    def key(self, character, difficulty, quest_type):
+        """Pool key for a request, or None if quests with these parameters are not pooled"""
+        difficulty = (difficulty or "medium").lower()
+        quest_type = (quest_type or "random").lower()
+        if difficulty not in POOLED_DIFFICULTIES or quest_type not in POOLED_QUEST_TYPES:
+            return None
+        return difficulty, quest_type, self.level_band(character)
+
+    def _where(self, key):
+        difficulty, quest_type, level_band = key
+        return and_(
+            pool_table.c.difficulty == difficulty,
+            pool_table.c.quest_type == quest_type,
+            pool_table.c.level_band == level_band
+        )
+
+    def take(self, session, key):
+        """Remove the oldest quest of a pool as part of the session's transaction
+
+        The caller binds the quest to its character and commits; if that fails
+        the rollback puts the quest back.
+
+        Returns:
+            Quest data dictionary, or None if the pool is empty
+        """
+        self.ensure_table()
+        oldest = (
+            select(pool_table.c.id)
+            .where(self._where(key))
+            .order_by(pool_table.c.id)
+            .limit(1)
+            .scalar_subquery()
+        )
+        row = session.execute(
+            delete(pool_table)
+            .where(pool_table.c.id == oldest)
+            .returning(pool_table.c.quest_data)
+        ).first()
+
+        with self._lock:
+            if row is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return json.loads(row.quest_data) if row else None
+
+    def depth(self, key):
+        """Number of quests ready in a pool"""
+        self.ensure_table()
+        with engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(pool_table).where(self._where(key))).scalar()
+
+    def add(self, key, quest_data):
+        """Store a generated quest in a pool"""
+        self.ensure_table()
+        difficulty, quest_type, level_band = key
+        with engine.begin() as conn:
+            conn.execute(pool_table.insert().values(
+                difficulty=difficulty,
+                quest_type=quest_type,
+                level_band=level_band,
+                quest_data=json.dumps(quest_data),
+                created_at=datetime.utcnow()
+            ))
+
+    def schedule_refill(self, key):
+        """Queue a refill of a pool if it is below the low watermark
+
+        Call this after the request's transaction has committed.
+        """
+        try:
+            if self.depth(key) >= self.low_watermark:
+                return
+            difficulty, quest_type, level_band = key
+            job_queue.enqueue(
+                'refill_quest_pool',
+                {'difficulty': difficulty, 'quest_type': quest_type, 'level_band': level_band},
+                dedupe_key=f"{difficulty}:{quest_type}:{level_band}"
+            )
+        except Exception as e:
+            # Requests keep falling back to live generation until a refill succeeds
+            print(f"Error queueing quest pool refill for {key}: {str(e)}")
+
+    def warm(self, keys=None):
+        """Queue refills for the pools that should be ready before the first request"""
+        for key in keys or WARM_KEYS:
+            self.schedule_refill(key)
+
+    def stats(self):
+        """Pool depths and the share of quests served from the pool by this process"""
+        self.ensure_table()
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select(pool_table.c.difficulty, pool_table.c.quest_type, pool_table.c.level_band, func.count())
+                .group_by(pool_table.c.difficulty, pool_table.c.quest_type, pool_table.c.level_band)
+            ).all()
+
+        with self._lock:
+            hits, misses = self._hits, self._misses
+        return {
+            'pools': [
+                {'difficulty': difficulty, 'quest_type': quest_type, 'level_band': level_band, 'ready': count}
+                for difficulty, quest_type, level_band, count in rows
+            ],
+            'low_watermark': self.low_watermark,
+            'high_watermark': self.high_watermark,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None
+        }
+
+
+# Initialize pool
+quest_pool = QuestPool()
@@ -0,0 +1,393 @@
+import os
+import re
+import time
+import random
+import sqlite3
+import asyncio
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Priority classes, most urgent first. Interactive chat may use the whole
+# budget; lower classes leave a reserve so a player is never stuck behind a
+# queue of background renders.
+INTERACTIVE = 0
+STANDARD = 1
+BACKGROUND = 2
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", STANDARD: "standard", BACKGROUND: "background"}
+
+# Share of the bucket and of the concurrency slots each class must leave free
+PRIORITY_RESERVE = {INTERACTIVE: 0.0, STANDARD: 0.2, BACKGROUND: 0.4}
+
+# Seconds a caller of each class waits for its turn before giving up
+PRIORITY_MAX_WAIT = {INTERACTIVE: 30, STANDARD: 90, BACKGROUND: 300}
+
+# Upstream limit family and priority class of every call type
+CALL_TYPES = {
+    "chat": ("chat", INTERACTIVE),
+    "chat_stream": ("chat", INTERACTIVE),
+    "chat_json": ("chat", INTERACTIVE),
+    "quest": ("chat", STANDARD),
+    "summary": ("chat", BACKGROUND),
+    "bio": ("chat", BACKGROUND),
+    "image": ("image", BACKGROUND),
+}
+
+# Requests per minute and concurrent requests per limit family, across all workers
+DEFAULT_LIMITS = {
+    "chat": {"rpm": 500, "concurrency": 16},
+    "image": {"rpm": 7, "concurrency": 4},
+}
+
+# Seconds of burst a bucket can hold
+BURST_SECONDS = 10
+
+# Seconds after which the slot of a crashed caller is reclaimed
+LEASE_TTL = 300
+
+# Stop sending when the upstream token budget drops below this
+MIN_UPSTREAM_TOKENS = 1000
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value):
+    """Parse OpenAI reset durations ('20ms', '1.5s', '6m0s') or plain seconds"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a call waited longer than its priority class allows"""
+
+
+class RateGovernor:
+    """Outbound rate and concurrency limiter shared by every worker process
+
+    Each limit family (chat completions, image generations) has a token bucket
+    refilled at its requests-per-minute rate, a cap on concurrent requests and
+    a "blocked until" time. The state lives in a small SQLite file, so all
+    gunicorn and job workers on the host draw from the same budget instead of
+    stampeding the API independently.
+
+    Upstream feedback is shared too: a 429 with Retry-After, or rate limit
+    headers saying the budget is spent, pause the whole family for every
+    worker until the reset time.
+
+    Settings can be overridden with environment variables:
+        OPENAI_GOVERNOR_DB, OPENAI_<FAMILY>_RPM, OPENAI_<FAMILY>_CONCURRENCY
+        (e.g. OPENAI_IMAGE_RPM=5), OPENAI_GOVERNOR=off to disable
+    """
+
+    def __init__(self, path=None, limits=None):
+        self.path = path or os.environ.get(
+            "OPENAI_GOVERNOR_DB",
+            os.path.join(tempfile.gettempdir(), "emerald_altar_openai_governor.db")
+        )
+        self.enabled = os.environ.get("OPENAI_GOVERNOR", "on").lower() not in ("off", "0", "false")
+
+        self.limits = {}
+        for family, defaults in DEFAULT_LIMITS.items():
+            self.limits[family] = {
+                "rpm": float(os.environ.get(f"OPENAI_{family.upper()}_RPM", defaults["rpm"])),
+                "concurrency": int(os.environ.get(f"OPENAI_{family.upper()}_CONCURRENCY", defaults["concurrency"])),
+            }
+        if limits:
+            for family, values in limits.items():
+                self.limits.setdefault(family, {}).update(values)
+
+        self._local = threading.local()
+        self._ready = False
+        self._ready_lock = threading.Lock()
+
+    # -- storage -------------------------------------------------------------
+
+    def _connect(self):
+        """One connection per thread and process"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        if not self._ready:
+            with self._ready_lock:
+                if not self._ready:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS buckets ("
+                        "family TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, "
+                        "blocked_until REAL NOT NULL DEFAULT 0)"
+                    )
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS leases ("
+                        "id INTEGER PRIMARY KEY, family TEXT NOT NULL, priority INTEGER NOT NULL, "
+                        "pid INTEGER NOT NULL, expires_at REAL NOT NULL)"
+                    )
+                    self._ready = True
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _bucket(self, conn, family, now):
+        """Current (refilled) bucket state of a family"""
+        limits = self.limits[family]
+        rate = limits["rpm"] / 60.0
+        capacity = max(1.0, rate * BURST_SECONDS)
+
+        row = conn.execute(
+            "SELECT tokens, updated_at, blocked_until FROM buckets WHERE family = ?", (family,)
+        ).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO buckets (family, tokens, updated_at, blocked_until) VALUES (?, ?, ?, 0)",
+                (family, capacity, now)
+            )
+            return capacity, capacity, rate, 0.0
+
+        tokens, updated_at, blocked_until = row
+        tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+        return tokens, capacity, rate, blocked_until
+
+    # -- acquiring -----------------------------------------------------------
+
+    def classify(self, call_type, priority=None):
+        family, default_priority = CALL_TYPES.get(call_type, ("chat", STANDARD))
+        return family, default_priority if priority is None else priority
+
+    def try_acquire(self, call_type, priority=None):
+        """Take a request token and a concurrency slot if the class may have them
+
+        Returns:
+            (lease id, 0) on success, or (None, seconds to wait before trying again)
+        """
+        family, priority = self.classify(call_type, priority)
+        limits = self.limits[family]
+        reserve = PRIORITY_RESERVE[priority]
+        now = time.time()
+
+        with self._transaction() as conn:
+            tokens, capacity, rate, blocked_until = self._bucket(conn, family, now)
+
+            # Slots of callers that crashed while holding them
+            conn.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+            active = conn.execute("SELECT COUNT(*) FROM leases WHERE family = ?", (family,)).fetchone()[0]
+            slots = max(1, int(limits["concurrency"] * (1 - reserve)))
+            if active >= slots and self._reap_dead_leases(conn, family):
+                active = conn.execute("SELECT COUNT(*) FROM leases WHERE family = ?", (family,)).fetchone()[0]
+
+            # Tokens the class must leave in the bucket; small buckets (images)
+            # still need room for one request above the reserve
+            floor = min(capacity * reserve, capacity - 1)
+
+            wait = 0.0
+            if blocked_until > now:
+                wait = blocked_until - now
+            elif tokens - 1 < floor:
+                wait = (floor + 1 - tokens) / rate
+            elif active >= slots:
+                wait = 0.05
+
+            if wait > 0:
+                conn.execute("UPDATE buckets SET tokens = ?, updated_at = ? WHERE family = ?", (tokens, now, family))
+                return None, wait
+
+            conn.execute("UPDATE buckets SET tokens = ?, updated_at = ? WHERE family = ?", (tokens - 1, now, family))
+            cursor = conn.execute(
+                "INSERT INTO leases (family, priority, pid, expires_at) VALUES (?, ?, ?, ?)",
+                (family, priority, os.getpid(), now + LEASE_TTL)
+            )
+            return cursor.lastrowid, 0
+
+    def _reap_dead_leases(self, conn, family):
+        """Free the slots of processes that died without releasing them
+
+        Returns:
+            Number of leases removed
+        """
+        dead = []
+        for lease_id, pid in conn.execute("SELECT id, pid FROM leases WHERE family = ?", (family,)).fetchall():
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                dead.append((lease_id,))
+            except PermissionError:
+                pass  # The process exists but belongs to someone else
+        if dead:
+            conn.executemany("DELETE FROM leases WHERE id = ?", dead)
+        return len(dead)
+
+    def _wait_time(self, wait, deadline):
+        # Jitter keeps waiting workers from waking up in lockstep
+        wait = min(wait, 1.0) * random.uniform(0.8, 1.2)
+        return max(0.0, min(wait, deadline - time.monotonic()))
+
+    def acquire(self, call_type, priority=None):
+        """Block until the call may be sent
+
+        Returns:
+            Lease id to pass to release()
+
+        Raises:
+            RateLimitTimeout if the class waited longer than it may
+        """
+        family, priority = self.classify(call_type, priority)
+        deadline = time.monotonic() + PRIORITY_MAX_WAIT[priority]
+
+        while True:
+            lease_id, wait = self.try_acquire(call_type, priority)
+            if lease_id is not None:
+                return lease_id
+            if time.monotonic() >= deadline:
+                raise RateLimitTimeout(
+                    f"Waited too long for an OpenAI {family} slot ({PRIORITY_NAMES[priority]} priority)"
+                )
+            time.sleep(self._wait_time(wait, deadline))
+
+    async def acquire_async(self, call_type, priority=None, executor=None):
+        """asyncio version of acquire(): waits with asyncio.sleep instead of blocking a thread
+
+        The SQLite work runs in executor (default: the loop's default executor).
+        """
+        family, priority = self.classify(call_type, priority)
+        deadline = time.monotonic() + PRIORITY_MAX_WAIT[priority]
+        loop = asyncio.get_running_loop()
+
+        while True:
+            lease_id, wait = await loop.run_in_executor(executor, self.try_acquire, call_type, priority)
+            if lease_id is not None:
+                return lease_id
+            if time.monotonic() >= deadline:
+                raise RateLimitTimeout(
+                    f"Waited too long for an OpenAI {family} slot ({PRIORITY_NAMES[priority]} priority)"
+                )
+            await asyncio.sleep(self._wait_time(wait, deadline))
+
+    def release(self, lease_id):
+        """Give back the concurrency slot of a finished call"""
+        if lease_id is None:
+            return
+        try:
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM leases WHERE id = ?", (lease_id,))
+        except sqlite3.Error as e:
+            # The lease expires on its own
+            print(f"Error releasing OpenAI rate lease: {str(e)}")
+
+    @contextmanager
+    def slot(self, call_type, priority=None):
+        """Hold a rate token and concurrency slot for the duration of a call"""
+        if not self.enabled:
+            yield
+            return
+        lease_id = self.acquire(call_type, priority)
+        try:
+            yield
+        finally:
+            self.release(lease_id)
+
+    # -- upstream feedback ---------------------------------------------------
+
+    def observe(self, call_type, status_code, headers):
+        """Apply the rate limit information of an OpenAI response
+
+        Retry-After on a 429/503 and exhausted x-ratelimit-remaining-* headers
+        pause the whole family until the reset time; a lower remaining request
+        count than our bucket holds drains the bucket to match.
+        """
+        if not self.enabled or headers is None:
+            return
+
+        family, _ = self.classify(call_type)
+        pause = 0.0
+
+        if status_code in (429, 503):
+            retry_after = parse_duration(headers.get("retry-after-ms"))
+            retry_after = retry_after / 1000 if retry_after is not None else parse_duration(headers.get("retry-after"))
+            if retry_after is None:
+                retry_after = parse_duration(headers.get("x-ratelimit-reset-requests")) or 1.0
+            pause = max(pause, retry_after)
+
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        if remaining_requests is not None and remaining_requests.isdigit() and int(remaining_requests) == 0:
+            pause = max(pause, parse_duration(headers.get("x-ratelimit-reset-requests")) or 1.0)
+
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None and remaining_tokens.isdigit() and int(remaining_tokens) < MIN_UPSTREAM_TOKENS:
+            pause = max(pause, parse_duration(headers.get("x-ratelimit-reset-tokens")) or 1.0)
+
+        if pause <= 0 and remaining_requests is None:
+            return
+
+        now = time.time()
+        try:
+            with self._transaction() as conn:
+                tokens, _, _, blocked_until = self._bucket(conn, family, now)
+                if remaining_requests is not None and remaining_requests.isdigit():
+                    tokens = min(tokens, float(remaining_requests))
+                if pause > 0:
+                    blocked_until = max(blocked_until, now + pause)
+                    print(f"OpenAI {family} rate limit reached, pausing all workers for {pause:.2f}s")
+                conn.execute(
+                    "UPDATE buckets SET tokens = ?, updated_at = ?, blocked_until = ? WHERE family = ?",
+                    (tokens, now, blocked_until, family)
+                )
+        except sqlite3.Error as e:
+            print(f"Error recording OpenAI rate limit headers: {str(e)}")
+
+    def retry_delay(self, response, retry_count, base_delay=1):
+        """Seconds to wait before retrying a rate-limited call
+
+        Uses the upstream Retry-After when there is one, otherwise exponential
+        backoff with jitter.
+        """
+        if response is not None:
+            retry_after = parse_duration(response.headers.get("retry-after"))
+            if retry_after is not None:
+                return retry_after + random.uniform(0.1, 0.5)
+        return (2 ** retry_count) * base_delay + random.uniform(0.1, 0.5)
+
+    def stats(self):
+        """Bucket levels, pauses and slots in use per limit family"""
+        now = time.time()
+        result = {}
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM leases WHERE expires_at < ?", (now,))
+            for family, limits in self.limits.items():
+                tokens, capacity, _, blocked_until = self._bucket(conn, family, now)
+                by_priority = dict(conn.execute(
+                    "SELECT priority, COUNT(*) FROM leases WHERE family = ? GROUP BY priority", (family,)
+                ).fetchall())
+                result[family] = {
+                    "rpm": limits["rpm"],
+                    "tokens": round(tokens, 2),
+                    "capacity": round(capacity, 2),
+                    "paused_seconds": round(max(0.0, blocked_until - now), 2),
+                    "concurrency": limits["concurrency"],
+                    "in_flight": {PRIORITY_NAMES[p]: by_priority.get(p, 0) for p in PRIORITY_NAMES},
+                }
+        return result
+
+
+# Initialize governor
+rate_governor = RateGovernor()
@@ -0,0 +1,160 @@
+"""
+Structured (JSON) output mode for DM replies.
+
+Instead of appending bracket tags to its narrative, the model returns
+{"narrative": "...", "effects": [{"effect": "damage", "amount": 5, "source": "..."}, ...]}
+constrained by a JSON schema. The schema is generated from the tag
+definitions in tag_parser.TAG_SPECS, and parse_structured validates a reply
+locally into the same ParsedResponse that parse_tags produces, so both modes
+feed the same effect appliers in OpenAIService.
+"""
+
+import json
+import threading
+from .tag_parser import TAG_SPECS, TagEffect, ParsedResponse, parse_tags
+
+# Effect specs by the name used in the "effect" field (item, damage, mp, ...)
+EFFECT_SPECS = {spec.kind: (name, spec) for name, spec in TAG_SPECS.items()}
+
+
+class StructuredOutputError(ValueError):
+    """The reply is not a JSON object with a narrative and a list of effects"""
+
+
+def _effect_schema(kind, spec):
+    properties = {"effect": {"type": "string", "enum": [kind]}}
+    for field in spec.fields:
+        properties[field] = {"type": "integer" if field in spec.int_fields else "string"}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+
+DM_TURN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "narrative": {"type": "string"},
+        "effects": {
+            "type": "array",
+            "items": {"anyOf": [_effect_schema(kind, spec) for kind, (_, spec) in EFFECT_SPECS.items()]}
+        }
+    },
+    "required": ["narrative", "effects"],
+    "additionalProperties": False
+}
+
+# response_format for the chat completions API (strict schemas need gpt-4o or newer)
+DM_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "dm_turn", "strict": True, "schema": DM_TURN_SCHEMA}
+}
+
+
+def _parse_effect(raw, errors):
+    if not isinstance(raw, dict):
+        errors.append(f"Effect is not an object: {raw!r}")
+        return None
+
+    kind = raw.get("effect")
+    if kind not in EFFECT_SPECS:
+        errors.append(f"Unknown effect {kind!r}: {raw!r}")
+        return None
+
+    name, spec = EFFECT_SPECS[kind]
+    data = {}
+    for field in spec.fields:
+        value = raw.get(field)
+        if field in spec.int_fields:
+            if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+                value = int(value)
+            if not isinstance(value, int) or isinstance(value, bool):
+                errors.append(f"{kind} {field} is not a number: {raw!r}")
+                return None
+        else:
+            if value is None:
+                errors.append(f"{kind} is missing {field}: {raw!r}")
+                return None
+            value = str(value).strip()
+        data[field] = value
+
+    return TagEffect(kind, data, json.dumps(raw))
+
+
+def parse_structured(content):
+    """
+    Validate a structured DM reply
+
+    Malformed effects are dropped and reported in errors, like malformed tags.
+    Bracket tags that slipped into the narrative are stripped and reported too
+    (not applied, so an effect is never applied twice).
+
+    Args:
+        content: Message content returned by the model
+
+    Returns:
+        ParsedResponse(narrative, effects, errors)
+
+    Raises:
+        StructuredOutputError if the reply is not a JSON object with a string
+        narrative and a list of effects
+    """
+    try:
+        payload = json.loads(content)
+    except (TypeError, ValueError) as e:
+        raise StructuredOutputError(f"Reply is not valid JSON: {str(e)}")
+
+    if not isinstance(payload, dict) or not isinstance(payload.get("narrative"), str):
+        raise StructuredOutputError("Reply has no narrative")
+    if not isinstance(payload.get("effects", []), list):
+        raise StructuredOutputError("Reply effects are not a list")
+
+    errors = []
+    effects = []
+    for raw in payload.get("effects", []):
+        effect = _parse_effect(raw, errors)
+        if effect:
+            effects.append(effect)
+
+    stray = parse_tags(payload["narrative"])
+    for effect in stray.effects:
+        errors.append(f"Tag in the narrative: {effect.tag}")
+    errors.extend(stray.errors)
+
+    return ParsedResponse(stray.narrative, effects, errors)
+
+
+class ReplyStats:
+    """Counts of parsed DM replies per output mode (tags or json), for this process"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._modes = {}
+
+    def record(self, mode, parsed=None, parse_failed=False):
+        with self._lock:
+            counts = self._modes.setdefault(mode, {'replies': 0, 'parse_failures': 0, 'effects': 0, 'dropped': 0})
+            counts['replies'] += 1
+            if parse_failed:
+                counts['parse_failures'] += 1
+            if parsed is not None:
+                counts['effects'] += len(parsed.effects)
+                counts['dropped'] += len(parsed.errors)
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for mode, counts in self._modes.items():
+                attempted = counts['effects'] + counts['dropped']
+                result[mode] = dict(
+                    counts,
+                    parse_failure_rate=round(counts['parse_failures'] / counts['replies'], 4),
+                    drop_rate=round(counts['dropped'] / attempted, 4) if attempted else None
+                )
+            return result
+
+
+# Initialize stats
+reply_stats = ReplyStats()
@@ -0,0 +1,132 @@
+"""
+Single-pass parser for the DM's special bracket tags.
+
+The AI appends tags like [ITEM:Name|Type|Effect] or [DAMAGE:5|Goblin attack]
+to its narrative (see TAG_INSTRUCTIONS in prompt_builder.py). parse_tags walks
+the reply once and returns the narrative without the tags plus a list of typed
+effects for OpenAIService to apply.
+
+The scan only uses str.find from positions that never move backwards, so its
+cost is linear in the length of the reply however malformed it is -- unlike
+the lazy multi-group regexes it replaces, which could backtrack badly on a
+long unterminated [ENEMY: tag.
+"""
+
+from collections import namedtuple
+from .tag_stream import TAG_NAMES, MAX_TAG_LENGTH
+
+# Fields of a tag (split on "|", the last field keeps any extra "|"), and which are integers
+TagSpec = namedtuple("TagSpec", "kind fields int_fields")
+
+TAG_SPECS = {
+    "ITEM": TagSpec("item", ("name", "type", "description"), ()),
+    "TRANSACTION": TagSpec("transaction", ("amount", "description"), ("amount",)),
+    "REWARD": TagSpec("reward", ("amount", "description"), ("amount",)),
+    "DAMAGE": TagSpec("damage", ("amount", "source"), ("amount",)),
+    "HEALING": TagSpec("healing", ("amount", "source"), ("amount",)),
+    "MP_USED": TagSpec("mp", ("amount", "source"), ("amount",)),
+    "DAMAGE_DEALT": TagSpec("damage_dealt", ("amount", "target"), ("amount",)),
+    "ENEMY": TagSpec(
+        "enemy",
+        ("name", "description", "lore_description", "hp", "mp", "armor_class", "str", "dex", "speed",
+         "wisdom", "intelligence", "constitution", "charisma", "initiative"),
+        ("hp", "mp", "armor_class", "str", "dex", "speed", "wisdom", "intelligence", "constitution",
+         "charisma", "initiative"),
+    ),
+    "ENEMY_MOVE": TagSpec(
+        "enemy_move",
+        ("name", "description", "lore_description", "damage", "mana_cost", "status_effect", "condition"),
+        ("damage", "mana_cost"),
+    ),
+    "NPC": TagSpec("npc", ("name", "description", "lore_description", "role", "affiliation"), ()),
+}
+
+assert set(TAG_SPECS) == set(TAG_NAMES), "tag_stream.TAG_NAMES and TAG_SPECS must list the same tags"
+
+# Longest "NAME" between "[" and ":"
+MAX_NAME_LENGTH = max(len(name) for name in TAG_NAMES)
+
+# kind: effect type (see TAG_SPECS), data: dict of field values, tag: the raw tag text
+TagEffect = namedtuple("TagEffect", "kind data tag")
+
+# narrative: reply without tags, effects: TagEffects in order, errors: malformed tags that were dropped
+ParsedResponse = namedtuple("ParsedResponse", "narrative effects errors")
+
+
+def _parse_effect(name, body, tag, errors):
+    spec = TAG_SPECS[name]
+    values = [value.strip() for value in body.split("|", len(spec.fields) - 1)]
+    if len(values) < len(spec.fields):
+        errors.append(f"{name} needs {len(spec.fields)} fields, got {len(values)}: {tag}")
+        return None
+
+    data = dict(zip(spec.fields, values))
+    for field in spec.int_fields:
+        try:
+            data[field] = int(data[field])
+        except ValueError:
+            errors.append(f"{name} {field} is not a number: {tag}")
+            return None
+    return TagEffect(spec.kind, data, tag)
+
+
+def parse_tags(text):
+    """
+    Split an AI reply into narrative and effects in one pass
+
+    Tags are removed from the narrative whether or not they are well formed,
+    matching what TagStreamFilter shows the player while streaming: an
+    unterminated tag at the end is dropped and one longer than MAX_TAG_LENGTH
+    is kept as plain text.
+
+    Args:
+        text: Raw reply from the model
+
+    Returns:
+        ParsedResponse(narrative, effects, errors)
+    """
+    narrative = []
+    effects = []
+    errors = []
+    length = len(text)
+    pos = 0
+    close = -1  # next "]" at or after the current tag, reused until we pass it
+
+    while pos < length:
+        start = text.find("[", pos)
+        if start == -1:
+            break
+
+        colon = text.find(":", start + 1, start + 2 + MAX_NAME_LENGTH)
+        name = text[start + 1:colon] if colon != -1 else None
+        if name not in TAG_SPECS:
+            # A bracket that isn't one of our tags
+            narrative.append(text[pos:start + 1])
+            pos = start + 1
+            continue
+
+        if close < start:
+            close = text.find("]", start)
+        if close == -1:
+            # Nothing after this point is closed, so no later tag can be either
+            if length - start <= MAX_TAG_LENGTH:
+                errors.append(f"Unterminated {name} tag: {text[start:start + 80]}")
+                narrative.append(text[pos:start])
+                pos = length
+            break
+
+        if close - start > MAX_TAG_LENGTH:
+            # Malformed tag, keep it as plain text
+            narrative.append(text[pos:start + 1])
+            pos = start + 1
+            continue
+
+        narrative.append(text[pos:start])
+        tag = text[start:close + 1]
+        effect = _parse_effect(name, text[colon + 1:close], tag, errors)
+        if effect:
+            effects.append(effect)
+        pos = close + 1
+
+    narrative.append(text[pos:])
+    return ParsedResponse("".join(narrative).strip(), effects, errors)
@@ -0,0 +1,98 @@
+"""
+Filter that hides the DM's special bracket tags from a streamed response.
+
+The AI appends tags like [ITEM:Name|Type|Effect] or [DAMAGE:5|Goblin attack]
+to its narrative. When the completion is streamed to the player those tags
+arrive split across chunks, so the filter holds back anything that could still
+turn into a tag and only releases text once it is known to be narrative.
+"""
+
+# Tag names the DM is instructed to emit (see OpenAIService._build_chat_messages)
+TAG_NAMES = (
+    "ITEM",
+    "TRANSACTION",
+    "REWARD",
+    "DAMAGE",
+    "DAMAGE_DEALT",
+    "HEALING",
+    "MP_USED",
+    "ENEMY",
+    "ENEMY_MOVE",
+    "NPC",
+)
+
+# Every "[NAME:" opener, used to decide whether a held-back buffer can still be a tag
+TAG_OPENERS = tuple(f"[{name}:" for name in TAG_NAMES)
+
+# Give up on a tag that never closes so a malformed reply can't swallow the stream
+MAX_TAG_LENGTH = 2000
+
+
+class TagStreamFilter:
+    """Incrementally strips special tags from streamed completion text"""
+
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, chunk):
+        """
+        Add a chunk of streamed text
+
+        Args:
+            chunk: Raw text received from the completion stream
+
+        Returns:
+            Text that is safe to show to the player (may be empty)
+        """
+        self._pending += chunk
+        visible = []
+
+        while self._pending:
+            start = self._pending.find("[")
+
+            # No tag opener at all, everything is narrative
+            if start == -1:
+                visible.append(self._pending)
+                self._pending = ""
+                break
+
+            visible.append(self._pending[:start])
+            self._pending = self._pending[start:]
+
+            if self._is_tag_prefix(self._pending):
+                # Still waiting for the rest of the tag name
+                break
+
+            if self._pending.startswith(TAG_OPENERS):
+                end = self._pending.find("]")
+                if end != -1:
+                    # Complete tag, drop it
+                    self._pending = self._pending[end + 1:]
+                    continue
+
+                if len(self._pending) > MAX_TAG_LENGTH:
+                    # Malformed tag, release it as plain text
+                    visible.append(self._pending)
+                    self._pending = ""
+                break
+
+            # A bracket that isn't one of our tags
+            visible.append("[")
+            self._pending = self._pending[1:]
+
+        return "".join(visible)
+
+    def flush(self):
+        """Release whatever is still held back once the stream has ended"""
+        remaining = self._pending
+        self._pending = ""
+
+        # An unterminated tag at the very end is still a tag
+        if remaining.startswith(TAG_OPENERS) or self._is_tag_prefix(remaining):
+            return ""
+        return remaining
+
+    @staticmethod
+    def _is_tag_prefix(text):
+        """True if text is a strict prefix of one of the tag openers"""
+        return any(opener.startswith(text) and opener != text for opener in TAG_OPENERS)
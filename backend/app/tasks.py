@@ -0,0 +1,138 @@
+from .jobs import job_queue
+from .db import session_scope
+from .models import Character, Item, ChatSummary
+from .services.openai_service import openai_service, ITEM_PLACEHOLDER_IMAGE
+from .services.item_index import item_index
+from .services.chat_context import chat_context_builder
+from .services.quest_pool import quest_pool
+from .routes import save_generated_quest, create_test_item
+
+# Background tasks run by the job workers (see worker.py). Each task gets the
+# job payload as keyword arguments and returns the same JSON body the
+# synchronous route would have returned.
+
+
+@job_queue.task('generate_avatar')
+def generate_avatar(character_name, character_class, character_description=''):
+    image_path = openai_service.generate_character_avatar(character_name, character_class, character_description)
+    if not image_path:
+        raise RuntimeError('Failed to generate avatar image')
+    return {'image_url': image_path}
+
+
+@job_queue.task('generate_bio')
+def generate_bio(character_name, character_class):
+    bio = openai_service.generate_character_bio(character_name, character_class)
+    if not bio:
+        raise RuntimeError('Failed to generate character bio')
+    return {'bio': bio}
+
+
+@job_queue.task('generate_quest')
+def generate_quest(character_id=None, difficulty='medium', quest_type='random'):
+    with session_scope() as session:
+        character = None
+        if character_id:
+            character = session.query(Character).filter_by(id=character_id).first()
+            if not character:
+                raise ValueError(f'Character {character_id} not found')
+
+        quest_data = openai_service.generate_quest(character, difficulty, quest_type)
+        if 'error' in quest_data:
+            raise RuntimeError(quest_data['error'])
+
+        return save_generated_quest(session, quest_data, character_id)
+
+
+@job_queue.task('refill_quest_pool')
+def refill_quest_pool(difficulty, quest_type, level_band):
+    """Generate quests for a pool until it reaches the high watermark"""
+    key = (difficulty, quest_type, level_band)
+    level = quest_pool.band_level(level_band)
+    added = 0
+
+    # Bounded by the watermark even if other refills or takes race with this one
+    for _ in range(quest_pool.high_watermark):
+        if quest_pool.depth(key) >= quest_pool.high_watermark:
+            break
+        quest_data = openai_service.generate_quest(None, difficulty, quest_type, level=level)
+        if 'error' in quest_data:
+            raise RuntimeError(quest_data['error'])
+        quest_pool.add(key, quest_data)
+        added += 1
+
+    print(f"Added {added} quests to the {difficulty}/{quest_type} pool for level band {level_band}")
+    return {'difficulty': difficulty, 'quest_type': quest_type, 'level_band': level_band, 'added': added}
+
+
+@job_queue.task('generate_test_item')
+def generate_test_item(character_id, item_name, item_type, item_description):
+    with session_scope() as session:
+        return create_test_item(session, character_id, item_name, item_type, item_description)
+
+
+@job_queue.task('render_item_image')
+def render_item_image(item_name):
+    """Render the image of an item created from a DM reply and attach it to every item with that name"""
+    def matching_items(session):
+        return item_index.find_exact(session, item_name)
+
+    # Reuse an image an earlier render already produced for the same name
+    with session_scope() as session:
+        rendered = [item.image_url for item in matching_items(session)
+                    if item.image_url and item.image_url != ITEM_PLACEHOLDER_IMAGE]
+    image_path = rendered[0] if rendered else None
+
+    # The DALL-E call runs outside any transaction so it never holds a database lock
+    if not image_path:
+        image_path = openai_service._generate_image(item_name, "item")
+        if not image_path:
+            raise RuntimeError(f"Failed to render image for item '{item_name}'")
+
+    with session_scope() as session:
+        updated = []
+        for item in matching_items(session):
+            if not item.image_url or item.image_url == ITEM_PLACEHOLDER_IMAGE:
+                item.image_url = image_path
+                updated.append(item.id)
+
+    print(f"Item image for '{item_name}' set on items {updated}: {image_path}")
+    return {'image_url': image_path, 'item_ids': updated}
+
+
+@job_queue.task('fold_chat_summary')
+def fold_chat_summary(character_id):
+    """Fold the chat turns that fell out of the context window into the character's summary"""
+    folded = 0
+
+    while True:
+        with session_scope() as session:
+            summary_row, turns = chat_context_builder.turns_to_fold(session, character_id)
+            previous_summary = summary_row.summary if summary_row else ''
+            previous_last_id = summary_row.last_message_id if summary_row else 0
+            turn_dicts = [{'content': turn.content, 'is_user': turn.is_user} for turn in turns]
+            last_id = turns[-1].id if turns else None
+
+        if not turn_dicts:
+            break
+
+        # The OpenAI call runs outside any transaction so it never holds a database lock
+        summary = openai_service.summarize_chat(previous_summary, turn_dicts)
+        if not summary:
+            raise RuntimeError(f"Failed to summarize chat for character {character_id}")
+
+        with session_scope() as session:
+            summary_row = session.query(ChatSummary).filter_by(character_id=character_id).first()
+            if summary_row is None:
+                summary_row = ChatSummary(character_id=character_id)
+                session.add(summary_row)
+            elif summary_row.last_message_id != previous_last_id:
+                # Someone else folded these turns meanwhile, start over from their summary
+                continue
+            summary_row.summary = summary
+            summary_row.last_message_id = last_id
+
+        folded += len(turn_dicts)
+
+    print(f"Folded {folded} chat turns into the summary of character {character_id}")
+    return {'character_id': character_id, 'folded': folded}
@@ -0,0 +1,3 @@
+def name_key(name):
+    """Normalized name (lowercase, single spaces) used to match and deduplicate entities by name"""
+    return " ".join(name.lower().split()) if name else None
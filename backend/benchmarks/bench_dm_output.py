@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Benchmark: dropped effects and parse failures, tag replies vs structured (JSON) replies.
+
+Sends the same DM turns in both output modes through the real request
+builder (OpenAIService._chat_payload) and reply parser (_parse_reply) and
+reports, per mode, how many replies could not be parsed and how many effects
+were dropped or lost.
+
+By default the replies come from a local stub server that knows the effects
+it meant to send. Its error model, which you can change with the flags:
+  - both modes: a reply is cut off at max_tokens with probability --truncation
+  - tags only: every tag is mistyped with probability --tag-errors, scaled by
+    its number of fields (a wrong field count, "5 HP" as an amount, "," as a
+    separator or a missing "]")
+  - json only: nothing else, the API enforces the strict schema
+With --live the turns go to the OpenAI API instead (OPENAI_API_KEY needed);
+there is no ground truth then, so only parse failures and drops are counted.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_dm_output [--turns 500] [--tag-errors 0.04] [--truncation 0.01] [--live]
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from app.services.http_transport import HTTPTransport
+from app.services.openai_service import openai_service
+from app.services.structured_output import reply_stats
+from app.services.tag_parser import TAG_SPECS
+
+PLAYER_TURNS = [
+    "I draw my machete and attack the cultist.",
+    "I buy a coil of rope from the vendor for 5 pesos.",
+    "I cast a hex on the nahual.",
+    "I search the body of the fallen zealot.",
+    "I drink the healing tea the curandera gave me.",
+    "I ask the bartender who runs the Obsidian Circle in this barrio.",
+]
+
+EFFECT_VALUES = {
+    "item": {"name": "Jade Amulet", "type": "necklace", "description": "Wards off restless spirits"},
+    "transaction": {"amount": 5, "description": "Purchase of rope"},
+    "reward": {"amount": 20, "description": "Bounty on the cultist"},
+    "damage": {"amount": 6, "source": "Cultist dagger"},
+    "healing": {"amount": 8, "source": "Healing tea"},
+    "mp": {"amount": 10, "source": "Hex"},
+    "damage_dealt": {"amount": 12, "target": "Cultist"},
+    "enemy": {"name": "Cultist", "description": "A robed zealot", "lore_description": "Serves the Obsidian Circle",
+              "hp": 30, "mp": 10, "armor_class": 12, "str": 10, "dex": 12, "speed": 10, "wisdom": 8,
+              "intelligence": 8, "constitution": 10, "charisma": 6, "initiative": 11},
+    "enemy_move": {"name": "Obsidian Slash", "description": "A quick cut", "lore_description": "Taught in the temple",
+                   "damage": 6, "mana_cost": 0, "status_effect": "bleeding", "condition": "melee range"},
+    "npc": {"name": "Doña Ana", "description": "A curandera", "lore_description": "Knows the old remedies",
+            "role": "ally", "affiliation": "Independent"},
+}
+SPECS = {spec.kind: (name, spec) for name, spec in TAG_SPECS.items()}
+
+NARRATIVE = ("The gaslights of the Zocalo flicker as the miasma rolls in from the lake bed. "
+             "Somewhere a church bell rings thirteen times. ")
+
+
+def render_tag(kind, values, rng, error_rate):
+    """A tag as the model writes it, mistyped with a probability that grows with its fields"""
+    name, spec = SPECS[kind]
+    fields = [str(values[field]) for field in spec.fields]
+    if rng.random() < error_rate * len(spec.fields) / 2:
+        mistake = rng.choice(("field_count", "amount", "separator", "bracket"))
+        if mistake == "field_count":
+            fields = fields[:-1]
+        elif mistake == "amount" and spec.int_fields:
+            index = spec.fields.index(spec.int_fields[0])
+            fields[index] += " HP"
+        elif mistake == "separator":
+            return f"[{name}:" + ", ".join(fields) + "]"
+        else:
+            return f"[{name}:" + "|".join(fields)
+    return f"[{name}:" + "|".join(fields) + "]"
+
+
+class StubState:
+    def __init__(self, seed, tag_errors, truncation):
+        self.rng = random.Random(seed)
+        self.tag_errors = tag_errors
+        self.truncation = truncation
+        self.lock = threading.Lock()
+
+    def reply(self, structured):
+        with self.lock:
+            kinds = self.rng.sample(sorted(EFFECT_VALUES), self.rng.randint(0, 4))
+            if structured:
+                content = json.dumps({
+                    "narrative": NARRATIVE,
+                    "effects": [dict(EFFECT_VALUES[kind], effect=kind) for kind in kinds]
+                })
+            else:
+                tags = [render_tag(kind, EFFECT_VALUES[kind], self.rng, self.tag_errors) for kind in kinds]
+                content = NARRATIVE + " ".join(tags)
+            if self.rng.random() < self.truncation:
+                content = content[:self.rng.randint(len(content) // 2, len(content) - 1)]
+        return content, len(kinds)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        content, expected = self.server.state.reply("response_format" in request)
+        body = json.dumps({"choices": [{"message": {"content": content}}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Expected-Effects", str(expected))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_character():
+    return SimpleNamespace(
+        name="Elio", race="Human", exp=350, hp_status=70, mp_status=90, money=40,
+        description="A printer's apprentice who saw the emerald taken.",
+        class_=SimpleNamespace(name="Bruja", hp=80, mp=120),
+    )
+
+
+def run_mode(structured, turns, transport, url, headers):
+    character = make_character()
+    totals = {"expected": 0, "applied": 0, "seconds": 0.0}
+
+    for turn in range(turns):
+        messages = [{"content": PLAYER_TURNS[turn % len(PLAYER_TURNS)], "is_user": True}]
+        formatted_messages = openai_service._build_chat_messages(messages, character, None, None, structured)
+        call_type, data = openai_service._chat_payload(formatted_messages, structured)
+
+        start = time.perf_counter()
+        response = transport.post(url, call_type=call_type, headers=headers, json=data)
+        totals["seconds"] += time.perf_counter() - start
+        if response.status_code != 200:
+            print(f"HTTP {response.status_code}: {response.text[:200]}")
+            continue
+
+        parsed = openai_service._parse_reply(response.json()["choices"][0]["message"]["content"], structured)
+        totals["applied"] += len(parsed.effects)
+        totals["expected"] += int(response.headers.get("X-Expected-Effects", 0))
+
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=500, help="DM turns per mode")
+    parser.add_argument("--tag-errors", type=float, default=0.04, help="stub: mistyped tag rate per two fields")
+    parser.add_argument("--truncation", type=float, default=0.01, help="stub: share of replies cut off")
+    parser.add_argument("--live", action="store_true", help="call the OpenAI API instead of the stub")
+    args = parser.parse_args()
+
+    headers = {"Content-Type": "application/json"}
+    transport = HTTPTransport(governor=None)
+    server = None
+    if args.live:
+        url = openai_service.api_url
+        headers["Authorization"] = f"Bearer {openai_service.api_key}"
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        server.daemon_threads = True
+        server.state = StubState(int(os.environ.get("BENCH_SEED", 7)), args.tag_errors, args.truncation)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+    print(f"{args.turns} turns per mode against {'the OpenAI API' if args.live else 'the local stub'}\n")
+    results = {}
+    for mode, structured in (("tags", False), ("json", True)):
+        results[mode] = run_mode(structured, args.turns, transport, url, headers)
+
+    stats = reply_stats.stats()
+    print(f"{'mode':<6} {'parse fail':>11} {'dropped':>9} {'drop rate':>10} {'lost':>7} {'ms/turn':>8}")
+    for mode, totals in results.items():
+        counts = stats.get(mode, {})
+        lost = f"{totals['expected'] - totals['applied']:>7}" if not args.live else f"{'-':>7}"
+        print(f"{mode:<6} {counts.get('parse_failures', 0):>11} {counts.get('dropped', 0):>9} "
+              f"{(counts.get('drop_rate') or 0) * 100:>9.1f}% {lost} {totals['seconds'] / args.turns * 1000:>8.2f}")
+    if not args.live:
+        print("\nlost = effects the stub meant to send that were not applied (dropped, or cut off by truncation)")
+
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Benchmark: bare requests.post vs the pooled HTTPTransport used by OpenAIService.
+
+Starts a local HTTPS stub with a throwaway self-signed certificate, then sends
+the same JSON requests both ways and reports latency plus the number of TLS
+handshakes the stub had to perform. No OpenAI key or network access needed.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_http_transport [--requests 200] [--threads 4]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import ssl
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from app.services.http_transport import HTTPTransport
+
+RESPONSE_BODY = json.dumps({"choices": [{"message": {"content": "The plaza is quiet."}}]}).encode()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so the stub honours keep-alive like the real API does
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(RESPONSE_BODY)))
+        self.end_headers()
+        self.wfile.write(RESPONSE_BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HandshakeCountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.handshakes = 0
+        self._count_lock = threading.Lock()
+
+    def get_request(self):
+        # Every accepted connection on the TLS socket is a full handshake
+        request, address = super().get_request()
+        with self._count_lock:
+            self.handshakes += 1
+        return request, address
+
+
+def make_certificate(directory):
+    """Create a self-signed certificate for 127.0.0.1 with the openssl CLI"""
+    cert_file = os.path.join(directory, "cert.pem")
+    key_file = os.path.join(directory, "key.pem")
+    subprocess.run(
+        [
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", key_file, "-out", cert_file, "-days", "1",
+            "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return cert_file, key_file
+
+
+def start_stub(cert_file, key_file):
+    server = HandshakeCountingServer(("127.0.0.1", 0), StubHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run(label, send, total, threads, server):
+    payload = {"model": "gpt-4", "messages": [{"role": "user", "content": "Where am I?"}]}
+    latencies = []
+    lock = threading.Lock()
+
+    def one(_):
+        start = time.perf_counter()
+        response = send(payload)
+        response.raise_for_status()
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    server.handshakes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, range(total)))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{label:<10} wall={wall:7.3f}s  mean={statistics.mean(latencies) * 1000:7.2f}ms  "
+        f"p50={statistics.median(latencies) * 1000:7.2f}ms  p95={p95 * 1000:7.2f}ms  "
+        f"handshakes={server.handshakes}"
+    )
+    return wall, server.handshakes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="requests per mode")
+    parser.add_argument("--threads", type=int, default=4, help="concurrent callers")
+    args = parser.parse_args()
+
+    if not shutil.which("openssl"):
+        print("ERROR: the openssl command is needed to create the stub certificate.")
+        return
+
+    cert_dir = tempfile.mkdtemp(prefix="ea-bench-")
+    try:
+        cert_file, key_file = make_certificate(cert_dir)
+        server = start_stub(cert_file, key_file)
+        url = f"https://127.0.0.1:{server.server_port}/v1/chat/completions"
+        print(f"HTTPS stub on {url}: {args.requests} requests per mode, {args.threads} threads\n")
+
+        def bare(payload):
+            return requests.post(url, json=payload, verify=cert_file, timeout=(3.05, 30))
+
+        transport = HTTPTransport(governor=None)
+
+        def pooled(payload):
+            return transport.post(url, call_type="chat", json=payload, verify=cert_file)
+
+        bare_wall, bare_handshakes = run("bare", bare, args.requests, args.threads, server)
+        pooled_wall, pooled_handshakes = run("pooled", pooled, args.requests, args.threads, server)
+
+        print(f"\nHandshakes saved: {bare_handshakes - pooled_handshakes} "
+              f"({bare_handshakes} -> {pooled_handshakes}), speedup x{bare_wall / pooled_wall:.2f}")
+        transport.close()
+        server.shutdown()
+    finally:
+        shutil.rmtree(cert_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
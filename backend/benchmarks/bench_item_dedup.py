@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark: "does a similar item already exist" lookups, ILIKE scan vs item_index.
+
+The DM tag processor used Item.name.ilike("%name%"), which scans the whole
+items table on every [ITEM:] tag -- and a brand new item, the common case,
+always scans all of it. ItemIndex.find_similar answers the same question
+from the items.name_key index and the FTS5 trigram table. This fills a
+scratch SQLite database with generated items and times both for names that
+exist, names contained in an existing one, and new names.
+No OpenAI key needed; the app database is not touched.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_item_dedup [--sizes 10000,100000,300000] [--queries 200]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.models import Base, Item
+from app.services.item_index import ItemIndex
+from app.utils import name_key
+
+ADJECTIVES = ["Jade", "Obsidian", "Cursed", "Blessed", "Rusty", "Bone", "Feathered", "Hollow", "Weeping",
+              "Gilded", "Ashen", "Sunken", "Serpent", "Jaguar", "Smoking", "Shattered", "Crimson", "Silent"]
+NOUNS = ["Amulet", "Machete", "Rosary", "Mask", "Codex", "Talon", "Pendant", "Veil", "Flute", "Gauntlet",
+         "Idol", "Ring", "Dagger", "Censer", "Skull", "Drum", "Quiver", "Mirror"]
+OWNERS = ["Xibalba", "Tlaloc", "Ixchel", "Mixcoatl", "Camazotz", "Cipactli", "Ehecatl", "the Nahual",
+          "the Curandera", "the Zocalo", "Tezcatlipoca", "the Obsidian Circle"]
+
+
+def item_name(rng, number):
+    return f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} of {rng.choice(OWNERS)} {number}"
+
+
+def fill(engine, size, rng):
+    names = [item_name(rng, number) for number in range(size)]
+    with engine.begin() as conn:
+        conn.execute(Item.__table__.insert(), [
+            {"name": name, "name_key": name_key(name), "type": "trinket", "effect_description": "Generated"}
+            for name in names
+        ])
+    return names
+
+
+def legacy_lookup(session, name):
+    return session.query(Item).filter(Item.name.ilike(f"%{name}%")).first()
+
+
+def timed(lookup, session, names):
+    start = time.perf_counter()
+    found = sum(1 for name in names if lookup(session, name) is not None)
+    return (time.perf_counter() - start) / len(names), found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,300000", help="comma separated item counts")
+    parser.add_argument("--queries", type=int, default=200, help="lookups per kind of name")
+    args = parser.parse_args()
+
+    rng = random.Random(7)
+    print(f"{'items':>8} {'names':<10} {'ilike':>11} {'index':>11} {'found (ilike/index)':>20}")
+    for size in [int(value) for value in args.sizes.split(",")]:
+        path = os.path.join(tempfile.mkdtemp(prefix="ea-bench-"), "items.db")
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(engine, tables=[Item.__table__])
+        names = fill(engine, size, rng)
+
+        index = ItemIndex(bind=engine)
+        start = time.perf_counter()
+        index.ensure_schema()
+        print(f"{size:>8} FTS table built in {time.perf_counter() - start:.2f}s (fts={index.fts})")
+
+        queries = {
+            "existing": [rng.choice(names).upper() for _ in range(args.queries)],
+            "contained": [" ".join(rng.choice(names).split()[1:3]) for _ in range(args.queries)],
+            "new": [f"{rng.choice(ADJECTIVES)} Trinket {number}" for number in range(args.queries)],
+        }
+        session = sessionmaker(bind=engine)()
+        for kind, batch in queries.items():
+            legacy, legacy_found = timed(legacy_lookup, session, batch)
+            indexed, indexed_found = timed(index.find_similar, session, batch)
+            print(f"{'':>8} {kind:<10} {legacy * 1e3:9.3f}ms {indexed * 1e3:9.3f}ms "
+                  f"{f'{legacy_found}/{indexed_found}':>20}")
+        session.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
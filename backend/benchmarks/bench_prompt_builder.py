@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark: DM prompt assembly, old layout vs the precompiled PromptBuilder.
+
+The old layout rendered the whole rules f-string with the character stats near
+the top and then concatenated five instruction blocks on every turn. The
+builder sends the compiled rules first and a short stat block after them.
+
+For a set of synthetic characters this reports the time to assemble one turn
+and the length of the prompt prefix shared by every character -- the part
+OpenAI's prompt caching can reuse. No OpenAI key or database needed.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_prompt_builder [--characters 50] [--turns 2000]
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+from types import SimpleNamespace
+
+from app.services.prompt_builder import DM_RULES, TAG_INSTRUCTIONS, FIRST_MESSAGE_INSTRUCTION, PromptBuilder, prefix_hash
+
+CLASSES = [("Bruja", 80, 120), ("Luchador", 140, 40), ("Curandero", 90, 110), ("Pistolero", 100, 60)]
+RACES = ["Human", "Nahual", "Chaneque", "Alux"]
+
+
+def make_character(index):
+    name, hp, mp = random.choice(CLASSES)
+    return SimpleNamespace(
+        name=f"Hero{index}",
+        race=random.choice(RACES),
+        exp=random.randint(0, 2000),
+        hp_status=random.randint(1, hp),
+        mp_status=random.randint(0, mp),
+        money=random.randint(0, 500),
+        description=f"A wanderer from barrio {index} haunted by the emerald.",
+        class_=SimpleNamespace(name=name, hp=hp, mp=mp),
+    )
+
+
+def legacy_build(messages, character):
+    """The message list as OpenAIService built it before the prompt builder"""
+    intro, rules = DM_RULES.split("\n\n", 1)
+    class_name = character.class_.name if character.class_ else ''
+    system_prompt = f"""{intro}
+
+The player you are interacting with is {character.name}, a {character.race} {class_name}.
+
+Character Stats:
+- Level: {int(character.exp / 100) + 1}
+- Class: {class_name or 'Unknown'}
+- HP: {character.hp_status}/{character.class_.hp}
+- MP: {character.mp_status}/{character.class_.mp}
+- Money: {character.money} pesos
+- Background: {character.description if character.description else 'Unknown'}
+
+{rules}"""
+    for block in TAG_INSTRUCTIONS:
+        system_prompt += "\n\n" + block
+    if not messages:
+        system_prompt += "\n\n" + FIRST_MESSAGE_INSTRUCTION
+
+    formatted_messages = [{"role": "system", "content": system_prompt}]
+    for msg in messages:
+        formatted_messages.append({"role": "user" if msg['is_user'] else "assistant", "content": msg['content']})
+    return formatted_messages
+
+
+def shared_prefix_chars(prompts):
+    """Length of the prefix shared by every serialized prompt"""
+    first = min(prompts)
+    last = max(prompts)
+    length = 0
+    for a, b in zip(first, last):
+        if a != b:
+            break
+        length += 1
+    return length
+
+
+def run(label, build, characters, history, turns):
+    start = time.perf_counter()
+    for turn in range(turns):
+        build(history, characters[turn % len(characters)])
+    per_turn = (time.perf_counter() - start) / turns
+
+    prompts = [json.dumps(build(history, character)) for character in characters]
+    prefix = shared_prefix_chars(prompts)
+    print(f"{label:<8} assembly={per_turn * 1e6:8.1f}us/turn  shared prefix={prefix:6d} chars (~{prefix // 4} tokens)")
+    return prefix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--characters", type=int, default=50, help="distinct characters")
+    parser.add_argument("--turns", type=int, default=2000, help="prompts assembled per layout")
+    args = parser.parse_args()
+
+    random.seed(int(os.environ.get("BENCH_SEED", 7)))
+    characters = [make_character(index) for index in range(args.characters)]
+    history = [
+        {"content": f"Turn {turn}: the player walks toward the Zocalo.", "is_user": turn % 2 == 0}
+        for turn in range(10)
+    ]
+
+    print(f"{args.characters} characters, {len(history)} history turns, {args.turns} prompts per layout\n")
+    legacy_prefix = run("legacy", legacy_build, characters, history, args.turns)
+
+    builder = PromptBuilder()
+    builder_prefix = run("builder", builder.build, characters, history, args.turns)
+
+    stats = builder.stats()
+    print(f"\nBuilder prefix hash {stats['dm_prefix_hash']} on {stats['dm_prefix_share'] * 100:.0f}% of "
+          f"{stats['builds']} prompts ({len(stats['prefixes'])} distinct prefix)")
+    print(f"Cacheable prefix: {legacy_prefix} -> {builder_prefix} chars; "
+          f"dm prefix hash check: {prefix_hash(builder.dm_prefix) == stats['dm_prefix_hash']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Benchmark: DM tag extraction, per-tag regexes vs the single-pass parser.
+
+The old code ran one lazy regex per tag type (the ENEMY one has 14 groups)
+and re-searched and re-substituted the whole reply for every tag it applied.
+parse_tags walks the reply once. This times both on a typical reply and on
+malformed replies of growing size -- an unterminated [ENEMY: tag full of
+"|" makes the regex backtrack polynomially while the parser stays linear.
+No OpenAI key or database needed.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_tag_parser [--sizes 12,16,20,24] [--repeat 200]
+"""
+
+import argparse
+import re
+import time
+
+from app.services.tag_parser import parse_tags
+
+# The patterns OpenAIService used before the parser
+LEGACY_PATTERNS = [
+    r'\[ITEM:(.*?)\|(.*?)\|(.*?)\]',
+    r'\[TRANSACTION:(.*?)\|(.*?)\]',
+    r'\[REWARD:(.*?)\|(.*?)\]',
+    r'\[DAMAGE:(.*?)\|(.*?)\]',
+    r'\[HEALING:(.*?)\|(.*?)\]',
+    r'\[MP_USED:(.*?)\|(.*?)\]',
+    r'\[DAMAGE_DEALT:(.*?)\|(.*?)\]',
+    r'\[ENEMY:' + r'\|'.join([r'(.*?)'] * 14) + r'\]',
+    r'\[ENEMY_MOVE:(.*?)\|(.*?)\|(.*?)\|(.*?)\|(.*?)\|(.*?)\|(.*?)\]',
+    r'\[NPC:(.*?)\|(.*?)\|(.*?)\|(.*?)\|(.*?)\]',
+]
+
+TYPICAL_REPLY = (
+    "The cultist lunges from the shadows of the Templo Mayor, obsidian blade flashing. "
+    "You twist away but the edge bites your shoulder. Your hex answers, green fire "
+    "crawling over his robes. As he falls, a jade amulet rolls from his hand. "
+    "[ITEM:Jade Amulet|necklace|Wards off restless spirits] [DAMAGE:5|Cultist dagger] "
+    "[MP_USED:10|Hex] [DAMAGE_DEALT:12|Cultist] "
+    "[ENEMY:Cultist|A robed zealot|Serves the Obsidian Circle|30|10|12|10|12|10|8|8|10|6|11]"
+)
+
+
+def legacy_scan(text):
+    """Search, then strip, every tag type the way _process_tags used to"""
+    for pattern in LEGACY_PATTERNS:
+        if re.search(pattern, text):
+            text = re.sub(pattern, '', text).strip()
+    return text
+
+
+def adversarial_reply(size):
+    """An unterminated ENEMY tag with `size` empty fields (each 4 more cost the regex ~13x)"""
+    return "The shadows shift. [ENEMY:" + "|" * size
+
+
+def timed(function, text, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(text)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="12,16,20,24", help="comma separated malformed tag sizes")
+    parser.add_argument("--repeat", type=int, default=200, help="runs per measurement (typical reply)")
+    args = parser.parse_args()
+
+    legacy = timed(legacy_scan, TYPICAL_REPLY, args.repeat)
+    single = timed(parse_tags, TYPICAL_REPLY, args.repeat)
+    print(f"typical reply ({len(TYPICAL_REPLY)} chars): regex={legacy * 1e6:8.1f}us  parser={single * 1e6:8.1f}us")
+    print(f"parser effects: {[effect.kind for effect in parse_tags(TYPICAL_REPLY).effects]}\n")
+
+    print(f"{'size':>6} {'regex':>12} {'parser':>12}")
+    for size in [int(value) for value in args.sizes.split(",")]:
+        text = adversarial_reply(size)
+        legacy = timed(legacy_scan, text, 1)
+        single = timed(parse_tags, text, 10)
+        print(f"{size:>6} {legacy * 1e3:10.2f}ms {single * 1e3:10.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
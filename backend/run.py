@@ -7,4 +7,12 @@ if __name__ == "__main__":
     app.run(debug=True)
     
 # To run with gunicorn: gunicorn -w 4 -b 127.0.0.1:5000 run:app
-# This provides better database connection management with multiple workers 
\ No newline at end of file
+# This provides better database connection management with multiple workers
+#
+# The /api/async/* routes share one event loop per worker for their OpenAI calls,
+# so threaded workers can keep many generations in flight at once:
+# gunicorn -w 2 -k gthread --threads 100 -b 127.0.0.1:5000 run:app
+# The rate governor still caps chat calls across all workers at OPENAI_CHAT_CONCURRENCY
+# in flight (16 by default) and OPENAI_CHAT_RPM per minute (500); raise both, e.g.
+# OPENAI_CHAT_CONCURRENCY=200 OPENAI_CHAT_RPM=20000 (within your account's limits and
+# OPENAI_ASYNC_MAX_CONNECTIONS per worker), for that many generations to reach OpenAI at once.
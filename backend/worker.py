@@ -0,0 +1,23 @@
+import argparse
+import os
+from app.jobs import start_workers
+from app import tasks  # registers the background tasks
+from app.services.quest_pool import quest_pool
+from app.migrations import migrate
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the background job workers")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("JOB_WORKERS", 2)),
+                        help="number of worker processes (default: JOB_WORKERS or 2)")
+    args = parser.parse_args()
+
+    # Jobs may touch tables and columns added since the database was created
+    migrate()
+
+    # Fill the common quest pools before players start asking for quests
+    quest_pool.warm()
+    start_workers(args.workers)
+
+# Run alongside the web server: python worker.py --workers 4
+# Routes called with {"background": true} return 202 and a job id; follow the job
+# with GET /api/jobs/<id> or the Server-Sent Events stream at /api/jobs/<id>/events
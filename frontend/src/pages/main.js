@@ -94,6 +94,11 @@ function Main() {
       });
       
       if (aiResponse.ok) {
+        // Outbox mode: load the history once the effects of the reply are applied
+        const aiData = await aiResponse.json();
+        if (aiData.effects_url) {
+          await waitForDmEffects(aiData.effects_url);
+        }
         
         const chatHistoryResponse = await fetch(`http://127.0.0.1:5000/api/characters/${character.id}/chat`, {
           headers: {
@@ -327,6 +332,28 @@ function Main() {
     fetchData();
   }, [userId]);
   
+  // With DM_EFFECTS_MODE=outbox the backend applies the effects of a reply after answering:
+  // wait for them and return the notes it added to the message
+  const waitForDmEffects = async (effectsUrl) => {
+    const token = localStorage.getItem('token');
+    for (let attempt = 0; attempt < 20; attempt++) {
+      const response = await fetch(`http://127.0.0.1:5000${effectsUrl}`, {
+        headers: {
+          'Authorization': `Bearer ${token}`,
+          'Accept': 'application/json'
+        }
+      });
+      if (response.ok) {
+        const effects = await response.json();
+        if (effects.status !== 'pending') {
+          return effects.notes || [];
+        }
+      }
+      await new Promise(resolve => setTimeout(resolve, 250));
+    }
+    return [];
+  };
+  
   // Function to parse AI messages for potential items
   const parseItemSuggestions = (message) => {
     if (!message || !message.content || typeof message.content !== 'string') return;
@@ -498,6 +525,15 @@ function Main() {
         
         setChatMessages(prev => [...prev, aiMessage]);
         
+        // Outbox mode: the item and HP notes arrive once the effects are applied
+        if (aiData.effects_url) {
+          const notes = await waitForDmEffects(aiData.effects_url);
+          if (notes.length > 0) {
+            aiMessage.content = [aiMessage.content, ...notes].join('\n\n');
+            setChatMessages(prev => prev.map(message => message === aiMessage ? { ...aiMessage } : message));
+          }
+        }
+        
         // Parse the AI response for any suggested items
         parseItemSuggestions(aiMessage);
         